@@ -12,6 +12,8 @@ import modal
 app = modal.App('gemma_metrics_and_data')
 vol = modal.Volume.from_name('saes', create_if_missing=True)
 SAES_DIR='/saes'
+# random-baseline null distributions, reused across reruns (see null_cache_key)
+NULL_CACHE_DIR=f'{SAES_DIR}/null_cache'
 
 image = (
     modal.Image
@@ -326,7 +328,7 @@ def main_sae_sim_metrics_res(run_name: str, base_layer: str, one_to_X: int, targ
     4. get meta metrics, such as mean actv corr. done
     5. run svcca paired and rsa paired. done
     6. run shuffle rand for pvals and means there. done
-    7. save json. done
+    7. append the scores to the results store. done
 
     Changing to rely on cfg dicts to account for some run errors.
     """
@@ -358,7 +360,12 @@ def main_sae_sim_metrics_res(run_name: str, base_layer: str, one_to_X: int, targ
     # Ensure the directory exists
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-    metrics_dict_filename = f'metrics_dict_res_{run_name}_base-model-{cfg["base_model"]}_target-model-{cfg["target_model"]}_base-layer-{cfg["pure_layer_for_file_name"]}_target-layer-increments-{cfg["target_layer_increments"]}_one-to-X-{cfg["one_to_X"]}_max-seq-len-{cfg["max_seq_len"]}_batch-size-{cfg["batch_size"]}_num-runs-{cfg["num_runs"]}.json'
+    # one row per score, keyed by the sae pair, their layers and this config (see ResultsStore); a rerun only computes
+    # the scores not stored yet
+    store = ResultsStore(f'{file_path}results.sqlite')
+    store_config = {key: val for key, val in cfg.items() if key not in ('base_layer', 'pure_layer_for_file_name')}
+    store_config['run_name'] = run_name
+    meta_metrics = ['mean_activ_corr', 'num_feat_kept', 'mean_activ_corr_filt']
 
 
     gemma_2b_jb_saes_ids = [
@@ -374,21 +381,6 @@ def main_sae_sim_metrics_res(run_name: str, base_layer: str, one_to_X: int, targ
     ]
 
 
-    metrics_dict = {'cfg': cfg,
-                    'mean_activ_corr': {}, 'num_feat_kept': {}, 'mean_activ_corr_filt': {}, # meta level
-                    'svcca_paired': {}, 'svcca_rand_mean': {}, 'svcca_rand_pval': {}, # pairwise level
-                    'rsa_paired': {}, 'rsa_rand_mean': {}, 'rsa_rand_pval': {}} # pairwise level
-
-    # in case of bug, load in the saved metrics to avoid recalculation
-    if os.path.exists(f'{SAES_DIR}/gemma_2_2b_vs_gemma_1_2b_saes/{metrics_dict_filename}'):
-        with open(f'{SAES_DIR}/gemma_2_2b_vs_gemma_1_2b_saes/{metrics_dict_filename}', 'r') as f:
-            metrics_dict = json.load(f)
-
-            print(f'loaded metrics dict from {metrics_dict_filename}')
-
-    print(metrics_dict)
-
-
     def load_full_batch_activs(sae_id, model, batch_size=cfg['batch_size']):
         layer = sae_id.split('/')[0]
         activs = []
@@ -397,18 +389,6 @@ def main_sae_sim_metrics_res(run_name: str, base_layer: str, one_to_X: int, targ
 
         return np.concatenate(activs, axis=0)
 
-    def save_metrics_dict(metrics_dict):
-        # convert all floats etc to str representations for dumping to json
-        for key, value in metrics_dict.items():
-            if isinstance(value, dict):
-                for sub_key, sub_value in value.items():
-                    if isinstance(sub_value, float):
-                        metrics_dict[key][sub_key] = str(sub_value)
-
-        with open(f'{SAES_DIR}/gemma_2_2b_vs_gemma_1_2b_saes/{metrics_dict_filename}', 'w') as f:
-            json.dump(metrics_dict, f)
-            print(f'saved metrics dict to {metrics_dict_filename}')
-
     # loop over all sae pairs
     for gemma_2_2b_sae in gemma_scope_2b_pt_res_canonical_ids:
 
@@ -431,46 +411,16 @@ def main_sae_sim_metrics_res(run_name: str, base_layer: str, one_to_X: int, targ
 
         for gemma_1_2b_sae in gemma_2b_jb_saes_ids:
 
-            # Here need some logic so that we can avoid recalculating the same metrics
             pairwise_label = f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'
-
-            # We don't need to do the expensive correlation code if we only do unpaired rand mean and pval
-            # Very likely a more efficient way to do this, test quickly for now
-
-            mean_activ_corr_already = False
-            num_feat_kept_already = False
-            mean_activ_corr_filt_already = False
-
-            svcca_paired_already = False
-            svcca_rand_mean_already = False
-            svcca_rand_pval_already = False
-
-            rsa_paired_already = False
-            rsa_rand_mean_already = False
-            rsa_rand_pval_already = False
-
-
-            if pairwise_label in metrics_dict['mean_activ_corr_filt']:
-                mean_activ_corr_already = True
-            if pairwise_label in metrics_dict['num_feat_kept']:
-                num_feat_kept_already = True
-            if pairwise_label in metrics_dict['mean_activ_corr_filt']:
-                mean_activ_corr_filt_already = True
-            if pairwise_label in metrics_dict['svcca_paired']:
-                svcca_paired_already = True
-            if pairwise_label in metrics_dict['svcca_rand_mean']:
-                svcca_rand_mean_already = True
-            if pairwise_label in metrics_dict['svcca_rand_pval']:
-                svcca_rand_pval_already = True
-            if pairwise_label in metrics_dict['rsa_paired']:
-                rsa_paired_already = True
-            if pairwise_label in metrics_dict['rsa_rand_mean']:
-                rsa_rand_mean_already = True
-            if pairwise_label in metrics_dict['rsa_rand_pval']:
-                rsa_rand_pval_already = True
-
-
-
+            store_key = {'model_A': cfg['base_model'], 'model_B': cfg['target_model'],
+                         'sae_A': 'gemma-scope-2b-pt-res-canonical', 'sae_B': 'gemma-scope-9b-pt-res-canonical',
+                         'layer_A': gemma_2_2b_sae, 'layer_B': gemma_1_2b_sae}
+            done = store.done_metrics(config=store_config, **store_key)
+            todo_sims = [sim for sim in ('svcca', 'rsa')
+                         if not {f'{sim}_paired', f'{sim}_rand_mean', f'{sim}_rand_pval'} <= done]
+            if set(meta_metrics) <= done and not todo_sims:
+                print(f'skipping {pairwise_label}, all scores already stored')
+                continue
 
             full_batch_sae_activs_1_2b = load_full_batch_activs(gemma_1_2b_sae, 'gemma_1_2b')
             first_dim_reshaped = full_batch_sae_activs_1_2b.shape[0] * full_batch_sae_activs_1_2b.shape[1]
@@ -487,105 +437,73 @@ def main_sae_sim_metrics_res(run_name: str, base_layer: str, one_to_X: int, targ
             print(f'shape of full_batch_sae_activs_9b {full_batch_sae_activs_1_2b.shape}')
             print(f'number of nonzero activations gemma 2 9b {np.count_nonzero(full_batch_sae_activs_1_2b)}')
 
-            if mean_activ_corr_already and num_feat_kept_already and mean_activ_corr_filt_already and svcca_paired_already and rsa_paired_already:
-                print(f'skipping {pairwise_label} correlation and paired calculation')
-                continue
-            else:
-                full_batch_sae_activs_2b_tensor = torch.tensor(full_batch_sae_activs_2b, dtype=torch.float32)
-                full_batch_sae_activs_1_2b_tensor = torch.tensor(full_batch_sae_activs_1_2b, dtype=torch.float32)
-                highest_correlations_indices_AB, highest_correlations_values_AB = batched_correlation(full_batch_sae_activs_2b_tensor, full_batch_sae_activs_1_2b_tensor)
-
-                metrics_dict['mean_activ_corr'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = sum(highest_correlations_values_AB) / len(highest_correlations_values_AB)
-
-                print('mean activ corr', metrics_dict['mean_activ_corr'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-
-                sorted_feat_counts = Counter(highest_correlations_indices_AB).most_common()
-                kept_mod2_feats = [feat_ID for feat_ID, count in sorted_feat_counts if count <= cfg['one_to_X']]
-
-                filt_corr_ind_A = []
-                filt_corr_ind_B = []
-                seen = set()
-
-                for ind_B, ind_A in enumerate(highest_correlations_indices_AB):
-                    if ind_A in kept_mod2_feats:
-                        filt_corr_ind_A.append(ind_A)
-                        filt_corr_ind_B.append(ind_B)
-                    elif ind_A not in seen:  # only keep one if it's over count X
-                        seen.add(ind_A)
-                        filt_corr_ind_A.append(ind_A)
-                        filt_corr_ind_B.append(ind_B)
-
-                new_highest_correlations_indices_A = []
-                new_highest_correlations_indices_B = []
-                new_highest_correlations_values = []
-
-                for ind_A, ind_B in zip(filt_corr_ind_A, filt_corr_ind_B):
-                    val = highest_correlations_values_AB[ind_B]
-                    if val > 0:
-                        new_highest_correlations_indices_A.append(ind_A)
-                        new_highest_correlations_indices_B.append(ind_B)
-                        new_highest_correlations_values.append(val)
-
-                metrics_dict['num_feat_kept'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = len(new_highest_correlations_indices_A)
-                metrics_dict['mean_activ_corr_filt'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = sum(new_highest_correlations_values) / len(new_highest_correlations_values)
-
-                print('num feat kept', metrics_dict['num_feat_kept'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-                print('mean activ corr filt', metrics_dict['mean_activ_corr_filt'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-
-                print('shape of filtered weights gemma 2 2b', gemma_2_2b_sae_w_dec[new_highest_correlations_indices_A].shape)
-                print('shape of filtered weights gemma 2 9b', gemma_1_2b_sae_w_dec[new_highest_correlations_indices_B].shape)
-
-                num_feats = len(new_highest_correlations_indices_A)
-
-                metrics_dict['svcca_paired'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = svcca(gemma_2_2b_sae_w_dec[new_highest_correlations_indices_A],
-                                                                                                                    gemma_1_2b_sae_w_dec[new_highest_correlations_indices_B],
-                                                                                                                    'nd')
-
-                print('svcca paired', metrics_dict['svcca_paired'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-
-
-
-                metrics_dict['rsa_paired'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = representational_similarity_analysis(gemma_2_2b_sae_w_dec[new_highest_correlations_indices_A],
-                                                                                                                                                 gemma_1_2b_sae_w_dec[new_highest_correlations_indices_B],
-                                                                                                                                                 'nd')
-
-                print('rsa paired', metrics_dict['rsa_paired'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-
-            if not svcca_rand_mean_already and not svcca_rand_pval_already:
+            # every missing score needs the pairs, so they are recomputed whenever one is missing
+            full_batch_sae_activs_2b_tensor = torch.tensor(full_batch_sae_activs_2b, dtype=torch.float32)
+            full_batch_sae_activs_1_2b_tensor = torch.tensor(full_batch_sae_activs_1_2b, dtype=torch.float32)
+            highest_correlations_indices_AB, highest_correlations_values_AB = batched_correlation(full_batch_sae_activs_2b_tensor, full_batch_sae_activs_1_2b_tensor)
+
+            # each B feat is paired with its max-correlated A feat; an A feat matched more than one_to_X times
+            # only keeps its first pair
+            filt_corr_ind_A, filt_corr_ind_B = one_to_X_pairs(highest_correlations_indices_AB,
+                                                              np.arange(len(highest_correlations_indices_AB)),
+                                                              cfg['one_to_X'])
+
+            new_highest_correlations_indices_A = []
+            new_highest_correlations_indices_B = []
+            new_highest_correlations_values = []
+
+            for ind_A, ind_B in zip(filt_corr_ind_A, filt_corr_ind_B):
+                val = highest_correlations_values_AB[ind_B]
+                if val > 0:
+                    new_highest_correlations_indices_A.append(ind_A)
+                    new_highest_correlations_indices_B.append(ind_B)
+                    new_highest_correlations_values.append(val)
+
+            if not set(meta_metrics) <= done:
+                meta_scores = {
+                    'mean_activ_corr': sum(highest_correlations_values_AB) / len(highest_correlations_values_AB),
+                    'num_feat_kept': len(new_highest_correlations_indices_A),
+                    'mean_activ_corr_filt': sum(new_highest_correlations_values) / len(new_highest_correlations_values),
+                }
+                store.append(meta_scores, config=store_config, **store_key)
+                for metric, value in meta_scores.items():
+                    print(metric.replace('_', ' '), value)
+
+            print('shape of filtered weights gemma 2 2b', gemma_2_2b_sae_w_dec[new_highest_correlations_indices_A].shape)
+            print('shape of filtered weights gemma 2 9b', gemma_1_2b_sae_w_dec[new_highest_correlations_indices_B].shape)
+
+            num_feats = len(new_highest_correlations_indices_A)
+
+            for sim in todo_sims:
+                sim_fn = svcca if sim == 'svcca' else representational_similarity_analysis
+
+                if f'{sim}_paired' in done:
+                    paired = store.query(metrics=f'{sim}_paired', config=store_config, **store_key)['value'].iloc[0]
+                else:
+                    paired = sim_fn(gemma_2_2b_sae_w_dec[new_highest_correlations_indices_A],
+                                    gemma_1_2b_sae_w_dec[new_highest_correlations_indices_B],
+                                    'nd')
+                    store.append({f'{sim}_paired': paired}, config=store_config, **store_key)
+                    print(f'{sim} paired', paired)
+
+                if {f'{sim}_rand_mean', f'{sim}_rand_pval'} <= done:
+                    print(f'skipping {pairwise_label} {sim} rand mean and pval calculation')
+                    continue
 
                 rand_scores = shuffle_rand(cfg['num_runs'],
                                            gemma_2_2b_sae_w_dec[new_highest_correlations_indices_A],
                                            gemma_1_2b_sae_w_dec[new_highest_correlations_indices_B],
                                            num_feats,
-                                           svcca,
-                                           shapereq_bool=True)
-
-                metrics_dict['svcca_rand_mean'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = sum(rand_scores) / len(rand_scores)
-                metrics_dict['svcca_rand_pval'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = np.mean(np.array(rand_scores) >= metrics_dict['svcca_paired'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-
-                print('svcca rand mean', metrics_dict['svcca_rand_mean'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-                print('svcca rand pval', metrics_dict['svcca_rand_pval'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-            else:
-                print(f'skipping {pairwise_label} svcca rand mean and pval calculation')
-
-            if not rsa_rand_mean_already and not rsa_rand_pval_already:
-
-                rand_scores = shuffle_rand(cfg['num_runs'],
-                                           gemma_2_2b_sae_w_dec[new_highest_correlations_indices_A],
-                                           gemma_1_2b_sae_w_dec[new_highest_correlations_indices_B],
-                                           num_feats,
-                                           representational_similarity_analysis,
-                                           shapereq_bool=True)
-
-                metrics_dict['rsa_rand_mean'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = sum(rand_scores) / len(rand_scores)
-                metrics_dict['rsa_rand_pval'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'] = np.mean(np.array(rand_scores) >= metrics_dict['rsa_paired'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
+                                           sim_fn,
+                                           shapereq_bool=True,
+                                           cache_dir=NULL_CACHE_DIR)
 
-                print('rsa rand mean', metrics_dict['rsa_rand_mean'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-                print('rsa rand pval', metrics_dict['rsa_rand_pval'][f'gemma_2_2b-{gemma_2_2b_sae}_vs_gemma_1_2b-{gemma_1_2b_sae}'])
-            else:
-                print(f'skipping {pairwise_label} rsa rand mean and pval calculation')
+                rand_metrics = {f'{sim}_rand_mean': sum(rand_scores) / len(rand_scores),
+                                f'{sim}_rand_pval': np.mean(np.array(rand_scores) >= paired)}
+                store.append(rand_metrics, config=store_config, **store_key)
 
-            save_metrics_dict(metrics_dict)
+                print(f'{sim} rand mean', rand_metrics[f'{sim}_rand_mean'])
+                print(f'{sim} rand pval', rand_metrics[f'{sim}_rand_pval'])
 
             del full_batch_sae_activs_1_2b
             del sae1
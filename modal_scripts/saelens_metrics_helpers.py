@@ -83,10 +83,9 @@ def highest_activating_tokens_saelens(
 
     return torch.stack([top_acts_batch, top_acts_seq], dim=-1), top_acts_values
 
-def store_top_toks_saelens(top_acts_indices, top_acts_values, batch_tokens, tokenizer):
-    feat_samps = []
-    for (batch_idx, seq_idx), value in zip(top_acts_indices, top_acts_values):
-        new_str_token = tokenizer.decode(batch_tokens[batch_idx, seq_idx]).replace("\n", "\\n").replace("<|BOS|>", "|BOS|")
-        feat_samps.append(new_str_token)
-    return feat_samps
+def store_top_toks_saelens(top_acts_indices, top_acts_values, batch_tokens, tokenizer, vocab=None):
+    if vocab is None:
+        vocab = get_vocab_table(tokenizer)
+    top_tok_ids = batch_tokens[top_acts_indices[:, 0], top_acts_indices[:, 1]].cpu().numpy()
+    return [tok_str.replace("\n", "\\n").replace("<|BOS|>", "|BOS|") for tok_str in vocab.decode(top_tok_ids)]
 
@@ -110,6 +110,38 @@ def batched_correlation(reshaped_activations_A, reshaped_activations_B, batch_si
     del normalized_A, normalized_B
     return torch.cat(max_indices).cpu().numpy(), torch.cat(max_values).cpu().numpy()
 
+# pairing functions (same as run_pipeline/pairing_fns.py)
+
+def first_occurrence_mask(inds):
+    # True at the first position each value appears at, in the original order
+    inds = np.asarray(inds, dtype=np.int64)
+    if len(inds) == 0:
+        return np.zeros(0, dtype=bool)
+    positions = np.arange(len(inds))
+    first_pos = np.full(inds.max() + 1, len(inds))
+    np.minimum.at(first_pos, inds, positions)
+    return first_pos[inds] == positions
+
+def one_to_X_mask(inds, X, count_inds=None):
+    """
+    inds: the "many" side feature of each pair, in pair order
+    count_inds: the indices to count matches over (defaults to inds). run_expm counts over all pairs from
+        batched_correlation, before keyword filtering, and applies the mask to the filtered pairs.
+    """
+    inds = np.asarray(inds, dtype=np.int64)
+    count_inds = inds if count_inds is None else np.asarray(count_inds, dtype=np.int64)
+    if len(inds) == 0:
+        return np.zeros(0, dtype=bool)
+    minlength = max(inds.max(), count_inds.max() if len(count_inds) else 0) + 1
+    counts = np.bincount(count_inds, minlength=minlength)
+    return (counts[inds] <= X) | first_occurrence_mask(inds)
+
+def one_to_X_pairs(ind_A, ind_B, X, count_inds=None, manyA_1B_bool=True):
+    ind_A, ind_B = np.asarray(ind_A, dtype=np.int64), np.asarray(ind_B, dtype=np.int64)
+    many_inds = ind_A if manyA_1B_bool else ind_B
+    keep = one_to_X_mask(many_inds, X, count_inds)
+    return ind_A[keep].tolist(), ind_B[keep].tolist()
+
 # similarity functions
 
 import functools
@@ -720,6 +752,47 @@ def representational_similarity_analysis(
         raise ValueError(f"Unknown outer similarity function: {outer}")
 
 
+# RSA permutation test on precomputed RSM ranks (same as run_pipeline/sim_fns.py)
+def _correlation_rsm_condensed(R, n_jobs=None):
+    # condensed (upper triangle) RSM as in representational_similarity_analysis with inner="correlation"
+    R = R - R.mean(axis=1, keepdims=True)
+    return scipy.spatial.distance.squareform(
+        1 - sklearn.metrics.pairwise_distances(R, metric="cosine", n_jobs=n_jobs),  # type:ignore
+        checks=False,
+    )
+
+
+def rsa_permutation_scores(R, Rp, perms, max_chunk_elems=2**24, n_jobs=None) -> list:
+    """representational_similarity_analysis(R, Rp[perm], "nd") for every row permutation perm in perms.
+
+    Permuting the rows of Rp only reorders its condensed RSM, so both RSMs are ranked once and each score is the
+    correlation of the ranks, with the permuted condensed indices gathered over blocks of RSM rows.
+    """
+    R, Rp = flatten(R, Rp, shape="nd")
+    R, Rp = to_numpy_if_needed(R, Rp)
+    perms = np.asarray(perms, dtype=np.int64).reshape(-1, R.shape[0])
+    N = R.shape[0]
+
+    rank_x = scipy.stats.rankdata(_correlation_rsm_condensed(R, n_jobs))
+    rank_y = scipy.stats.rankdata(_correlation_rsm_condensed(Rp, n_jobs))
+    rank_x = (rank_x - rank_x.mean()) / rank_x.std()
+    rank_y = (rank_y - rank_y.mean()) / rank_y.std()
+
+    dots = np.zeros(len(perms))
+    rows_per_block = max(1, max_chunk_elems // max(1, N * len(perms)))
+    start = 0
+    for i0 in range(0, N - 1, rows_per_block):
+        i1 = min(i0 + rows_per_block, N - 1)
+        ii, jj = np.nonzero(np.arange(N)[None, :] > np.arange(i0, i1)[:, None])
+        ii += i0
+        lo = np.minimum(perms[:, ii], perms[:, jj])
+        hi = np.maximum(perms[:, ii], perms[:, jj])
+        cond_inds = lo * N - lo * (lo + 1) // 2 + hi - lo - 1
+        dots += rank_y[cond_inds] @ rank_x[start:start + len(ii)]
+        start += len(ii)
+    return (dots / len(rank_x)).tolist()
+
+
 class RSA(RSMSimilarityMeasure):
     def __init__(self):
         # choice of inner/outer in __call__ if fixed to default values, so these values are always the same
@@ -1262,6 +1335,48 @@ def svcca(
     return _svcca_original(R.T, Rp.T)
 
 
+# SVD-reuse permutation test (same as run_pipeline/sim_fns.py)
+def cca_mean_from_covariances(sigmaxx, sigmaxy, sigmayy, epsilon=1e-10):
+    # Same steps as get_cca_similarity (rescaling, compute_ccas) but starting from given (cross-)covariances
+    xmax = np.max(np.abs(sigmaxx))
+    ymax = np.max(np.abs(sigmayy))
+    sigmaxx = sigmaxx / xmax
+    sigmayy = sigmayy / ymax
+    sigmaxy = sigmaxy / np.sqrt(xmax * ymax)
+
+    if not np.any(np.abs(np.diagonal(sigmaxx)) >= epsilon) or not np.any(np.abs(np.diagonal(sigmayy)) >= epsilon):
+        return 0.0
+    ([u, s, v], _, _, _, _) = compute_ccas(sigmaxx, sigmaxy, sigmaxy.T.copy(), sigmayy, epsilon=epsilon, verbose=False)
+    return np.mean(s)
+
+
+def svcca_top_k_svd(R):
+    # (s[:k], V[:k]) of the mean-subtracted acts R.T, as computed in _svcca_original
+    acts = R.T
+    cacts = acts - np.mean(acts, axis=1, keepdims=True)
+    _, s, V = np.linalg.svd(cacts, full_matrices=False)
+    k = top_k_pca_comps(s)
+    return s[:k], V[:k]
+
+
+def svcca_permutation_scores(R, Rp, perms) -> list:
+    """svcca(R, Rp[perm], "nd") for every row permutation perm in perms.
+
+    Permuting the rows of Rp only permutes the columns of its V, so both truncated SVDs are computed once and each
+    permutation only needs the small k1 x k2 CCA.
+    """
+    R, Rp = flatten(R, Rp, shape="nd")
+    R, Rp = to_numpy_if_needed(R, Rp)
+    s1, V1 = svcca_top_k_svd(R)
+    s2, V2 = svcca_top_k_svd(Rp)
+    assert len(s1) < R.shape[0] and len(s2) < Rp.shape[0], "input must be number of neurons" "by datapoints"
+
+    s1, s2 = s1.astype(np.float64), s2.astype(np.float64)
+    sigmaxx, sigmayy = np.diag(s1**2), np.diag(s2**2)
+    sV1, sV2 = s1[:, None] * V1, s2[:, None] * V2
+    return [cca_mean_from_covariances(sigmaxx, sV1 @ sV2[:, perm].T, sigmayy) for perm in perms]
+
+
 def pwcca(
     R: Union[torch.Tensor, npt.NDArray],
     Rp: Union[torch.Tensor, npt.NDArray],
@@ -1575,28 +1690,50 @@ def highest_activating_tokens(
 
     return torch.stack([top_acts_batch, top_acts_seq], dim=-1), top_acts_values
 
+# decoded vocab table, imported from run_pipeline instead of mirrored (modal mounts the imported local module)
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'run_pipeline'))
+from vocab_fns import VocabTable, get_vocab_table
+
 from rich import print as rprint
-def display_top_sequences(top_acts_indices, top_acts_values, batch_tokens):
+def context_windows(batch_tokens, docs, pos, left=5, right=5):
+    # (n, left + right) token IDs around each (doc, pos) example in one fancy index, -1 outside the doc
+    # (same as run_pipeline/context_fns.py)
+    batch_tokens = batch_tokens.cpu() if isinstance(batch_tokens, torch.Tensor) else torch.as_tensor(batch_tokens)
+    docs, pos = torch.as_tensor(docs).long().reshape(-1), torch.as_tensor(pos).long().reshape(-1)
+    cols = pos[:, None] + torch.arange(-left, right)[None, :]
+    inside = (cols >= 0) & (cols < batch_tokens.shape[1])
+    window_ids = batch_tokens[docs[:, None].clamp_min(0), cols.clamp(0, batch_tokens.shape[1] - 1)]
+    return torch.where(inside & (docs[:, None] >= 0), window_ids, -1)
+
+_escaped_vocabs = {}
+def display_top_sequences(top_acts_indices, top_acts_values, batch_tokens, vocab=None):
+    if vocab is None:
+        vocab = get_vocab_table(tokenizer)
+    top_acts_indices = torch.as_tensor(top_acts_indices)
+    if id(vocab) not in _escaped_vocabs:
+        # escaped vocab with '' appended, so the -1 IDs outside the doc decode to ''
+        _escaped_vocabs[id(vocab)] = np.array([tok_str.replace("\n", "\\n").replace("<|BOS|>", "|BOS|") for tok_str in vocab.id_to_str] + [''], dtype=object)
+    decoded = _escaped_vocabs[id(vocab)][context_windows(batch_tokens, top_acts_indices[:, 0], top_acts_indices[:, 1]).numpy()]
+    decoded[:, 5] = [f"[bold u dark_orange]{tok}[/]" for tok in decoded[:, 5]]
     s = ""
-    for (batch_idx, seq_idx), value in zip(top_acts_indices, top_acts_values):
-        # s += f'{batch_idx}\n'
+    for (batch_idx, seq_idx), value, row in zip(top_acts_indices.tolist(), top_acts_values, decoded):
         s += f'batchID: {batch_idx}, '
-        # Get the sequence as a string (with some padding on either side of our sequence)
-        seq_start = max(seq_idx - 5, 0)
-        seq_end = min(seq_idx + 5, batch_tokens.shape[1])
-        seq = ""
-        # Loop over the sequence, adding each token to the string (highlighting the token with the large activations)
-        for i in range(seq_start, seq_end):
-            # new_str_token = model.to_single_str_token(batch_tokens[batch_idx, i].item()).replace("\n", "\\n").replace("<|BOS|>", "|BOS|")
-            new_str_token = tokenizer.decode([batch_tokens[batch_idx, i].item()]).replace("\n", "\\n").replace("<|BOS|>", "|BOS|")
-            if i == seq_idx:
-                new_str_token = f"[bold u dark_orange]{new_str_token}[/]"
-            seq += new_str_token
         # Print the sequence, and the activation value
-        s += f'Act = {value:.2f}, Seq = "{seq}"\n'
+        s += f'Act = {value:.2f}, Seq = "{"".join(row)}"\n'
 
     rprint(s)
 
+# per-feature top activations index, imported from run_pipeline (sys.path set above for vocab_fns): a feature's top
+# examples over the whole dataset, built during extraction, so display_top_sequences does not need a topk over the
+# in-memory feature_acts
+from topk_index_fns import TopActivationsIndex, get_top_acts_index, tokens_hash, top_acts_index_path
+
+def display_feature_top_sequences(top_acts_index, feature_idx, batch_tokens, k=None, vocab=None):
+    # display_top_sequences from the index; batch_tokens are the input_ids the index was built over
+    top_acts_indices, top_acts_values = top_acts_index.top(feature_idx, k)
+    display_top_sequences(top_acts_indices, top_acts_values.tolist(), batch_tokens, vocab=vocab)
+
 from torch.utils.data import DataLoader, TensorDataset
 
 # getting llm activations
@@ -1686,7 +1823,88 @@ def get_next_batch(dataset_iter, batch_size=100):
 
 
 
-def shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool):
+# null-distribution cache (same as run_pipeline/null_cache_fns.py)
+
+import hashlib
+
+
+def W_dec_hash(W):
+    W = np.ascontiguousarray(W.detach().cpu().numpy() if isinstance(W, torch.Tensor) else W)
+    return hashlib.sha1(W.view(np.uint8)).hexdigest()[:16] + f'_{W.shape[0]}x{W.shape[1]}'
+
+def null_cache_key(kind, weight_matrix_np, weight_matrix_2, num_feats, metric, seed):
+    return f'{kind}_{metric}_{W_dec_hash(weight_matrix_np)}_{W_dec_hash(weight_matrix_2)}_n{num_feats}_seed{seed}'
+
+def null_cache_path(cache_dir, key):
+    return os.path.join(cache_dir, f'null_{key}.npy')
+
+def load_cached_scores(path):
+    return np.load(path) if os.path.exists(path) else np.zeros(0)
+
+def save_cached_scores(path, scores):
+    # write to a temp file and rename, so an interrupted run never leaves a truncated entry
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, np.asarray(scores, dtype=np.float64))
+    os.replace(tmp_path, path)
+
+def extend_cached_scores(path, num_runs, score_runs):
+    scores = load_cached_scores(path)
+    if len(scores) < num_runs:
+        print(f'null cache: {len(scores)} runs cached, scoring {num_runs - len(scores)} more')
+        new_scores = np.asarray(score_runs(len(scores), num_runs - len(scores)), dtype=np.float64)
+        scores = np.concatenate([scores, new_scores])
+        save_cached_scores(path, scores)
+    return scores[:num_runs]
+
+def cached_null_scores(kind, num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, seed, cache_dir,
+                       score_runs):
+    key = null_cache_key(kind, weight_matrix_np, weight_matrix_2, num_feats, sim_fn.__name__, seed)
+    return extend_cached_scores(null_cache_path(cache_dir, key), num_runs, score_runs)
+
+def run_seed_seqs(seed, first_run, num_runs):
+    # run i's seed stream, the same as SeedSequence(seed).spawn(n)[i] for any n > i
+    return [np.random.SeedSequence(seed, spawn_key=(run,)) for run in range(first_run, first_run + num_runs)]
+
+def seeded_shuffle_perms(seed_seqs, num_feats):
+    return [np.random.default_rng(seed_seq).permutation(num_feats).tolist() for seed_seq in seed_seqs]
+
+
+def score_perms(weight_matrix_np, weight_matrix_2, perms, sim_fn, shapereq_bool):
+    if sim_fn is svcca:
+        return svcca_permutation_scores(weight_matrix_np, weight_matrix_2, perms)
+    if sim_fn is representational_similarity_analysis:
+        return rsa_permutation_scores(weight_matrix_np, weight_matrix_2, perms)
+    scores = []
+    for row_idxs in perms:
+        if shapereq_bool:
+            scores.append(sim_fn(weight_matrix_np, weight_matrix_2[row_idxs], "nd"))
+        else:
+            scores.append(sim_fn(weight_matrix_np, weight_matrix_2[row_idxs]))
+    return scores
+
+def shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, cache_dir=None,
+                 seed=0):
+    # cache_dir: read from / add to the null cache there (runs are then shuffled with run_seed_seqs(seed))
+    if cache_dir is not None:
+        def score_runs(first_run, num_new_runs):
+            perms = seeded_shuffle_perms(run_seed_seqs(seed, first_run, num_new_runs), num_feats)
+            return score_perms(weight_matrix_np, weight_matrix_2, perms, sim_fn, shapereq_bool)
+
+        return cached_null_scores('shuffle', num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, seed,
+                                  cache_dir, score_runs).tolist()
+
+    if sim_fn is svcca or sim_fn is representational_similarity_analysis:
+        # same permutations, but the SVDs / RSMs are computed once for all runs
+        perms = []
+        for i in range(num_runs):
+            row_idxs = list(range(num_feats))
+            random.shuffle(row_idxs)
+            perms.append(row_idxs)
+        if sim_fn is svcca:
+            return svcca_permutation_scores(weight_matrix_np, weight_matrix_2, perms)
+        return rsa_permutation_scores(weight_matrix_np, weight_matrix_2, perms)
+
     all_rand_scores = []
     for i in range(num_runs):
         row_idxs = list(range(num_feats))
@@ -1697,4 +1915,134 @@ def shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn,
             score = sim_fn(weight_matrix_np, weight_matrix_2[row_idxs])
         all_rand_scores.append(score)
     # return sum(all_rand_scores) / len(all_rand_scores)
-    return all_rand_scores
\ No newline at end of file
+    return all_rand_scores
+
+
+
+# results store (same as run_pipeline/results_fns.py): one SQLite row per score, keyed by
+# (model_A, model_B, sae_A, sae_B, layer_A, layer_B, metric, config_hash), appended in its own transaction
+
+import sqlite3
+import time
+
+
+KEY_COLUMNS = ('model_A', 'model_B', 'sae_A', 'sae_B', 'layer_A', 'layer_B', 'metric', 'config_hash')
+
+def _canonical_config_value(val):
+    # (same as run_pipeline/results_fns.py)
+    # plain values as they are (so their hashes do not change), numpy values as lists / scalars, dicts as sorted items
+    if isinstance(val, np.ndarray):
+        return val.tolist()
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, (bool, int, float, str, type(None))):
+        return val
+    if isinstance(val, (tuple, list)):
+        return type(val)(_canonical_config_value(v) for v in val)
+    if isinstance(val, dict):
+        return tuple(sorted((key, _canonical_config_value(v)) for key, v in val.items()))
+    raise TypeError(f"config value {val!r} of type {type(val).__name__} has no stable repr to hash")
+
+def config_hash(config):
+    # config: the settings the results depend on; objects without a stable repr (e.g. the vocab table) raise TypeError
+    canonical_config = {key: _canonical_config_value(val) for key, val in config.items()}
+    return hashlib.sha1(repr(sorted(canonical_config.items())).encode()).hexdigest()[:10]
+
+def _to_db_value(value):
+    # (value, blob): numbers as they are, everything else pickled
+    if isinstance(value, (bool, np.bool_)):
+        return int(value), None
+    if isinstance(value, (int, np.integer)):
+        return int(value), None
+    if np.ndim(value) == 0 and not isinstance(value, (str, dict)) and value is not None:
+        try:
+            return float(value), None
+        except (TypeError, ValueError):
+            pass
+    return None, pickle.dumps(value)
+
+class ResultsStore:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # layer columns have no type, so int layers stay ints and sae_id layers stay strings
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS results (
+                model_A TEXT, model_B TEXT, sae_A TEXT, sae_B TEXT, layer_A, layer_B, metric TEXT,
+                config_hash TEXT, value, blob BLOB, created REAL,
+                PRIMARY KEY ({', '.join(KEY_COLUMNS)}))""")
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def append(self, metrics, model_A, model_B, sae_A=None, sae_B=None, layer_A=None, layer_B=None, config=None):
+        """
+        Stores every (metric, value) of metrics for this key in one transaction; a metric already stored for the key is
+        replaced.
+        """
+        key = (model_A, model_B, sae_A or '', sae_B or '', layer_A, layer_B)
+        chash = config_hash(config or {})
+        rows = [(*key, metric, chash, *_to_db_value(value), time.time()) for metric, value in metrics.items()]
+        conn = self._connect()
+        with conn:
+            conn.executemany(f"INSERT OR REPLACE INTO results VALUES ({', '.join('?' * 11)})", rows)
+        conn.close()
+
+    def _where(self, filters):
+        clauses, params = [], []
+        for col, val in filters.items():
+            if val is None:
+                continue
+            if col == 'config':
+                col, val = 'config_hash', config_hash(val)
+            if col not in KEY_COLUMNS:
+                raise ValueError(f"Unknown results column: {col}")
+            if isinstance(val, (list, tuple, set)):
+                clauses.append(f"{col} IN ({', '.join('?' * len(val))})")
+                params.extend(val)
+            else:
+                clauses.append(f'{col} = ?')
+                params.append(val)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def done_metrics(self, model_A, model_B, sae_A=None, sae_B=None, layer_A=None, layer_B=None, config=None):
+        # set of the metrics already stored for this key
+        where, params = self._where({'model_A': model_A, 'model_B': model_B, 'sae_A': sae_A or '', 'sae_B': sae_B or '',
+                                     'layer_A': layer_A, 'layer_B': layer_B, 'config': config or {}})
+        conn = self._connect()
+        metrics = {metric for (metric,) in conn.execute(f'SELECT metric FROM results{where}', params)}
+        conn.close()
+        return metrics
+
+    def query(self, metrics=None, **filters):
+        """
+        DataFrame of the rows matching filters (a value or a list of values per key column, or config=dict), with
+        columns KEY_COLUMNS + (value, created); value holds the unpickled object for non-scalar scores.
+        e.g. store.query(metrics=['svcca_paired', 'svcca_rand_mean'], sae_A='EleutherAI/sae-pythia-70m-32k')
+        """
+        import pandas as pd
+        if metrics is not None:
+            filters['metric'] = [metrics] if isinstance(metrics, str) else list(metrics)
+        where, params = self._where(filters)
+        conn = self._connect()
+        rows = conn.execute(f"SELECT {', '.join(KEY_COLUMNS)}, value, blob, created FROM results{where}",
+                            params).fetchall()
+        conn.close()
+        df = pd.DataFrame([row[:len(KEY_COLUMNS)] + row[-1:] for row in rows], columns=[*KEY_COLUMNS, 'created'])
+        # object column, so counts stay ints next to float scores and pickled objects. SQLite stores nan as NULL
+        values = [pickle.loads(blob) if blob is not None else (np.nan if value is None else value)
+                  for *_, value, blob, _ in rows]
+        df.insert(len(KEY_COLUMNS), 'value', pd.Series(values, index=df.index, dtype=object))
+        return df
+
+def layer_to_dictscores(df, layer_A=None):
+    """
+    {layer_A: {layer_B: {metric: value}}} of a query DataFrame (one model / SAE pair and config), as the
+    model_layer_to_dictscores run.py used to pickle; with layer_A, only its {layer_B: dictscores}, as plot_fns takes.
+    """
+    model_layer_to_dictscores = {}
+    for layer_A_, layer_B, metric, value in zip(df['layer_A'], df['layer_B'], df['metric'], df['value']):
+        model_layer_to_dictscores.setdefault(layer_A_, {}).setdefault(layer_B, {})[metric] = value
+    return model_layer_to_dictscores if layer_A is None else model_layer_to_dictscores[layer_A]
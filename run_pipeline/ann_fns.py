@@ -0,0 +1,212 @@
+"""
+k-nearest-neighbor indexes over decoder weight rows (16k-131k rows), for Jaccard neighborhoods, mutual nearest neighbor
+matching and UMAP inputs, without native build dependencies.
+
+    ExactIndex: blocked matmul + torch.topk; the baseline the approximate index is measured against
+    IVFIndex:   inverted file index. k-means (spherical for cosine) splits the rows into num_lists lists; a query
+                only scores the rows of its num_probes closest lists, exactly
+
+Both have query(Q, k, query_ids=None) -> (inds, scores), with scores = cosine similarity or -squared euclidean
+distance. get_ann_index builds an index once per W_dec (by content hash) and, with a cache_dir, persists the IVF lists
+there. report_recall prints the recall@k of an IVFIndex against ExactIndex.
+"""
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+# in-process cache of built / loaded indexes
+_ann_indexes = {}
+
+def _to_torch(X, device=None):
+    X = X if isinstance(X, torch.Tensor) else torch.from_numpy(np.ascontiguousarray(X))
+    return X.to(device=device, dtype=torch.float32)
+
+def _prepare(X, metric, device=None):
+    X = _to_torch(X, device)
+    if metric == 'cosine':
+        return X / X.norm(dim=1, keepdim=True).clamp_min(torch.finfo(X.dtype).tiny)
+    elif metric == 'euclidean':
+        return X
+    raise ValueError(f"Unknown metric: {metric}")
+
+def _pairwise_scores(Q, X, metric, X_sq_norms=None):
+    # larger is closer: cosine similarity of normalized rows, or -||q - x||^2
+    if metric == 'cosine':
+        return Q @ X.T
+    X_sq_norms = (X**2).sum(dim=1) if X_sq_norms is None else X_sq_norms
+    return 2 * Q @ X.T - X_sq_norms[None, :] - (Q**2).sum(dim=1, keepdim=True)
+
+def _merge_topk(best_scores, best_inds, scores, inds, k):
+    scores = torch.cat([best_scores, scores], dim=1)
+    inds = torch.cat([best_inds, inds], dim=1)
+    top = torch.topk(scores, min(k, scores.shape[1]), dim=1)
+    return top.values, torch.gather(inds, 1, top.indices)
+
+def W_dec_hash(W):
+    W = np.ascontiguousarray(W.detach().cpu().numpy() if isinstance(W, torch.Tensor) else W)
+    return hashlib.sha1(W.view(np.uint8)).hexdigest()[:16] + f'_{W.shape[0]}x{W.shape[1]}'
+
+class ExactIndex:
+    def __init__(self, W, metric='cosine', block_size=4096, device=None):
+        self.metric = metric
+        self.block_size = block_size
+        self.device = device
+        self.X = _prepare(W, metric, device)
+        self.X_sq_norms = (self.X**2).sum(dim=1)
+
+    def query(self, Q, k, query_ids=None):
+        """
+        query_ids: index row of each query if the queries are rows of the index; these rows are excluded from
+            their own results (as top_k_neighbors does by dropping the first neighbor)
+        """
+        Q = _prepare(Q, self.metric, self.device)
+        inds = torch.empty((Q.shape[0], k), dtype=torch.int64)
+        scores = torch.empty((Q.shape[0], k))
+        for b0 in range(0, Q.shape[0], self.block_size):
+            b1 = min(b0 + self.block_size, Q.shape[0])
+            sims = _pairwise_scores(Q[b0:b1], self.X, self.metric, self.X_sq_norms)
+            if query_ids is not None:
+                sims[torch.arange(b1 - b0), torch.as_tensor(query_ids[b0:b1], device=sims.device)] = -torch.inf
+            top = torch.topk(sims, k, dim=1)
+            inds[b0:b1], scores[b0:b1] = top.indices.cpu(), top.values.cpu()
+        return inds.numpy(), scores.numpy()
+
+class IVFIndex:
+    def __init__(self, W, metric='cosine', num_lists=None, num_probes=8, num_iters=10, train_size=None, seed=0,
+                 device=None, centroids=None, list_order=None, list_starts=None):
+        self.metric = metric
+        self.num_probes = num_probes
+        self.device = device
+        self.X = _prepare(W, metric, device)
+        self.X_sq_norms = (self.X**2).sum(dim=1)
+        N = self.X.shape[0]
+
+        if centroids is None:
+            num_lists = num_lists or max(1, int(np.sqrt(N)))
+            centroids = self._kmeans(num_lists, num_iters, train_size or min(N, 64 * num_lists), seed)
+            assignment = self._nearest_centroid(self.X, centroids)
+            list_order = torch.argsort(assignment, stable=True)
+            list_starts = torch.searchsorted(assignment[list_order], torch.arange(len(centroids) + 1, device=assignment.device))
+        # {(k, num_probes, query set): recall@k}, see report_recall
+        self.recalls = {}
+        self.centroids = _to_torch(centroids, device)
+        self.list_order = torch.as_tensor(list_order, device=device)
+        self.list_starts = torch.as_tensor(list_starts, device=device)
+
+    def _nearest_centroid(self, X, centroids, block_size=65536):
+        return torch.cat([torch.argmax(_pairwise_scores(X[b0:b0 + block_size], centroids, self.metric), dim=1)
+                          for b0 in range(0, X.shape[0], block_size)])
+
+    def _kmeans(self, num_lists, num_iters, train_size, seed):
+        gen = torch.Generator().manual_seed(seed)
+        train = self.X[torch.randperm(self.X.shape[0], generator=gen)[:train_size].to(self.X.device)]
+        centroids = train[torch.randperm(train.shape[0], generator=gen)[:num_lists].to(self.X.device)].clone()
+        for _ in range(num_iters):
+            assignment = self._nearest_centroid(train, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, train)
+            counts = torch.bincount(assignment, minlength=len(centroids)).unsqueeze(1)
+            # empty lists keep their old centroid
+            centroids = torch.where(counts > 0, sums / counts.clamp_min(1), centroids)
+            if self.metric == 'cosine':
+                centroids = centroids / centroids.norm(dim=1, keepdim=True).clamp_min(torch.finfo(centroids.dtype).tiny)
+        return centroids
+
+    def query(self, Q, k, query_ids=None):
+        """
+        Scores each query against the rows of its num_probes closest lists. Loops over lists rather than queries:
+        all queries probing a list are scored against it in one matmul and merged into their running top-k.
+        query_ids: as in ExactIndex.query
+        """
+        Q = _prepare(Q, self.metric, self.device)
+        num_q = Q.shape[0]
+        probes = torch.topk(_pairwise_scores(Q, self.centroids, self.metric),
+                            min(self.num_probes, len(self.centroids)), dim=1).indices
+        best_scores = torch.full((num_q, k), -torch.inf, device=Q.device)
+        best_inds = torch.full((num_q, k), -1, dtype=torch.int64, device=Q.device)
+        query_ids = None if query_ids is None else torch.as_tensor(query_ids, device=Q.device)
+
+        for list_id in torch.unique(probes).tolist():
+            q_inds = torch.nonzero((probes == list_id).any(dim=1)).squeeze(1)
+            members = self.list_order[self.list_starts[list_id]:self.list_starts[list_id + 1]]
+            if len(members) == 0:
+                continue
+            sims = _pairwise_scores(Q[q_inds], self.X[members], self.metric, self.X_sq_norms[members])
+            if query_ids is not None:
+                sims = sims.masked_fill(query_ids[q_inds, None] == members[None, :], -torch.inf)
+            best_scores[q_inds], best_inds[q_inds] = _merge_topk(
+                best_scores[q_inds], best_inds[q_inds], sims, members.expand(len(q_inds), -1), k)
+        return best_inds.cpu().numpy(), best_scores.cpu().numpy()
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids.cpu().numpy(), list_order=self.list_order.cpu().numpy(),
+                 list_starts=self.list_starts.cpu().numpy(), metric=self.metric)
+
+    @classmethod
+    def load(cls, path, W, num_probes=8, device=None):
+        saved = np.load(path)
+        return cls(W, metric=str(saved['metric']), num_probes=num_probes, device=device, centroids=saved['centroids'],
+                   list_order=saved['list_order'], list_starts=saved['list_starts'])
+
+def recall_at_k(approx_inds, exact_inds):
+    # mean fraction of each query's exact k neighbors that the approximate search found
+    k = exact_inds.shape[1]
+    found = (approx_inds[:, :, None] == exact_inds[:, None, :]).any(axis=1)
+    return float(found.sum() / (len(exact_inds) * k))
+
+def evaluate_recall(index, W, k=10, num_queries=1000, seed=0, Q=None):
+    # recall@k of index against ExactIndex on up to num_queries sampled queries: rows of Q, or else rows of W
+    # (excluding themselves)
+    self_query = Q is None
+    Q = W if self_query else Q
+    sample = np.random.default_rng(seed).choice(len(Q), size=min(num_queries, len(Q)), replace=False)
+    query_ids = sample if self_query else None
+    exact_inds, _ = ExactIndex(W, metric=index.metric, device=index.device).query(Q[sample], k, query_ids)
+    approx_inds, _ = index.query(Q[sample], k, query_ids)
+    return recall_at_k(approx_inds, exact_inds)
+
+def report_recall(index, W, k, Q=None):
+    # evaluate_recall of an IVFIndex over W, computed and printed once per k, num_probes and query set (Q, or W itself)
+    if not isinstance(index, IVFIndex):
+        return 1.0
+    key = (k, index.num_probes, None if Q is None else W_dec_hash(Q))
+    if key not in index.recalls:
+        index.recalls[key] = evaluate_recall(index, W, k, Q=Q)
+        print(f"ivf recall@{k}: {index.recalls[key]:.3f} ({min(index.num_probes, len(index.centroids))} of "
+              f"{len(index.centroids)} lists probed)")
+    return index.recalls[key]
+
+def ann_index_path(W, metric='cosine', num_lists=None, cache_dir='.'):
+    return os.path.join(cache_dir, f'ivf_{W_dec_hash(W)}_{metric}_{num_lists or "auto"}.npz')
+
+def get_ann_index(W, kind='ivf', metric='cosine', cache_dir=None, num_lists=None, num_probes=8, device=None):
+    '''
+    Returns the index over the rows of W (a W_dec), building it once per W_dec and process.
+    kind: 'exact' or 'ivf'
+    cache_dir: if given, an 'ivf' index's lists are persisted there (e.g. next to the saved SAE activations), so
+        later runs only load them
+    '''
+    if kind == 'exact':
+        key = ('exact', W_dec_hash(W), metric)
+        if key not in _ann_indexes:
+            _ann_indexes[key] = ExactIndex(W, metric=metric, device=device)
+        return _ann_indexes[key]
+    elif kind != 'ivf':
+        raise ValueError(f"Unknown index kind: {kind}")
+
+    path = ann_index_path(W, metric, num_lists, cache_dir) if cache_dir is not None else None
+    key = path or ('ivf', W_dec_hash(W), metric, num_lists)
+    if key in _ann_indexes:
+        _ann_indexes[key].num_probes = num_probes
+        return _ann_indexes[key]
+
+    if path is not None and os.path.exists(path):
+        index = IVFIndex.load(path, W, num_probes=num_probes, device=device)
+    else:
+        index = IVFIndex(W, metric=metric, num_lists=num_lists, num_probes=num_probes, device=device)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            index.save(path)
+    _ann_indexes[key] = index
+    return index
@@ -0,0 +1,62 @@
+"""
+Batched similarity scores for many (X_i, Y_i) matrix pairs, e.g. all layer pairs of a grid, random baselines or
+concept subsets, instead of one svcca(...) call per pair.
+
+Pairs are grouped by their number of rows N. Within a group, the feature dims are zero padded to the largest D and D'
+of the group: this does not change SVCCA (zero-variance directions are never in the top-k PCA), CKA or the orthogonal
+Procrustes distance (zero padding is what it does for D != D' anyway). Each group is scored in chunks of batch_size
+pairs with the batched torch functions from sim_fns, and the chunks run in a thread pool (torch.linalg releases the
+GIL), so small-matrix LAPACK calls and per-pair Python overhead are amortized.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from sim_fns import cka_torch, orthogonal_procrustes_torch, svcca_torch
+
+batched_metric_fns = {
+    'svcca': svcca_torch,
+    'cka': cka_torch,
+    'procrustes': orthogonal_procrustes_torch,
+}
+
+def group_pairs_by_rows(pairs, batch_size):
+    # lists of pair indices with the same number of rows, at most batch_size each
+    groups = defaultdict(list)
+    for pair_ind, (X, Y) in enumerate(pairs):
+        assert X.shape[0] == Y.shape[0], f"pair {pair_ind}: X and Y need the same number of rows"
+        groups[X.shape[0]].append(pair_ind)
+    return [inds[i:i + batch_size] for inds in groups.values() for i in range(0, len(inds), batch_size)]
+
+def stack_padded(mats, dtype=torch.float32, device=None):
+    # (len(mats), N, max D) with zero padded columns
+    max_cols = max(mat.shape[1] for mat in mats)
+    stacked = torch.zeros((len(mats), mats[0].shape[0], max_cols), dtype=dtype, device=device)
+    for i, mat in enumerate(mats):
+        mat = mat if isinstance(mat, torch.Tensor) else torch.from_numpy(np.asarray(mat))
+        stacked[i, :, :mat.shape[1]] = mat.to(device=device, dtype=dtype)
+    return stacked
+
+def score_pairs(pairs, metrics=('svcca',), batch_size=32, num_workers=4, dtype=torch.float32, device=None):
+    """
+    pairs: list of (X, Y) numpy arrays / tensors, X (N_i, D_i) and Y (N_i, D'_i); rows are the paired datapoints
+        (e.g. matched decoder rows), as for svcca(X, Y, "nd")
+    metrics: keys of batched_metric_fns
+    Returns {metric: np.array of len(pairs)} in the order of pairs.
+    """
+    scores = {metric: np.full(len(pairs), np.nan) for metric in metrics}
+
+    def score_batch(pair_inds):
+        X = stack_padded([pairs[i][0] for i in pair_inds], dtype=dtype, device=device)
+        Y = stack_padded([pairs[i][1] for i in pair_inds], dtype=dtype, device=device)
+        return pair_inds, {metric: batched_metric_fns[metric](X, Y, dtype=dtype, device=device).cpu().numpy()
+                           for metric in metrics}
+
+    batches = group_pairs_by_rows(pairs, batch_size)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for pair_inds, batch_scores in pool.map(score_batch, batches):
+            for metric, vals in batch_scores.items():
+                scores[metric][pair_inds] = vals
+    return scores
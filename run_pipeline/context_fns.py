@@ -0,0 +1,93 @@
+"""
+Context windows around feature examples, for many features at once. display_top_sequences decodes the +-5 tokens
+around each example one token at a time; here all windows are gathered with a single fancy index into the token
+tensor and decoded with one index into the (escaped) vocab table.
+
+export_feature_examples writes the top examples of matched feature pairs as JSONL, one pair per line, plus a
+`.idx.npy` array of line byte offsets, so FeatureExamplesReader can load any pair without reading the whole file.
+"""
+import json
+
+import numpy as np
+import torch
+
+# cached escaped vocab strings per VocabTable, with '' appended so that token ID -1 (outside the doc) decodes to ''
+_escaped_vocabs = {}
+
+def escaped_vocab(vocab):
+    key = id(vocab)
+    if key not in _escaped_vocabs:
+        strs = [tok_str.replace("\n", "\\n").replace("<|BOS|>", "|BOS|") for tok_str in vocab.id_to_str]
+        _escaped_vocabs[key] = np.array(strs + [''], dtype=object)
+    return _escaped_vocabs[key]
+
+def context_windows(batch_tokens, docs, pos, left=5, right=5):
+    """
+    (n, left + right) token IDs of the windows [pos - left, pos + right) of each (doc, pos) example, as
+    display_top_sequences shows them; positions outside the doc are -1.
+    """
+    batch_tokens = batch_tokens.cpu() if isinstance(batch_tokens, torch.Tensor) else torch.as_tensor(batch_tokens)
+    docs, pos = torch.as_tensor(docs).long().reshape(-1), torch.as_tensor(pos).long().reshape(-1)
+    cols = pos[:, None] + torch.arange(-left, right)[None, :]
+    inside = (cols >= 0) & (cols < batch_tokens.shape[1])
+    window_ids = batch_tokens[docs[:, None].clamp_min(0), cols.clamp(0, batch_tokens.shape[1] - 1)]
+    return torch.where(inside & (docs[:, None] >= 0), window_ids, -1)
+
+def render_windows(window_ids, vocab, center=5, highlight=('[[', ']]')):
+    """
+    Strings of the windows from context_windows, with the token at column center wrapped in highlight
+    (e.g. ("[bold u dark_orange]", "[/]") for rich).
+    Returns (texts, center tokens).
+    """
+    decoded = escaped_vocab(vocab)[np.asarray(window_ids)]
+    center_toks = decoded[:, center].copy()
+    if highlight is not None:
+        decoded[:, center] = [f'{highlight[0]}{tok}{highlight[1]}' for tok in center_toks]
+    return [''.join(row) for row in decoded], center_toks.tolist()
+
+def feature_examples(top_acts_index, feats, batch_tokens, vocab, k=5, left=5, right=5, highlight=('[[', ']]')):
+    # per feature in feats: list of its top k examples as {doc, pos, act, token, text}; empty index slots are left out
+    feats = torch.as_tensor(np.asarray(feats)).long()
+    docs, pos = top_acts_index.docs[feats, :k], top_acts_index.pos[feats, :k]
+    acts = top_acts_index.values[feats, :k]
+    texts, toks = render_windows(context_windows(batch_tokens, docs, pos, left, right), vocab, left, highlight)
+    flat = [{'doc': int(d), 'pos': int(p), 'act': round(float(a), 4), 'token': tok, 'text': text}
+            for d, p, a, tok, text in zip(docs.reshape(-1).tolist(), pos.reshape(-1).tolist(),
+                                          acts.reshape(-1).tolist(), toks, texts)]
+    return [[example for example in flat[i * docs.shape[1]:(i + 1) * docs.shape[1]] if example['doc'] >= 0]
+            for i in range(len(feats))]
+
+def export_feature_examples(path, pair_ind_A, pair_ind_B, pair_vals, top_acts_index_A, top_acts_index_B,
+                            batch_tokens, vocab, k=5, left=5, right=5):
+    """
+    Writes one JSON line per matched pair: {pair, feat_A, feat_B, corr, A: [examples], B: [examples]} (examples as in
+    feature_examples), and the byte offset of every line to path + '.idx.npy'.
+    """
+    examples_A = feature_examples(top_acts_index_A, pair_ind_A, batch_tokens, vocab, k, left, right)
+    examples_B = feature_examples(top_acts_index_B, pair_ind_B, batch_tokens, vocab, k, left, right)
+
+    offsets = []
+    with open(path, 'wb') as f:
+        for i, (feat_A, feat_B, corr) in enumerate(zip(np.asarray(pair_ind_A).tolist(), np.asarray(pair_ind_B).tolist(),
+                                                      np.asarray(pair_vals, dtype=np.float64).tolist())):
+            offsets.append(f.tell())
+            line = {'pair': i, 'feat_A': feat_A, 'feat_B': feat_B, 'corr': corr, 'A': examples_A[i], 'B': examples_B[i]}
+            f.write(json.dumps(line, ensure_ascii=False).encode('utf-8') + b'\n')
+    np.save(path + '.idx.npy', np.asarray(offsets, dtype=np.int64))
+
+class FeatureExamplesReader:
+    # lazy random access to an export_feature_examples file: reader[i] reads only line i
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(path + '.idx.npy')
+        self._file = open(path, 'rb')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        self._file.seek(int(self.offsets[i]))
+        return json.loads(self._file.readline())
+
+    def close(self):
+        self._file.close()
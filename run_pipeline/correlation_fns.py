@@ -58,3 +58,36 @@ def batched_correlation(reshaped_activations_A, reshaped_activations_B, batch_si
 
     # return torch.cat(max_indices), torch.cat(max_values)
     return torch.cat(max_indices).cpu().numpy(), torch.cat(max_values).cpu().numpy()
+
+
+def batched_correlation_topk(reshaped_activations_A, reshaped_activations_B, k=10, batch_size=8):
+    """
+    Same as batched_correlation, but keeps the k most correlated A feats for every B feat instead of only the max,
+    so 1-1 assignment can run on a sparse candidate graph without the dense corr matrix ever existing.
+    Returns (topk_inds, topk_vals), both (num B feats, k), sorted by decreasing corr.
+    """
+    normalized_A = normalize_byChunks(reshaped_activations_A, chunk_size=10000)
+    normalized_B = normalize_byChunks(reshaped_activations_B, chunk_size=10000)
+
+    if torch.cuda.is_available():
+        normalized_A = normalized_A.to('cuda')
+        normalized_B = normalized_B.to('cuda')
+
+    k = min(k, normalized_A.shape[1])
+    num_batches = (normalized_B.shape[1] + batch_size - 1) // batch_size
+    topk_values = []
+    topk_indices = []
+
+    for batch in range(num_batches):
+        start = batch * batch_size
+        end = min(start + batch_size, normalized_B.shape[1])
+
+        batch_corr_matrix = torch.matmul(normalized_A.t(), normalized_B[:, start:end]) / normalized_A.shape[0]
+        top_val, top_idx = batch_corr_matrix.topk(k, dim=0)
+        topk_values.append(top_val.t())
+        topk_indices.append(top_idx.t())
+
+        del batch_corr_matrix
+        torch.cuda.empty_cache()
+
+    return torch.cat(topk_indices).cpu().numpy(), torch.cat(topk_values).cpu().numpy()
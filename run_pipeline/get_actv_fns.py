@@ -10,8 +10,10 @@ from sparsify import Sae
 # Also support alternate SAE loading via sae_lens.
 from sae_lens import SAE
 
+from topk_index_fns import TopActivationsIndex, tokens_hash
+
 def get_sae_actvs(model=None, model_name=None, sae_name=None, inputs=None, layer_id=None, batch_size=32, 
-                  sae_lib='eleuther', compare_MLPs_bool=False):
+                  sae_lib='eleuther', compare_MLPs_bool=False, top_index_k=None, top_index_path=None, LLM_actvs=None):
     """
     Process the SAE activations in batches to avoid OOM errors.
     
@@ -23,6 +25,11 @@ def get_sae_actvs(model=None, model_name=None, sae_name=None, inputs=None, layer
         batch_size (int): The number of samples per batch.
         sae_lib (str): Which library to use ('eleuther' or 'sae_lens').
         custom_hookpoint (str, optional): If provided, overrides the default hookpoint.
+        top_index_k (int, optional): If provided, a TopActivationsIndex of each feature's top_index_k activations is
+            built from the batches as they are encoded, and saved to top_index_path.
+        LLM_actvs (torch.Tensor, optional): The model's layer_id activations (residual stream, or MLP output with
+            compare_MLPs_bool) if already computed, e.g. once for all SAEs of the same model layer; model is then
+            not run.
     
     Returns:
         weight_matrix_np (numpy.ndarray): The decoder weights.
@@ -32,11 +39,10 @@ def get_sae_actvs(model=None, model_name=None, sae_name=None, inputs=None, layer
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(device)
     ### Get LLM Residual Stream activations ###
-    if compare_MLPs_bool:
+    if LLM_actvs is None and compare_MLPs_bool:
         # _, _, LLM_actvs = get_LLM_MLP_actvs(model, model_name, layer_id, inputs)
         _, _, LLM_actvs = get_LLM_MLP_actvs(model, model_name, layer_id, inputs, batch_size)
-    else:
-        LLM_actvs = None
+    elif LLM_actvs is None:
         dataset = TensorDataset(inputs['input_ids'], inputs['attention_mask'])
         loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
 
@@ -92,6 +98,9 @@ def get_sae_actvs(model=None, model_name=None, sae_name=None, inputs=None, layer
     
     pre_act_batches = []
     num_samples = LLM_actvs.size(0)
+    top_index = None
+    if top_index_k:
+        top_index = TopActivationsIndex(weight_matrix_np.shape[0], top_index_k, inputs_hash=tokens_hash(inputs['input_ids']))
     for start in range(0, num_samples, batch_size):
         end = start + batch_size
         LLM_actvs_batch = LLM_actvs[start:end].to(device)
@@ -101,6 +110,8 @@ def get_sae_actvs(model=None, model_name=None, sae_name=None, inputs=None, layer
             elif sae_lib == 'sae_lens':                
                 batch_pre_acts = sae.encode(LLM_actvs_batch)
         pre_act_batches.append(batch_pre_acts.cpu())
+        if top_index is not None:
+            top_index.update(batch_pre_acts, doc_offset=start)
         
         del LLM_actvs_batch, batch_pre_acts
         torch.cuda.empty_cache()
@@ -110,6 +121,9 @@ def get_sae_actvs(model=None, model_name=None, sae_name=None, inputs=None, layer
     torch.cuda.empty_cache()
     gc.collect()
 
+    if top_index is not None and top_index_path is not None:
+        top_index.save(top_index_path)
+
     orig_actvs = torch.cat(pre_act_batches, dim=0)
     first_dim_reshaped  = orig_actvs.shape[0] * orig_actvs.shape[1]
     reshaped_activations = orig_actvs.reshape(first_dim_reshaped , orig_actvs.shape[-1]).cpu()
@@ -1,34 +1,306 @@
 import numpy as np
-def score_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool):
-    all_rand_scores = []
-    i = 0
-    # for i in range(num_runs):
-    while i < num_runs:
-        try:
-            rand_modA_feats = np.random.choice(range(weight_matrix_np.shape[0]), size=num_feats, replace=False).tolist()
-            rand_modB_feats = np.random.choice(range(weight_matrix_2.shape[0]), size=num_feats, replace=False).tolist()
+import torch
+from scipy.stats import beta
+
+from sim_fns import (centered_kernel_alignment, cka_permutation_scores, cka_torch, jaccard_permutation_scores,
+                     jaccard_similarity, orthogonal_procrustes, orthogonal_procrustes_permutation_scores,
+                     orthogonal_procrustes_torch, permutation_procrustes, permutation_procrustes_permutation_scores,
+                     representational_similarity_analysis, rsa_permutation_scores, svcca, svcca_permutation_scores,
+                     svcca_torch)
+from null_cache_fns import cached_null_scores
+
+# sim_fns with a batched torch version: a batch of random subsets is scored as one (batch, num_feats, D) stack
+subset_batch_fns = {
+    svcca: svcca_torch,
+    centered_kernel_alignment: cka_torch,
+    orthogonal_procrustes: orthogonal_procrustes_torch,
+}
+# batch_fn kwargs for float64 batches: the scatter matrices need no ridge term there, so the null is scored with the
+# same (unregularized) CCA as the svcca paired score
+float64_batch_kwargs = {
+    svcca_torch: {'reg': 0.0},
+}
+
+def run_seed_seqs(seed, first_run, num_runs):
+    # run i's seed stream, the same as SeedSequence(seed).spawn(n)[i] for any n > i
+    return [np.random.SeedSequence(seed, spawn_key=(run,)) for run in range(first_run, first_run + num_runs)]
+
+def draw_rand_subsets(num_runs, num_rows_1, num_rows_2, num_feats, seed=0, first_run=0):
+    # (num_runs, num_feats) row indices into each weight matrix, for runs first_run, ..., drawn upfront
+    inds_1, inds_2 = [], []
+    for seed_seq in run_seed_seqs(seed, first_run, num_runs):
+        rng = np.random.default_rng(seed_seq)
+        inds_1.append(rng.choice(num_rows_1, size=num_feats, replace=False))
+        inds_2.append(rng.choice(num_rows_2, size=num_feats, replace=False))
+    return np.array(inds_1).reshape(num_runs, num_feats), np.array(inds_2).reshape(num_runs, num_feats)
+
+class NullDistribution:
+    """
+    Scores of the random-subset runs so far. failures has (run index, error message) of every run whose score raised
+    (e.g. the svcca "input must be number of neurons by datapoints" assert) or was not finite (e.g. a degenerate CCA),
+    instead of silently redrawing it; these runs are not in scores.
+    pval: fraction of scores >= observed, as run_expm computes svcca_rand_pval
+    """
+    def __init__(self, num_runs, observed=None):
+        self.num_runs = num_runs
+        self.observed = observed
+        self.scores = []
+        self.failures = []
+        # set by sequential_pval
+        self.seq_pval = np.nan
+        self.stop_reason = None
+
+    @property
+    def num_done(self):
+        return len(self.scores) + len(self.failures)
+
+    @property
+    def mean(self):
+        return float(np.mean(self.scores)) if self.scores else np.nan
+
+    @property
+    def num_exceed(self):
+        return int(np.sum(np.asarray(self.scores) >= self.observed))
+
+    @property
+    def pval(self):
+        return self.num_exceed / len(self.scores) if self.scores and self.observed is not None else np.nan
 
+def iter_null_scores(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, observed=None,
+                     seed=0, max_batch_elems=2**26, max_batch_runs=None, dtype=torch.float64, device=None,
+                     first_run=0):
+    """
+    Yields the NullDistribution after every batch of runs, so callers can watch the running mean / pval and stop
+    early by breaking out of the loop. All subsets are drawn upfront with draw_rand_subsets(seed, first_run). For sim_fns in
+    subset_batch_fns, the subsets are scored in batches of at most max_batch_elems gathered entries; other sim_fns
+    (and any batch that raises) are scored one subset at a time.
+    """
+    inds_1, inds_2 = draw_rand_subsets(num_runs, weight_matrix_np.shape[0], weight_matrix_2.shape[0], num_feats, seed,
+                                       first_run)
+    null = NullDistribution(num_runs, observed)
+    batch_fn = subset_batch_fns.get(sim_fn) if shapereq_bool else None
+    batch_kwargs = float64_batch_kwargs.get(batch_fn, {}) if dtype == torch.float64 else {}
+    batch_size = max(1, max_batch_elems // (num_feats * (weight_matrix_np.shape[1] + weight_matrix_2.shape[1])))
+    batch_size = min(batch_size, max_batch_runs or batch_size)
+
+    def add_score(run, score):
+        if np.isfinite(score):
+            null.scores.append(score)
+        else:
+            null.failures.append((first_run + run, f'non-finite score {score}'))
+
+    def score_one(run):
+        try:
             if shapereq_bool:
-                score = sim_fn(weight_matrix_np[rand_modA_feats], weight_matrix_2[rand_modB_feats], "nd")
+                score = sim_fn(weight_matrix_np[inds_1[run]], weight_matrix_2[inds_2[run]], "nd")
             else:
-                score = sim_fn(weight_matrix_np[rand_modA_feats], weight_matrix_2[rand_modB_feats])
-            all_rand_scores.append(score)
-            i += 1
-        except:
-            continue
-    # return sum(all_rand_scores) / len(all_rand_scores)
-    return all_rand_scores
+                score = sim_fn(weight_matrix_np[inds_1[run]], weight_matrix_2[inds_2[run]])
+        except Exception as e:
+            null.failures.append((first_run + run, repr(e)))
+            return
+        add_score(run, float(score))
+
+    for b0 in range(0, num_runs, batch_size if batch_fn is not None else 1):
+        runs = range(b0, min(b0 + batch_size, num_runs)) if batch_fn is not None else [b0]
+        if batch_fn is not None:
+            try:
+                batch_scores = batch_fn(weight_matrix_np[inds_1[runs]], weight_matrix_2[inds_2[runs]],
+                                        dtype=dtype, device=device, **batch_kwargs).cpu().tolist()
+            except Exception:
+                for run in runs:
+                    score_one(run)
+            else:
+                for run, score in zip(runs, batch_scores):
+                    add_score(run, score)
+        else:
+            score_one(b0)
+        yield null
+
+def null_distribution(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, observed=None,
+                      seed=0, **kwargs):
+    # the NullDistribution after all runs, see iter_null_scores
+    null = NullDistribution(num_runs, observed)
+    for null in iter_null_scores(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool,
+                                 observed=observed, seed=seed, **kwargs):
+        pass
+    print(f"null mean {null.mean:.4g} over {len(null.scores)} / {num_runs} random subsets, "
+          f"{len(null.failures)} failed or non-finite")
+    if null.failures:
+        print(f"first failure: {null.failures[0]}")
+    return null
+
+def score_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, seed=0, cache_dir=None):
+    """
+    scores of num_runs random feature subsets (failed runs are reported by null_distribution and left out)
+    cache_dir: if given, the scores are read from / added to the null_cache_fns cache there
+    """
+    if cache_dir is None:
+        return null_distribution(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool,
+                                 seed=seed).scores
+
+    def score_runs(first_run, num_new_runs):
+        null = null_distribution(num_new_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool,
+                                 seed=seed, first_run=first_run)
+        # scores are in run order, with the failed runs left out
+        run_scores = np.full(num_new_runs, np.nan)
+        failed = np.zeros(num_new_runs, dtype=bool)
+        failed[[run - first_run for run, _ in null.failures]] = True
+        run_scores[~failed] = null.scores
+        return run_scores
+
+    scores = cached_null_scores('subset', num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, seed,
+                                cache_dir, score_runs)
+    num_failed = int(np.isnan(scores).sum())
+    print(f"null mean {np.nanmean(scores) if num_failed < len(scores) else np.nan:.4g} over "
+          f"{len(scores) - num_failed} / {num_runs} random subsets, {num_failed} failed or non-finite")
+    return scores[~np.isnan(scores)].tolist()
 
 import random
-def shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool):
-    all_rand_scores = []
-    for i in range(num_runs):
-        row_idxs = list(range(num_feats))
-        random.shuffle(row_idxs)
+permutation_score_fns = {
+    svcca: svcca_permutation_scores,
+    representational_similarity_analysis: rsa_permutation_scores,
+    centered_kernel_alignment: cka_permutation_scores,
+    jaccard_similarity: jaccard_permutation_scores,
+    orthogonal_procrustes: orthogonal_procrustes_permutation_scores,
+    permutation_procrustes: permutation_procrustes_permutation_scores,
+}
+
+def iter_shuffle_scores(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool,
+                        observed=None, first_batch=None):
+    """
+    Yields the NullDistribution of the shuffled-row scores after every batch of runs (same random.shuffle draws, in the
+    same order, as running them all at once). Batches start at first_batch runs (default: all num_runs) and double,
+    since the permutation_score_fns redo their SVDs / RSMs / covariances once per call.
+    """
+    null = NullDistribution(num_runs, observed)
+    batch_size = first_batch or num_runs
+    while null.num_done < num_runs:
+        perms = []
+        for i in range(min(batch_size, num_runs - null.num_done)):
+            row_idxs = list(range(num_feats))
+            random.shuffle(row_idxs)
+            perms.append(row_idxs)
+
+        if sim_fn in permutation_score_fns:
+            # same permutations, but the SVDs / RSMs / covariances / neighbor lists are computed once for all runs
+            null.scores.extend(permutation_score_fns[sim_fn](weight_matrix_np, weight_matrix_2, perms))
+        else:
+            for row_idxs in perms:
+                if shapereq_bool:
+                    score = sim_fn(weight_matrix_np, weight_matrix_2[row_idxs], "nd")
+                else:
+                    score = sim_fn(weight_matrix_np, weight_matrix_2[row_idxs])
+                null.scores.append(score)
+        batch_size *= 2
+        yield null
+
+def seeded_shuffle_perms(seed_seqs, num_feats):
+    return [np.random.default_rng(seed_seq).permutation(num_feats).tolist() for seed_seq in seed_seqs]
+
+def score_perms(weight_matrix_np, weight_matrix_2, perms, sim_fn, shapereq_bool):
+    if sim_fn in permutation_score_fns:
+        return list(permutation_score_fns[sim_fn](weight_matrix_np, weight_matrix_2, perms))
+    scores = []
+    for row_idxs in perms:
         if shapereq_bool:
-            score = sim_fn(weight_matrix_np, weight_matrix_2[row_idxs], "nd")
+            scores.append(sim_fn(weight_matrix_np, weight_matrix_2[row_idxs], "nd"))
         else:
-            score = sim_fn(weight_matrix_np, weight_matrix_2[row_idxs])
-        all_rand_scores.append(score)
-    # return sum(all_rand_scores) / len(all_rand_scores)
-    return all_rand_scores
\ No newline at end of file
+            scores.append(sim_fn(weight_matrix_np, weight_matrix_2[row_idxs]))
+    return scores
+
+def shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, cache_dir=None,
+                 seed=0, num_workers=None):
+    """
+    cache_dir: if given, the scores are read from / added to the null_cache_fns cache there. The runs are then
+        shuffled with the per-run seed streams of run_seed_seqs(seed) instead of the `random` module, so a cached
+        null can be extended with more runs
+    num_workers: if given, the runs are shuffled with the same per-run seed streams and scored on a pool of num_workers
+        processes by parallel_rand_fns.parallel_shuffle_rand (the scores do not depend on num_workers)
+    """
+    if num_workers is not None:
+        # imported here: parallel_rand_fns imports this module
+        from parallel_rand_fns import parallel_shuffle_rand
+
+    if num_workers is not None and cache_dir is None:
+        return parallel_shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool,
+                                     seed=seed, num_workers=num_workers)
+
+    if cache_dir is not None:
+        def score_runs(first_run, num_new_runs):
+            if num_workers is not None:
+                return parallel_shuffle_rand(num_new_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn,
+                                             shapereq_bool, seed=seed, num_workers=num_workers, first_run=first_run)
+            perms = seeded_shuffle_perms(run_seed_seqs(seed, first_run, num_new_runs), num_feats)
+            return score_perms(weight_matrix_np, weight_matrix_2, perms, sim_fn, shapereq_bool)
+
+        return cached_null_scores('shuffle', num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, seed,
+                                  cache_dir, score_runs).tolist()
+
+    for null in iter_shuffle_scores(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool):
+        pass
+    return null.scores
+
+def clopper_pearson(num_exceed, num_runs, confidence=0.99):
+    # exact binomial confidence interval of the exceedance probability
+    tail = (1 - confidence) / 2
+    lo = beta.ppf(tail, num_exceed, num_runs - num_exceed + 1) if num_exceed > 0 else 0.0
+    hi = beta.ppf(1 - tail, num_exceed + 1, num_runs - num_exceed) if num_exceed < num_runs else 1.0
+    return lo, hi
+
+def sequential_pval(null_iter, alpha=0.05, h=10, confidence=0.99, max_ci_width=None):
+    """
+    Sequential Monte Carlo p-value over a stream of NullDistributions (iter_shuffle_scores / iter_null_scores, with
+    observed set), stopping as soon as one of these holds (checked after every batch):
+        'besag_clifford': h null scores >= observed: seq_pval = num_exceed / n (Besag & Clifford, 1991), i.e. the
+            p-value is clearly large, and it only takes ~h / p runs to see that
+        'decided': the Clopper-Pearson interval (at confidence) of the exceedance probability is entirely below or
+            above alpha, e.g. 0 exceedances in ~90 runs for alpha=0.05, confidence=0.99
+        'ci_width': that interval is narrower than max_ci_width (if given)
+        'max_runs': all runs done
+    Except for 'besag_clifford', seq_pval = (num_exceed + 1) / (n + 1), which is a valid p-value at any stopping time.
+    If no null score was seen (no runs, or every run failed), seq_pval is nan and stop_reason 'no_scores'.
+    Returns the last NullDistribution; null.num_done is the number of runs actually used.
+    """
+    null = NullDistribution(0)
+    n = num_exceed = 0
+    for null in null_iter:
+        n, num_exceed = len(null.scores), null.num_exceed
+        if n == 0:
+            continue
+        lo, hi = clopper_pearson(num_exceed, n, confidence)
+        if num_exceed >= h:
+            null.stop_reason = 'besag_clifford'
+        elif hi < alpha or lo > alpha:
+            null.stop_reason = 'decided'
+        elif max_ci_width is not None and hi - lo < max_ci_width:
+            null.stop_reason = 'ci_width'
+        elif null.num_done >= null.num_runs:
+            null.stop_reason = 'max_runs'
+        if null.stop_reason is not None:
+            break
+
+    if n == 0:
+        null.stop_reason = 'no_scores'
+        null.seq_pval = np.nan
+    elif null.stop_reason == 'besag_clifford':
+        null.seq_pval = num_exceed / n
+    else:
+        null.seq_pval = (num_exceed + 1) / (len(null.scores) + 1)
+    print(f"sequential pval: {null.seq_pval:.4g} after {null.num_done} / {null.num_runs} runs ({null.stop_reason}), "
+          f"null mean {null.mean:.4g}, {len(null.failures)} failed or non-finite")
+    return null
+
+def sequential_shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, observed,
+                            first_batch=10, **stop_kwargs):
+    # shuffle_rand with early stopping, see sequential_pval
+    return sequential_pval(iter_shuffle_scores(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn,
+                                               shapereq_bool, observed=observed, first_batch=first_batch),
+                           **stop_kwargs)
+
+def sequential_score_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, observed,
+                          seed=0, max_batch_runs=10, **stop_kwargs):
+    # score_rand with early stopping, see sequential_pval
+    return sequential_pval(iter_null_scores(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn,
+                                            shapereq_bool, observed=observed, seed=seed,
+                                            max_batch_runs=max_batch_runs),
+                           **stop_kwargs)
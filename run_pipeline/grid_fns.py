@@ -0,0 +1,267 @@
+"""
+The A x B layer sweep of run.py / run_LLMs.py as a graph of tasks, run on a process pool and checkpointed task by task.
+
+Task IDs and what they run (name: the SAE or model name of a side, layers: its layer IDs):
+    ('extract', name, layer)                        the (weight_matrix, reshaped_activations, feature_acts_model) of
+                                                    one layer, saved to work_dir. Runs in this process, since it needs
+                                                    the loaded model
+    ('correlate', name_A, layer_A, name_B, layer_B) run_expm_fns.correlate_pairs: pair counts, mean corrs, kept pairs
+    ('score', ...)                                  run_expm_fns.paired_scores of the kept pairs
+    ('baselines', ...)                              run_expm_fns.rand_baseline_scores of the kept pairs
+A task's args may hold Dep(task_id) placeholders; the task depends on those tasks and gets their results in their place.
+
+Every finished task appends one (task_id, result) record to a TaskLog, instead of re-pickling the whole
+model_layer_to_dictscores after every pair. run_tasks skips the tasks already in the log, so a killed sweep started
+again with the same log resumes at the tasks that had not finished. A record cut off by the kill is dropped on load.
+With a results_fns.ResultsStore, run_layer_grid also adds the scores of each finished task to it as rows.
+"""
+import multiprocessing as mp
+import os
+import pickle
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+
+import numpy as np
+import torch
+
+from results_fns import config_hash
+from run_expm_fns import correlate_pairs, paired_scores, rand_baseline_scores
+from topk_index_fns import get_top_acts_index
+
+# per worker process: the activations loaded last, {path: actvs}
+_worker_actvs = {}
+_worker_actvs_max = 2
+
+class Dep:
+    # placeholder for the result of task task_id in a Task's args / kwargs
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+    def __repr__(self):
+        return f'Dep({self.task_id!r})'
+
+class Task:
+    """
+    fn(*args, **kwargs), with every Dep in args / kwargs replaced by that task's result.
+    local: run in this process (e.g. tasks that use a loaded model), else on the pool, where fn and args must pickle
+    """
+    def __init__(self, task_id, fn, args=(), kwargs=None, local=False):
+        self.task_id = task_id
+        self.fn = fn
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.local = local
+        self.deps = [arg.task_id for arg in (*self.args, *self.kwargs.values()) if isinstance(arg, Dep)]
+
+    def resolved(self, results):
+        args = [results[arg.task_id] if isinstance(arg, Dep) else arg for arg in self.args]
+        kwargs = {key: results[val.task_id] if isinstance(val, Dep) else val for key, val in self.kwargs.items()}
+        return args, kwargs
+
+class TaskLog:
+    # append-only file of pickled (task_id, result) records, one pickle.dump per finished task
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        # {task_id: result} of every complete record; a truncated last record is cut off the file
+        results = {}
+        if not os.path.exists(self.path):
+            return results
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            while f.tell() < size:
+                start = f.tell()
+                try:
+                    task_id, result = pickle.load(f)
+                except Exception:
+                    print(f'task log: dropping a truncated record at byte {start} of {self.path}')
+                    f.close()
+                    os.truncate(self.path, start)
+                    break
+                results[task_id] = result
+        return results
+
+    def append(self, task_id, result):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'ab') as f:
+            pickle.dump((task_id, result), f)
+            f.flush()
+            os.fsync(f.fileno())
+
+def _init_worker(blas_threads):
+    torch.set_num_threads(blas_threads)
+
+def run_tasks(tasks, log_path, num_workers=1, blas_threads=1, on_done=None):
+    """
+    Runs every task of tasks not in the TaskLog at log_path once its deps are done, and returns {task_id: result} of
+    all tasks. Ready pool tasks are submitted before a ready local task runs, so the workers score pairs while this
+    process extracts the next layer.
+    num_workers: pool size; 0 runs every task in this process, in dependency order
+    on_done(task_id, result): called in this process for each task finished by this call, before it is logged (so a
+        kill in between only re-runs the task)
+    """
+    log = TaskLog(log_path)
+    results = log.load()
+    pending = {task.task_id: task for task in tasks if task.task_id not in results}
+    if len(results):
+        print(f'task log: {len(results)} tasks already done, {len(pending)} to run')
+
+    def finish(task_id, result):
+        results[task_id] = result
+        if on_done is not None:
+            on_done(task_id, result)
+        log.append(task_id, result)
+        print(f'done: {task_id}')
+
+    pool = None
+    if num_workers > 0 and any(not task.local for task in pending.values()):
+        pool = ProcessPoolExecutor(num_workers, mp_context=mp.get_context('spawn'), initializer=_init_worker,
+                                   initargs=(blas_threads,))
+    running = {}
+    try:
+        while pending or running:
+            ready = [task for task in pending.values() if all(dep in results for dep in task.deps)]
+            if not ready and not running:
+                raise ValueError(f'tasks with missing deps: {list(pending)}')
+            for task in ready:
+                if pool is not None and not task.local:
+                    del pending[task.task_id]
+                    args, kwargs = task.resolved(results)
+                    running[pool.submit(task.fn, *args, **kwargs)] = task.task_id
+
+            local_ready = [task for task in ready if task.task_id in pending]
+            if local_ready:
+                task = pending.pop(local_ready[0].task_id)
+                args, kwargs = task.resolved(results)
+                finish(task.task_id, task.fn(*args, **kwargs))
+            if running:
+                done, _ = wait(running, timeout=0 if local_ready else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), future.result())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+            # keep what the other workers finished before a failed task stopped the run
+            for future, task_id in running.items():
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    finish(task_id, future.result())
+    return results
+
+def grid_log_path(work_dir, name_A, name_B, config):
+    # one log per sweep config, so a run with other settings never picks up stale results
+    return os.path.join(work_dir, f'grid_{name_A.replace("/", "_")}_{name_B.replace("/", "_")}_{config_hash(config)}.pkl')
+
+### tasks ###
+
+def extract_task(extract_fn, path_prefix):
+    # saves extract_fn()'s weight matrix (.npy, read by score / baselines) and activations (.pt) and returns the paths
+    with torch.inference_mode():
+        weight_matrix, reshaped_activations, feature_acts_model = extract_fn()
+    paths = {'W': f'{path_prefix}_W.npy', 'actvs': f'{path_prefix}_actvs.pt'}
+    os.makedirs(os.path.dirname(path_prefix) or '.', exist_ok=True)
+    np.save(paths['W'], np.asarray(weight_matrix))
+    torch.save((reshaped_activations, feature_acts_model), paths['actvs'])
+    return paths
+
+def load_extracted(paths):
+    if paths['actvs'] not in _worker_actvs:
+        while len(_worker_actvs) >= _worker_actvs_max:
+            _worker_actvs.pop(next(iter(_worker_actvs)))
+        _worker_actvs[paths['actvs']] = torch.load(paths['actvs'])
+    return (np.load(paths['W']), *_worker_actvs[paths['actvs']])
+
+def correlate_task(extracted_A, extracted_B, inputs, tokenizer, vocab=None, top_index_paths=None, **corr_kwargs):
+    top_acts_indexes = None
+    if top_index_paths is not None:
+        top_acts_indexes = tuple(get_top_acts_index(path, inputs['input_ids']) for path in top_index_paths)
+    return correlate_pairs(inputs, tokenizer, load_extracted(extracted_A), load_extracted(extracted_B), vocab=vocab,
+                           top_acts_indexes=top_acts_indexes, **corr_kwargs)
+
+def score_task(extracted_A, extracted_B, correlated, rsa_method=None):
+    _, inds_A, inds_B = correlated
+    return paired_scores(np.load(extracted_A['W']), np.load(extracted_B['W']), inds_A, inds_B, rsa_method)
+
+def baselines_task(extracted_A, extracted_B, correlated, paired, num_rand_runs=100, rsa_method=None,
+                   sequential_pval_bool=False, rand_num_workers=None):
+    _, inds_A, inds_B = correlated
+    return rand_baseline_scores(np.load(extracted_A['W']), np.load(extracted_B['W']), inds_A, inds_B, paired,
+                                num_rand_runs, rsa_method, sequential_pval_bool, rand_num_workers)
+
+### the layer grid ###
+
+def extract_tasks(name, extract_fns, work_dir):
+    # extract_fns: {layer: fn() -> (weight_matrix, reshaped_activations, feature_acts_model)}, e.g. a get_sae_actvs partial
+    return [Task(('extract', name, layer), extract_task,
+                 (extract_fn, os.path.join(work_dir, 'actvs', f'{name.replace("/", "_")}_L{layer}')), local=True)
+            for layer, extract_fn in extract_fns.items()]
+
+def pair_tasks(name_A, layers_A, name_B, layers_B, inputs, tokenizer, vocab=None, num_rand_runs=100,
+               rand_baselines_bool=True, rsa_method=None, sequential_pval_bool=False, top_index_path_fn=None,
+               rand_num_workers=None, **corr_kwargs):
+    """
+    correlate / score / baselines tasks of every (layer_A, layer_B), reading the ('extract', name, layer) results.
+    rand_num_workers: processes each baselines task scores its random runs on, see rand_baseline_scores
+    top_index_path_fn(name, layer): path of the layer's TopActivationsIndex (e.g. topk_index_fns.top_acts_index_path)
+    corr_kwargs: the other correlate_pairs args (oneToOne_bool, corr_threshold, ...)
+    """
+    tasks = []
+    for layer_A in layers_A:
+        for layer_B in layers_B:
+            pair = (name_A, layer_A, name_B, layer_B)
+            extracted = (Dep(('extract', name_A, layer_A)), Dep(('extract', name_B, layer_B)))
+            top_index_paths = None
+            if top_index_path_fn is not None:
+                top_index_paths = (top_index_path_fn(name_A, layer_A), top_index_path_fn(name_B, layer_B))
+            tasks.append(Task(('correlate', *pair), correlate_task, (*extracted, inputs, tokenizer, vocab, top_index_paths),
+                              corr_kwargs))
+            tasks.append(Task(('score', *pair), score_task, (*extracted, Dep(('correlate', *pair)), rsa_method)))
+            if rand_baselines_bool:
+                tasks.append(Task(('baselines', *pair), baselines_task,
+                                  (*extracted, Dep(('correlate', *pair)), Dep(('score', *pair)), num_rand_runs,
+                                   rsa_method, sequential_pval_bool, rand_num_workers)))
+    return tasks
+
+def grid_dictscores(results, name_A, layers_A, name_B, layers_B):
+    # {layer_A: {layer_B: dictscores}}, the run_expm output per pair, as model_layer_to_dictscores
+    model_layer_to_dictscores = {}
+    for layer_A in layers_A:
+        model_layer_to_dictscores[layer_A] = {}
+        for layer_B in layers_B:
+            pair = (name_A, layer_A, name_B, layer_B)
+            dictscores = dict(results[('correlate', *pair)][0])
+            dictscores.update(results[('score', *pair)])
+            dictscores.update(results.get(('baselines', *pair), {}))
+            model_layer_to_dictscores[layer_A][layer_B] = dictscores
+    return model_layer_to_dictscores
+
+def store_task_scores(store, store_key, config, task_id, result):
+    # the scores of a finished correlate / score / baselines task as rows of a results_fns.ResultsStore
+    if task_id[0] == 'extract':
+        return
+    kind, _, layer_A, _, layer_B = task_id
+    metrics = result[0] if kind == 'correlate' else result
+    store.append(metrics, layer_A=layer_A, layer_B=layer_B, config=config, **store_key)
+
+def run_layer_grid(name_A, extract_fns_A, name_B, extract_fns_B, inputs, tokenizer, work_dir='.', config=None,
+                   num_workers=1, blas_threads=1, store=None, store_key=None, **pair_kwargs):
+    """
+    Runs (or resumes) the sweep of every layer of extract_fns_A against every layer of extract_fns_B and returns
+    model_layer_to_dictscores. The log is grid_log_path(work_dir, name_A, name_B, config), config being the settings
+    the results depend on (batch_size, max_length, ...); pair_kwargs are passed to pair_tasks.
+    store: a results_fns.ResultsStore that gets the scores of each pair as its tasks finish, under store_key
+        (model_A, model_B, sae_A, sae_B) and the same config
+    """
+    layers_A, layers_B = list(extract_fns_A), list(extract_fns_B)
+    # a layer of the same model on both sides is extracted once
+    tasks = list({task.task_id: task for task in extract_tasks(name_A, extract_fns_A, work_dir) +
+                  extract_tasks(name_B, extract_fns_B, work_dir)}.values())
+    tasks += pair_tasks(name_A, layers_A, name_B, layers_B, inputs, tokenizer, **pair_kwargs)
+    # the vocab table and the index path fn are how the settings are read, not settings
+    config = {**(config or {}), **{key: val for key, val in pair_kwargs.items()
+                                   if key not in ('vocab', 'top_index_path_fn')}}
+    on_done = None
+    if store is not None:
+        on_done = partial(store_task_scores, store, store_key or {'model_A': name_A, 'model_B': name_B}, config)
+    results = run_tasks(tasks, grid_log_path(work_dir, name_A, name_B, config), num_workers, blas_threads, on_done)
+    return grid_dictscores(results, name_A, layers_A, name_B, layers_B)
@@ -24,9 +24,68 @@ def highest_activating_tokens(
 
     return torch.stack([top_acts_batch, top_acts_seq], dim=-1) # , top_acts_values
 
-def store_top_toks(top_acts_indices, batch_tokens, tokenizer):
+def store_top_toks(top_acts_indices, batch_tokens, tokenizer, vocab=None):
+    if vocab is not None:  # decode all top tokens with one lookup into the cached vocab table
+        return vocab.decode(batch_tokens[top_acts_indices[:, 0], top_acts_indices[:, 1]]).tolist()
     feat_samps = []
     for (batch_idx, seq_idx) in top_acts_indices:
         new_str_token = tokenizer.decode(batch_tokens[batch_idx, seq_idx]) #.replace("\n", "\\n").replace("<|BOS|>", "|BOS|")
         feat_samps.append(new_str_token)
-    return feat_samps
\ No newline at end of file
+    return feat_samps
+
+def highest_activating_tokens_allFeats(
+    feature_acts,
+    k: int = 10,  # num batch_seq samples
+    batch_tokens=None,
+    feat_chunk_size: int = 4096
+):
+    '''
+    Batched version of highest_activating_tokens: one topk over the (batch, seq) axis for all features at once.
+    Returns the token IDs at the top k positions of every feature, shape (num_feats, k).
+    '''
+    num_feats = feature_acts.shape[-1]
+    # (batch, seq, feats) -> (batch*seq, feats); row i corresponds to batch_tokens.reshape(-1)[i]
+    flattened_feature_acts = feature_acts.reshape(-1, num_feats)
+    flattened_tokens = batch_tokens.reshape(-1).to(flattened_feature_acts.device)
+
+    top_tok_ids = []
+    for start in range(0, num_feats, feat_chunk_size):
+        end = min(start + feat_chunk_size, num_feats)
+        _, top_acts_indices = flattened_feature_acts[:, start:end].topk(k, dim=0)  # (k, chunk)
+        top_tok_ids.append(flattened_tokens[top_acts_indices].t())
+    return torch.cat(top_tok_ids, dim=0).cpu()
+
+def canonical_token_ids(batch_tokens, tokenizer, vocab=None):
+    '''
+    Maps every token ID in batch_tokens to the smallest ID that decodes to the same string, so that comparing
+    canonical IDs is the same as comparing decoded labels. Only the unique IDs in the batch are decoded.
+    Returns (canon_map, unique_ids, decoded) where canon_map is indexed by token ID.
+    '''
+    unique_ids = torch.unique(batch_tokens).tolist()
+    if vocab is not None:
+        decoded = vocab.decode(unique_ids).tolist()
+    else:
+        decoded = [tokenizer.decode(tok_id) for tok_id in unique_ids]
+    canon_map = torch.arange(max(unique_ids) + 1)
+    str_to_id = {}
+    for tok_id, tok_str in zip(unique_ids, decoded):  # unique_ids is sorted, so first seen is the smallest
+        canon_map[tok_id] = str_to_id.setdefault(tok_str, tok_id)
+    return canon_map, unique_ids, decoded
+
+def keyword_filter_mask(top_A_tok_ids, top_B_tok_ids, batch_tokens, tokenizer, nonconc_words, vocab=None):
+    '''
+    Vectorized keyword filter over matched feature pairs. Row i of top_A_tok_ids / top_B_tok_ids holds the top
+    token IDs of the i-th pair's A and B feature. A pair is kept if neither side has a top token in nonconc_words
+    and both sides share at least one top token. Token ID -1 (an empty TopActivationsIndex slot) is no token.
+    '''
+    canon_map, unique_ids, decoded = canonical_token_ids(batch_tokens, tokenizer, vocab)
+    nonconc_ids = torch.tensor([tok_id for tok_id, tok_str in zip(unique_ids, decoded) if tok_str in nonconc_words],
+                               dtype=top_A_tok_ids.dtype)
+
+    has_nonconc = torch.isin(top_A_tok_ids, nonconc_ids).any(dim=1) | torch.isin(top_B_tok_ids, nonconc_ids).any(dim=1)
+
+    canon_A = torch.where(top_A_tok_ids >= 0, canon_map[top_A_tok_ids.clamp_min(0)], -1)
+    canon_B = torch.where(top_B_tok_ids >= 0, canon_map[top_B_tok_ids.clamp_min(0)], -1)
+    shares_tok = ((canon_A[:, :, None] == canon_B[:, None, :]) & (canon_A[:, :, None] >= 0)).any(dim=2).any(dim=1)
+
+    return (~has_nonconc & shares_tok).numpy()
@@ -0,0 +1,54 @@
+"""
+Inverted index from normalized keyword to the sorted array of feature IDs it labels. The semantic-subspace code can
+pick a concept's features with one lookup per keyword (concept_feats) instead of find_indices_with_keyword's scan over
+every feature's labels (lower-casing and stripping each one) per keyword.
+
+Built from the top token IDs per feature (highest_activating_tokens_allFeats / TopActivationsIndex), decoded with the
+cached vocab table. Keywords are normalized like vocab_fns.normalize_tok_str (spaces dropped, lowercased). The keys are
+kept sorted (CSR layout: keys, offsets, feat_ids), so a lookup is a binary search.
+"""
+import numpy as np
+
+from vocab_fns import normalize_tok_str
+
+class KeywordIndex:
+    def __init__(self, keys, offsets, feat_ids):
+        self.keys = np.asarray(keys, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.feat_ids = np.asarray(feat_ids, dtype=np.int32)
+
+    @classmethod
+    def from_pairs(cls, keywords, feats):
+        # one (keyword, feature) pair per label occurrence; duplicates are dropped
+        norm_keywords = np.array([normalize_tok_str(kw) for kw in keywords], dtype=str)
+        feats = np.asarray(feats, dtype=np.int32)
+        if len(norm_keywords) == 0:
+            return cls(np.array([], dtype=str), np.zeros(1), np.array([], dtype=np.int32))
+        keys, key_inds = np.unique(norm_keywords, return_inverse=True)
+        pairs = np.unique(np.stack([key_inds, feats], axis=1), axis=0)  # sorted by key, then feature
+        offsets = np.searchsorted(pairs[:, 0], np.arange(len(keys) + 1))
+        return cls(keys, offsets, pairs[:, 1])
+
+    @classmethod
+    def from_top_token_ids(cls, top_tok_ids, vocab):
+        # -1 (an empty TopActivationsIndex slot) labels nothing
+        top_tok_ids = np.asarray(top_tok_ids.cpu() if hasattr(top_tok_ids, 'cpu') else top_tok_ids)
+        feats = np.repeat(np.arange(top_tok_ids.shape[0]), top_tok_ids.shape[1])
+        filled = top_tok_ids.ravel() >= 0
+        return cls.from_pairs(vocab.decode(top_tok_ids.ravel()[filled]).tolist(), feats[filled])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keyword):
+        # sorted feature IDs labeled exactly keyword (after normalization)
+        keyword = normalize_tok_str(keyword)
+        i = np.searchsorted(self.keys, keyword)
+        if i < len(self.keys) and self.keys[i] == keyword:
+            return self.feat_ids[self.offsets[i]:self.offsets[i + 1]]
+        return np.array([], dtype=np.int32)
+
+def concept_feats(keyword_index, concept_keywords):
+    # {concept: sorted feature IDs labeled with any of its keywords}, e.g. for the semantic-subspace keyword dicts
+    return {concept: np.unique(np.concatenate([keyword_index.lookup(kw) for kw in kws] + [np.array([], np.int32)]))
+            for concept, kws in concept_keywords.items()}
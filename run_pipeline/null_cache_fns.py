@@ -0,0 +1,49 @@
+"""
+On-disk cache of random-baseline null distributions. The scores of a baseline only depend on the two weight matrices,
+the subset size, the metric and the seed, and with per-run seed streams (get_rand_fns.run_seed_seqs) run i does not
+depend on how many runs there are. So a cache entry is the array of scores in run order, keyed by
+
+    {kind}_{metric}_{hash of weight matrix 1}_{hash of weight matrix 2}_n{num_feats}_seed{seed}
+
+(kind: 'shuffle' for shuffle_rand, 'subset' for score_rand), and asking for more runs than are cached only scores the
+missing runs and appends them. Failed runs are stored as nan.
+"""
+import os
+
+import numpy as np
+
+from ann_fns import W_dec_hash
+
+def null_cache_key(kind, weight_matrix_np, weight_matrix_2, num_feats, metric, seed):
+    return f'{kind}_{metric}_{W_dec_hash(weight_matrix_np)}_{W_dec_hash(weight_matrix_2)}_n{num_feats}_seed{seed}'
+
+def null_cache_path(cache_dir, key):
+    return os.path.join(cache_dir, f'null_{key}.npy')
+
+def load_cached_scores(path):
+    return np.load(path) if os.path.exists(path) else np.zeros(0)
+
+def save_cached_scores(path, scores):
+    # write to a temp file and rename, so an interrupted run never leaves a truncated entry
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, np.asarray(scores, dtype=np.float64))
+    os.replace(tmp_path, path)
+
+def extend_cached_scores(path, num_runs, score_runs):
+    """
+    The first num_runs cached scores at path, after scoring and saving any runs not cached yet.
+    score_runs(first_run, num_new_runs): scores of runs first_run, ..., first_run + num_new_runs - 1
+    """
+    scores = load_cached_scores(path)
+    if len(scores) < num_runs:
+        print(f'null cache: {len(scores)} runs cached, scoring {num_runs - len(scores)} more')
+        new_scores = np.asarray(score_runs(len(scores), num_runs - len(scores)), dtype=np.float64)
+        scores = np.concatenate([scores, new_scores])
+        save_cached_scores(path, scores)
+    return scores[:num_runs]
+
+def cached_null_scores(kind, num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, seed, cache_dir,
+                       score_runs):
+    key = null_cache_key(kind, weight_matrix_np, weight_matrix_2, num_feats, sim_fn.__name__, seed)
+    return extend_cached_scores(null_cache_path(cache_dir, key), num_runs, score_runs)
@@ -0,0 +1,189 @@
+"""
+Feature pairing after batched_correlation. All of these work on index arrays with np.bincount and a first-occurrence
+mask, so they are O(n) in the number of pairs instead of the O(n^2) `ind in kept_list` loops.
+
+    many-to-1: every feature of the "one" model keeps its max-correlated feature of the "many" model
+    1-to-X:    a "many" feature is kept in all its pairs if it is matched at most X times; otherwise only its first pair
+    1-to-1:    1-to-X with X = 1
+
+The "first pair wins" 1-1 above depends on feature order. hungarian_assignment and greedy_assignment instead solve the
+1-1 matching on the sparse top-k candidate graph from batched_correlation_topk.
+
+mutual_nn_pairs matches decoder rows by geometry instead of activations: mutual k nearest neighbors between W_A and
+W_B, using the ann_fns indexes.
+"""
+import numpy as np
+import scipy.sparse
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components, min_weight_full_bipartite_matching
+
+from ann_fns import get_ann_index, report_recall
+
+def many_to_one_pairs(max_corr_inds, manyA_1B_bool=True):
+    # `batched_correlation(A, B)` returns, for each B feat (position), its max correlated A feat (value)
+    if manyA_1B_bool:
+        return np.asarray(max_corr_inds), np.arange(len(max_corr_inds))
+    else:
+        return np.arange(len(max_corr_inds)), np.asarray(max_corr_inds)
+
+def first_occurrence_mask(inds):
+    # True at the first position each value appears at, in the original order
+    inds = np.asarray(inds, dtype=np.int64)
+    if len(inds) == 0:
+        return np.zeros(0, dtype=bool)
+    positions = np.arange(len(inds))
+    first_pos = np.full(inds.max() + 1, len(inds))
+    np.minimum.at(first_pos, inds, positions)
+    return first_pos[inds] == positions
+
+def one_to_X_mask(inds, X, count_inds=None):
+    """
+    inds: the "many" side feature of each pair, in pair order
+    count_inds: the indices to count matches over (defaults to inds). run_expm counts over all pairs from
+        batched_correlation, before keyword filtering, and applies the mask to the filtered pairs.
+    """
+    inds = np.asarray(inds, dtype=np.int64)
+    count_inds = inds if count_inds is None else np.asarray(count_inds, dtype=np.int64)
+    if len(inds) == 0:
+        return np.zeros(0, dtype=bool)
+    minlength = max(inds.max(), count_inds.max() if len(count_inds) else 0) + 1
+    counts = np.bincount(count_inds, minlength=minlength)
+    return (counts[inds] <= X) | first_occurrence_mask(inds)
+
+def one_to_X_pairs(ind_A, ind_B, X, count_inds=None, manyA_1B_bool=True):
+    ind_A, ind_B = np.asarray(ind_A, dtype=np.int64), np.asarray(ind_B, dtype=np.int64)
+    many_inds = ind_A if manyA_1B_bool else ind_B
+    keep = one_to_X_mask(many_inds, X, count_inds)
+    return ind_A[keep].tolist(), ind_B[keep].tolist()
+
+def one_to_one_pairs(ind_A, ind_B, count_inds=None, manyA_1B_bool=True):
+    return one_to_X_pairs(ind_A, ind_B, 1, count_inds, manyA_1B_bool)
+
+
+def topk_candidate_edges(topk_inds, topk_vals, min_corr=None):
+    # (row, col, corr) edge list of the candidate graph; rows are the "one" feats, cols the "many" feats
+    num_rows, k = topk_inds.shape
+    rows = np.repeat(np.arange(num_rows), k)
+    cols = np.asarray(topk_inds, dtype=np.int64).ravel()
+    vals = np.asarray(topk_vals, dtype=np.float64).ravel()
+    keep = np.isfinite(vals)
+    if min_corr is not None:
+        keep &= vals > min_corr
+    return rows[keep], cols[keep], vals[keep]
+
+def greedy_assignment(topk_inds, topk_vals, min_corr=None):
+    """
+    Sorted-edge greedy 1-1 matching: take edges by decreasing corr, skipping any whose row or col is already used.
+    Instead of a Python loop over edges, every round accepts all edges that are the best remaining edge for both their
+    row and their col (these are exactly the edges sequential greedy would take), then drops edges touching them.
+    """
+    rows, cols, vals = topk_candidate_edges(topk_inds, topk_vals, min_corr)
+    order = np.argsort(-vals, kind='stable')
+    rows, cols, vals = rows[order], cols[order], vals[order]
+
+    row_used = np.zeros(topk_inds.shape[0], dtype=bool)
+    col_used = np.zeros(cols.max() + 1 if len(cols) else 0, dtype=bool)
+    matched = []
+    while len(rows):
+        best = first_occurrence_mask(rows) & first_occurrence_mask(cols)
+        matched.append((rows[best], cols[best], vals[best]))
+        row_used[rows[best]] = True
+        col_used[cols[best]] = True
+        remaining = ~row_used[rows] & ~col_used[cols]
+        rows, cols, vals = rows[remaining], cols[remaining], vals[remaining]
+
+    return _sorted_matches(matched)
+
+def hungarian_assignment(topk_inds, topk_vals, min_corr=None, max_dense_size=4_000_000):
+    """
+    Max total corr 1-1 matching on the top-k candidate graph (a missing edge counts as corr 0, so pairs with
+    negative corr are never kept). The graph is split into connected components; each component is solved with
+    linear_sum_assignment on its dense sub-block if that has at most max_dense_size entries, else with the sparse
+    LAPJV solver (min_weight_full_bipartite_matching), so the full num_feats x num_feats matrix is never built.
+    """
+    rows, cols, vals = topk_candidate_edges(topk_inds, topk_vals, min_corr)
+    num_rows = topk_inds.shape[0]
+    unq_cols, cols = np.unique(cols, return_inverse=True)
+    num_cols = len(unq_cols)
+
+    # rows are nodes [0, num_rows), cols are nodes [num_rows, num_rows + num_cols)
+    adjacency = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, num_rows + cols)),
+                                        shape=(num_rows + num_cols, num_rows + num_cols))
+    _, labels = connected_components(adjacency, directed=False)
+    edge_comp = labels[rows]
+
+    edge_order = np.argsort(edge_comp, kind='stable')
+    _, comp_starts = np.unique(edge_comp[edge_order], return_index=True)
+    matched = []
+    for edge_inds in np.split(edge_order, comp_starts[1:]):
+        if len(edge_inds) == 0:
+            continue
+        c_rows, r_local = np.unique(rows[edge_inds], return_inverse=True)
+        c_cols, c_local = np.unique(cols[edge_inds], return_inverse=True)
+        c_vals = vals[edge_inds]
+
+        if len(c_rows) * len(c_cols) <= max_dense_size:
+            cost = np.zeros((len(c_rows), len(c_cols)))
+            is_edge = np.zeros((len(c_rows), len(c_cols)), dtype=bool)
+            cost[r_local, c_local] = -c_vals
+            is_edge[r_local, c_local] = True
+            row_ind, col_ind = linear_sum_assignment(cost)
+            real = is_edge[row_ind, col_ind] & (cost[row_ind, col_ind] < 0)
+            row_ind, col_ind = row_ind[real], col_ind[real]
+            matched.append((c_rows[row_ind], unq_cols[c_cols[col_ind]], -cost[row_ind, col_ind]))
+        else:
+            # each row also gets a private dummy col with weight 2 (= corr 0), so a full matching always exists;
+            # real edges get weight 2 - corr > 0, so minimizing total weight maximizes total corr
+            num_r, num_c = len(c_rows), len(c_cols)
+            biadjacency = scipy.sparse.csr_matrix(
+                (np.concatenate([2 - c_vals, np.full(num_r, 2.0)]),
+                 (np.concatenate([r_local, np.arange(num_r)]), np.concatenate([c_local, num_c + np.arange(num_r)]))),
+                shape=(num_r, num_c + num_r))
+            row_ind, col_ind = min_weight_full_bipartite_matching(biadjacency)
+            real = col_ind < num_c
+            row_ind, col_ind = row_ind[real], col_ind[real]
+            real_vals = 2 - np.asarray(biadjacency[row_ind, col_ind]).ravel()
+            real = real_vals > 0
+            matched.append((c_rows[row_ind[real]], unq_cols[c_cols[col_ind[real]]], real_vals[real]))
+
+    return _sorted_matches(matched)
+
+def _sorted_matches(matched):
+    if not matched:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    one_inds, many_inds, vals = (np.concatenate(x) for x in zip(*matched))
+    order = np.argsort(one_inds, kind='stable')
+    return one_inds[order], many_inds[order].astype(np.int64), vals[order]
+
+def assign_feats(topk_inds, topk_vals, method='hungarian', min_corr=None):
+    """
+    1-1 assignment from batched_correlation_topk output. Returns (one_inds, many_inds, vals) sorted by one_inds,
+    where one_inds are the feats of the model given as the second arg of batched_correlation_topk.
+    """
+    if method == 'hungarian':
+        return hungarian_assignment(topk_inds, topk_vals, min_corr)
+    elif method == 'greedy':
+        return greedy_assignment(topk_inds, topk_vals, min_corr)
+    else:
+        raise ValueError(f"Unknown assignment method: {method}")
+
+
+def mutual_nn_pairs(W_A, W_B, k=5, metric='euclidean', index_kind='exact', cache_dir=None):
+    """
+    (A, B) index arrays of all pairs where W_B[B] is among the k nearest rows of W_B to W_A[A] and W_A[A] is among the
+    k nearest rows of W_A to W_B[B] (the mnn matching of ts_1L_2L_mnn). Needs W_A and W_B in the same space.
+    index_kind: 'exact' or 'ivf', see ann_fns.get_ann_index (for 'ivf', the recall@k of both searches is printed)
+    cache_dir: if given, the ivf indexes are persisted there
+    """
+    index_B = get_ann_index(W_B, index_kind, metric=metric, cache_dir=cache_dir)
+    index_A = get_ann_index(W_A, index_kind, metric=metric, cache_dir=cache_dir)
+    report_recall(index_B, W_B, k, Q=W_A)
+    report_recall(index_A, W_A, k, Q=W_B)
+    nn_AB, _ = index_B.query(W_A, k)
+    nn_BA, _ = index_A.query(W_B, k)
+    ind_A = np.repeat(np.arange(len(nn_AB)), k)
+    ind_B = nn_AB.ravel()
+    valid = ind_B >= 0  # ivf can return fewer than k candidates
+    ind_A, ind_B = ind_A[valid], ind_B[valid]
+    mutual = (nn_BA[ind_B] == ind_A[:, None]).any(axis=1)
+    return ind_A[mutual], ind_B[mutual]
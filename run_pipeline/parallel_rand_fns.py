@@ -0,0 +1,123 @@
+"""
+shuffle_rand on a process pool. The random baseline runs are independent, so they are split into chunks of runs and
+scored by num_workers processes:
+
+    - the two (num_feats, D) weight matrices are copied into shared memory once; workers attach to them instead of
+      receiving a pickled copy with every task
+    - run i shuffles its rows with its own Generator from get_rand_fns.run_seed_seqs (SeedSequence(seed).spawn(n)[i]),
+      and chunks are collected in run order, so the scores only depend on seed, never on num_workers or on how the
+      runs were chunked
+    - each worker is pinned to blas_threads BLAS / torch threads, so num_workers x blas_threads does not oversubscribe
+      the cores
+
+The chunks are scored with get_rand_fns.score_perms, i.e. with permutation_score_fns where one exists. The runs are
+the same as shuffle_rand's with a cache_dir (not the `random.shuffle` draws it makes without one).
+
+python parallel_rand_fns.py runs benchmark_parallel_shuffle.
+"""
+import multiprocessing as mp
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+from get_rand_fns import run_seed_seqs, score_perms, seeded_shuffle_perms
+from sim_fns import svcca
+
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS')
+
+# per worker process: the shared memory blocks and the arrays viewing them
+_worker_shms = []
+_worker_mats = None
+
+def to_shared_memory(X):
+    X = np.ascontiguousarray(X)
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[...] = X
+    return shm, (shm.name, X.shape, X.dtype.str)
+
+def _init_worker(mat_specs, blas_threads):
+    global _worker_mats
+    torch.set_num_threads(blas_threads)
+    mats = []
+    for name, shape, dtype in mat_specs:
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_shms.append(shm)
+        mats.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    _worker_mats = mats
+
+def _score_chunk(args):
+    seed_seqs, sim_fn, shapereq_bool = args
+    weight_matrix_np, weight_matrix_2 = _worker_mats
+    return score_perms(weight_matrix_np, weight_matrix_2, seeded_shuffle_perms(seed_seqs, weight_matrix_np.shape[0]),
+                       sim_fn, shapereq_bool)
+
+def parallel_shuffle_rand(num_runs, weight_matrix_np, weight_matrix_2, num_feats, sim_fn, shapereq_bool, seed=0,
+                          num_workers=None, blas_threads=1, chunk_size=None, first_run=0):
+    """
+    Scores of num_runs row shuffles of weight_matrix_2 against weight_matrix_np (both num_feats rows), as shuffle_rand.
+    num_workers: defaults to os.cpu_count() // blas_threads; 1 scores in this process (same scores)
+    chunk_size: runs per task, defaults to ~4 tasks per worker
+    first_run: score runs first_run, ..., first_run + num_runs - 1 (e.g. to extend a null_cache_fns entry)
+    """
+    assert weight_matrix_np.shape[0] == num_feats and weight_matrix_2.shape[0] == num_feats
+    num_workers = num_workers or max(1, (os.cpu_count() or 1) // blas_threads)
+    chunk_size = chunk_size or max(1, -(-num_runs // (4 * num_workers)))
+    seed_seqs = run_seed_seqs(seed, first_run, num_runs)
+    chunks = [(seed_seqs[i:i + chunk_size], sim_fn, shapereq_bool) for i in range(0, num_runs, chunk_size)]
+
+    if num_workers == 1:
+        scores = []
+        for seed_chunk, _, _ in chunks:
+            scores.extend(score_perms(weight_matrix_np, weight_matrix_2, seeded_shuffle_perms(seed_chunk, num_feats),
+                                      sim_fn, shapereq_bool))
+        return scores
+
+    shms, mat_specs = zip(*(to_shared_memory(X) for X in (weight_matrix_np, weight_matrix_2)))
+    # the BLAS libraries read these when the spawned workers import numpy / torch
+    old_env = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(blas_threads) for var in BLAS_THREAD_VARS})
+    try:
+        with mp.get_context('spawn').Pool(num_workers, initializer=_init_worker,
+                                          initargs=(mat_specs, blas_threads)) as pool:
+            scores = [score for chunk_scores in pool.map(_score_chunk, chunks) for score in chunk_scores]
+    finally:
+        for var, val in old_env.items():
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = val
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return scores
+
+def benchmark_parallel_shuffle(num_feats=8192, dims=(512, 768), num_runs=64, sim_fn=svcca, worker_counts=None,
+                               blas_threads=1, seed=0):
+    """
+    Wall time of parallel_shuffle_rand on random weights for each worker count, and its speedup over 1 worker.
+    Also checks that every worker count gives the same scores.
+    """
+    worker_counts = worker_counts or sorted({1, 2, 4, 8, os.cpu_count() or 1})
+    rng = np.random.default_rng(seed)
+    W1 = rng.standard_normal((num_feats, dims[0])).astype(np.float32)
+    W2 = (W1 @ rng.standard_normal((dims[0], dims[1])) + rng.standard_normal((num_feats, dims[1]))).astype(np.float32)
+
+    timings, ref_scores = {}, None
+    for num_workers in worker_counts:
+        start = time.perf_counter()
+        scores = parallel_shuffle_rand(num_runs, W1, W2, num_feats, sim_fn, True, seed=seed,
+                                       num_workers=num_workers, blas_threads=blas_threads)
+        timings[num_workers] = time.perf_counter() - start
+        ref_scores = scores if ref_scores is None else ref_scores
+        assert np.allclose(scores, ref_scores), f"{num_workers} workers gave different scores"
+
+    for num_workers, seconds in timings.items():
+        print(f"{num_workers:3d} workers: {seconds:8.2f}s  speedup {timings[worker_counts[0]] / seconds:5.2f}x")
+    return timings
+
+if __name__ == "__main__":
+    benchmark_parallel_shuffle()
@@ -0,0 +1,140 @@
+"""
+SQLite store of experiment results, one row per metric, keyed by
+
+    (model_A, model_B, sae_A, sae_B, layer_A, layer_B, metric, config_hash)
+
+config_hash is config_hash(config) of the settings the scores depend on (batch_size, corr_threshold, ...), so runs
+with other settings never overwrite each other. Adding a score is one INSERT OR REPLACE in its own transaction,
+instead of rewriting a whole pickle / JSON of all scores. The database is in WAL mode with a busy timeout, so several
+processes (grid workers, parallel modal jobs on one volume) can append to it at once.
+
+Scalar scores are stored as numbers; anything else (e.g. the threshold_sweep dict, rsa_paired_ci) is pickled.
+query returns a pandas DataFrame, and layer_to_dictscores turns one back into the {layer_B: dictscores} dicts that
+plot_fns plots.
+"""
+import hashlib
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ('model_A', 'model_B', 'sae_A', 'sae_B', 'layer_A', 'layer_B', 'metric', 'config_hash')
+
+def _canonical_config_value(val):
+    # plain values as they are (so their hashes do not change), numpy values as lists / scalars, dicts as sorted items
+    if isinstance(val, np.ndarray):
+        return val.tolist()
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, (bool, int, float, str, type(None))):
+        return val
+    if isinstance(val, (tuple, list)):
+        return type(val)(_canonical_config_value(v) for v in val)
+    if isinstance(val, dict):
+        return tuple(sorted((key, _canonical_config_value(v)) for key, v in val.items()))
+    raise TypeError(f"config value {val!r} of type {type(val).__name__} has no stable repr to hash")
+
+def config_hash(config):
+    # config: the settings the results depend on; objects without a stable repr (e.g. the vocab table) raise TypeError
+    canonical_config = {key: _canonical_config_value(val) for key, val in config.items()}
+    return hashlib.sha1(repr(sorted(canonical_config.items())).encode()).hexdigest()[:10]
+
+def _to_db_value(value):
+    # (value, blob): numbers as they are, everything else pickled
+    if isinstance(value, (bool, np.bool_)):
+        return int(value), None
+    if isinstance(value, (int, np.integer)):
+        return int(value), None
+    if np.ndim(value) == 0 and not isinstance(value, (str, dict)) and value is not None:
+        try:
+            return float(value), None
+        except (TypeError, ValueError):
+            pass
+    return None, pickle.dumps(value)
+
+class ResultsStore:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # layer columns have no type, so int layers stay ints and sae_id layers stay strings
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS results (
+                model_A TEXT, model_B TEXT, sae_A TEXT, sae_B TEXT, layer_A, layer_B, metric TEXT,
+                config_hash TEXT, value, blob BLOB, created REAL,
+                PRIMARY KEY ({', '.join(KEY_COLUMNS)}))""")
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def append(self, metrics, model_A, model_B, sae_A=None, sae_B=None, layer_A=None, layer_B=None, config=None):
+        """
+        Stores every (metric, value) of metrics for this key in one transaction; a metric already stored for the key is
+        replaced.
+        """
+        key = (model_A, model_B, sae_A or '', sae_B or '', layer_A, layer_B)
+        chash = config_hash(config or {})
+        rows = [(*key, metric, chash, *_to_db_value(value), time.time()) for metric, value in metrics.items()]
+        conn = self._connect()
+        with conn:
+            conn.executemany(f"INSERT OR REPLACE INTO results VALUES ({', '.join('?' * 11)})", rows)
+        conn.close()
+
+    def _where(self, filters):
+        clauses, params = [], []
+        for col, val in filters.items():
+            if val is None:
+                continue
+            if col == 'config':
+                col, val = 'config_hash', config_hash(val)
+            if col not in KEY_COLUMNS:
+                raise ValueError(f"Unknown results column: {col}")
+            if isinstance(val, (list, tuple, set)):
+                clauses.append(f"{col} IN ({', '.join('?' * len(val))})")
+                params.extend(val)
+            else:
+                clauses.append(f'{col} = ?')
+                params.append(val)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def done_metrics(self, model_A, model_B, sae_A=None, sae_B=None, layer_A=None, layer_B=None, config=None):
+        # set of the metrics already stored for this key
+        where, params = self._where({'model_A': model_A, 'model_B': model_B, 'sae_A': sae_A or '', 'sae_B': sae_B or '',
+                                     'layer_A': layer_A, 'layer_B': layer_B, 'config': config or {}})
+        conn = self._connect()
+        metrics = {metric for (metric,) in conn.execute(f'SELECT metric FROM results{where}', params)}
+        conn.close()
+        return metrics
+
+    def query(self, metrics=None, **filters):
+        """
+        DataFrame of the rows matching filters (a value or a list of values per key column, or config=dict), with
+        columns KEY_COLUMNS + (value, created); value holds the unpickled object for non-scalar scores.
+        e.g. store.query(metrics=['svcca_paired', 'svcca_rand_mean'], sae_A='EleutherAI/sae-pythia-70m-32k')
+        """
+        if metrics is not None:
+            filters['metric'] = [metrics] if isinstance(metrics, str) else list(metrics)
+        where, params = self._where(filters)
+        conn = self._connect()
+        rows = conn.execute(f"SELECT {', '.join(KEY_COLUMNS)}, value, blob, created FROM results{where}",
+                            params).fetchall()
+        conn.close()
+        df = pd.DataFrame([row[:len(KEY_COLUMNS)] + row[-1:] for row in rows], columns=[*KEY_COLUMNS, 'created'])
+        # object column, so counts stay ints next to float scores and pickled objects. SQLite stores nan as NULL
+        values = [pickle.loads(blob) if blob is not None else (np.nan if value is None else value)
+                  for *_, value, blob, _ in rows]
+        df.insert(len(KEY_COLUMNS), 'value', pd.Series(values, index=df.index, dtype=object))
+        return df
+
+def layer_to_dictscores(df, layer_A=None):
+    """
+    {layer_A: {layer_B: {metric: value}}} of a query DataFrame (one model / SAE pair and config), as the
+    model_layer_to_dictscores run.py used to pickle; with layer_A, only its {layer_B: dictscores}, as plot_fns takes.
+    """
+    model_layer_to_dictscores = {}
+    for layer_A_, layer_B, metric, value in zip(df['layer_A'], df['layer_B'], df['metric'], df['value']):
+        model_layer_to_dictscores.setdefault(layer_A_, {}).setdefault(layer_B, {})[metric] = value
+    return model_layer_to_dictscores if layer_A is None else model_layer_to_dictscores[layer_A]
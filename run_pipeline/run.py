@@ -2,6 +2,7 @@
 
 import gc
 import pickle
+from functools import partial
 import numpy as np
 import matplotlib.pyplot as plt
 from fnmatch import fnmatch
@@ -34,6 +35,8 @@ from interpret_fns import *
 from get_actv_fns import *
 from run_expm_fns import *
 from plot_fns import *
+from grid_fns import run_layer_grid
+from results_fns import ResultsStore
 
 import argparse
 
@@ -78,12 +81,31 @@ def main():
     parser.add_argument("--max_length", type=int, default=100, help="Maximum sequence length")
     parser.add_argument("--num_rand_runs", type=int, default=1, help="Number of random runs")
     parser.add_argument("--oneToOne_bool", action="store_true", help="Use one-to-one mapping flag")
+    parser.add_argument("--oneToOne_method", type=str, default="first", choices=["first", "hungarian", "greedy"],
+                        help="How to make pairs one-to-one (with --oneToOne_bool)")
+    parser.add_argument("--corr_threshold", type=float, default=0.1, help="Filter out pairs with corr <= this")
+    parser.add_argument("--corr_thresholds", type=float, nargs="+", default=None,
+                        help="Also score the pairs kept at each of these thresholds (threshold sweep)")
+    parser.add_argument("--rsa_method", type=str, default=None, choices=["full", "sampled", "exact"],
+                        help="Also compute RSA: full RSMs, sampled (large N, with CI) or exact blocked (large N)")
+    parser.add_argument("--kw_filter", action="store_true",
+                        help="Drop pairs with non-concept top tokens or no shared top token (changes the scores)")
+    parser.add_argument("--sequential_pval", action="store_true",
+                        help="Stop the random baseline runs early once the p-value is settled")
+    parser.add_argument("--rand_num_workers", type=int, default=None,
+                        help="Processes scoring each pair's random baseline runs (seeded shuffles; default: in-process)")
     parser.add_argument("--model_A_startLayer", type=int, default=1, help="Model A start layer")
     parser.add_argument("--model_B_startLayer", type=int, default=1, help="Model B start layer")
     parser.add_argument("--model_A_endLayer", type=int, default=6, help="Model A end layer")
     parser.add_argument("--model_B_endLayer", type=int, default=12, help="Model B end layer")
     parser.add_argument("--layer_step_size_A", type=int, default=1, help="Layer step size A")
     parser.add_argument("--layer_step_size_B", type=int, default=1, help="Layer step size B")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Processes scoring layer pairs while the next layers are extracted (0: all in this process)")
+    parser.add_argument("--work_dir", type=str, default=".",
+                        help="Extracted activations and the task log; a killed run started again resumes from it")
+    parser.add_argument("--results_db", type=str, default="results.sqlite",
+                        help="SQLite results store the scores are appended to (see results_fns)")
     
     args = parser.parse_args()
     
@@ -94,12 +116,22 @@ def main():
     max_length = args.max_length
     num_rand_runs = args.num_rand_runs
     oneToOne_bool = args.oneToOne_bool
+    oneToOne_method = args.oneToOne_method
+    corr_threshold = args.corr_threshold
+    corr_thresholds = args.corr_thresholds
+    rsa_method = args.rsa_method
+    sequential_pval_bool = args.sequential_pval
+    rand_num_workers = args.rand_num_workers
+    kw_filter_bool = args.kw_filter
     model_A_startLayer = args.model_A_startLayer
     model_B_startLayer = args.model_B_startLayer
     model_A_endLayer = args.model_A_endLayer
     model_B_endLayer = args.model_B_endLayer
     layer_step_size_A = args.layer_step_size_A
     layer_step_size_B = args.layer_step_size_B
+    num_workers = args.num_workers
+    work_dir = args.work_dir
+    results_db = args.results_db
 
     # model_name_1 = "google/gemma-2-2b"
     # model_name_2 = "google/gemma-2-9b"
@@ -145,6 +177,7 @@ def main():
 
     ### store sae actvs
     print("Storing SAE activations")
+    top_index_k = 10  # per-feature top activations kept in the top_acts index, read by run_expm's keyword filter
 
     if 'EleutherAI' in model_name_1:
         sae_name = "EleutherAI/sae-pythia-70m-32k"
@@ -153,59 +186,48 @@ def main():
         # gemma 1: "google/gemma-2b-res-jb"
         sae_name = "gemma-scope-2b-pt-res-canonical"
         sae_lib = 'sae_lens'
-    saeActvs_by_layer_1 = {}
-    for layer_id in range(model_A_startLayer, model_A_endLayer, layer_step_size_A): 
-        print("Model A Layer: " + str(layer_id))
-        with torch.inference_mode():
-            weight_matrix, reshaped_activations, feature_acts_model = get_sae_actvs(model=model, sae_name=sae_name, inputs=inputs, 
-                                                                                     layer_id=layer_id, batch_size=8,
-                                                                                     sae_lib=sae_lib)
-            saeActvs_by_layer_1[layer_id] = (weight_matrix, reshaped_activations, feature_acts_model)
-
-    # save_file(saeActvs_by_layer_1, "saeActvs_by_layer_1.safetensors")
-    with open(f'saeActvs_by_layer_1.pkl', 'wb') as f:
-        pickle.dump(saeActvs_by_layer_1, f)
-
+    sae_lib_1 = sae_lib
     if 'EleutherAI' in model_name_2:
         sae_name_2 = "EleutherAI/sae-pythia-160m-32k"
-        sae_lib = 'eleuther'
+        sae_lib_2 = 'eleuther'
     elif 'google' in model_name_2:
         sae_name_2 = "gemma-scope-9b-pt-res-canonical"
-        sae_lib = 'sae_lens'
-    saeActvs_by_layer_2 = {}
-    for layer_id in range(model_B_startLayer, model_B_endLayer, layer_step_size_B): 
-        print("Model B Layer: " + str(layer_id))
-        with torch.inference_mode():
-            weight_matrix, reshaped_activations, feature_acts_model = get_sae_actvs(model=model_2, sae_name=sae_name_2,inputs=inputs, 
-                                                                                     layer_id=layer_id, batch_size=8,
-                                                                                     sae_lib=sae_lib)
-            saeActvs_by_layer_2[layer_id] = (weight_matrix, reshaped_activations, feature_acts_model)
-
-    # save_file(saeActvs_by_layer_2, "saeActvs_by_layer_2.safetensors")
-    with open(f'saeActvs_by_layer_2.pkl', 'wb') as f:
-        pickle.dump(saeActvs_by_layer_2, f)
+        sae_lib_2 = 'sae_lens'
+    model_A_layers = list(range(model_A_startLayer, model_A_endLayer, layer_step_size_A))
+    model_B_layers = list(range(model_B_startLayer, model_B_endLayer, layer_step_size_B))
+    # each layer's activations are extracted in a grid task (in this process, as it needs the model) and saved to
+    # work_dir/actvs, together with its top_acts index
+    extract_fns_1 = {layer_id: partial(get_sae_actvs, model=model, sae_name=sae_name, inputs=inputs, layer_id=layer_id,
+                                       batch_size=8, sae_lib=sae_lib_1, top_index_k=top_index_k,
+                                       top_index_path=top_acts_index_path(sae_name, layer_id, work_dir))
+                     for layer_id in model_A_layers}
+    extract_fns_2 = {layer_id: partial(get_sae_actvs, model=model_2, sae_name=sae_name_2, inputs=inputs,
+                                       layer_id=layer_id, batch_size=8, sae_lib=sae_lib_2, top_index_k=top_index_k,
+                                       top_index_path=top_acts_index_path(sae_name_2, layer_id, work_dir))
+                     for layer_id in model_B_layers}
+
+    # decoded vocab table, shared by every correlate task
+    vocab = get_vocab_table(tokenizer, cache_dir=work_dir)
 
     ### run
     print("Running experiment")
-    model_layer_to_dictscores = {}
+    model_layer_to_dictscores = run_layer_grid(
+        sae_name, extract_fns_1, sae_name_2, extract_fns_2, inputs, tokenizer, work_dir=work_dir,
+        config={'batch_size': batch_size, 'max_length': max_length}, num_workers=num_workers,
+        vocab=vocab, num_rand_runs=num_rand_runs, rsa_method=rsa_method, sequential_pval_bool=sequential_pval_bool,
+        rand_num_workers=rand_num_workers, top_index_path_fn=partial(top_acts_index_path, cache_dir=work_dir),
+        oneToOne_bool=oneToOne_bool, oneToOne_method=oneToOne_method, corr_threshold=corr_threshold,
+        corr_thresholds=corr_thresholds, kw_filter_bool=kw_filter_bool,
+        store=ResultsStore(results_db),
+        store_key={'model_A': model_name_1, 'model_B': model_name_2, 'sae_A': sae_name, 'sae_B': sae_name_2})
 
-    model_A_layers = list(range(model_A_startLayer, model_A_endLayer, layer_step_size_A))
-    model_B_layers = list(range(model_B_startLayer, model_B_endLayer, layer_step_size_B)) 
     for layer_id in model_A_layers:
-        print("Model A Layer: " + str(layer_id))
-        model_layer_to_dictscores[layer_id] = {}
-        for layer_id_2 in model_B_layers: # in range(layer_start, layer_end): # 0, 12
-            print("Model B Layer: " + str(layer_id_2))
-            model_layer_to_dictscores[layer_id][layer_id_2] = run_expm(inputs, tokenizer, 
-                                                        saeActvs_by_layer_1[layer_id],
-                                                        saeActvs_by_layer_2[layer_id_2], 
-                                                        num_rand_runs=num_rand_runs, oneToOne_bool=oneToOne_bool)
-            
+        for layer_id_2 in model_B_layers:
+            print("Model A Layer: " + str(layer_id) + ", Model B Layer: " + str(layer_id_2))
             for key, value in model_layer_to_dictscores[layer_id][layer_id_2].items():
                 print(key + ": " + str(value))
-
-            with open(f'{sae_name}_{sae_name_2}_multL_scores.pkl', 'wb') as f: # override prev save at each new score
-                pickle.dump(model_layer_to_dictscores, f)
+    # e.g. layer_to_dictscores(ResultsStore(results_db).query(sae_A=sae_name, sae_B=sae_name_2)) for plot_fns
+    print(f"scores stored in {results_db}")
 
 
 if __name__ == "__main__":
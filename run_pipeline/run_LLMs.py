@@ -1,5 +1,6 @@
 import gc
 import pickle
+from functools import partial
 import numpy as np
 import matplotlib.pyplot as plt
 from fnmatch import fnmatch
@@ -31,6 +32,8 @@ from interpret_fns import *
 from get_actv_fns import get_sae_actvs
 from run_expm_fns import *
 from plot_fns import *
+from grid_fns import run_layer_grid
+from results_fns import ResultsStore
 
 import argparse
 
@@ -74,8 +77,8 @@ def main():
     sae_name_B = "gemma-scope-9b-pt-mlp-canonical"
     sae_lib_B = "sae_lens"
 
-    dataset = "Skylion007/openwebtext"
-    # dataset = "togethercomputer/RedPajama-Data-1T-Sample"
+    dataset_name = "Skylion007/openwebtext"
+    # dataset_name = "togethercomputer/RedPajama-Data-1T-Sample"
 
     # Since we are comparing layer 3 SAEs, set the start and end layers accordingly.
     ## pythia
@@ -122,8 +125,12 @@ def main():
     max_length = 100
     num_rand_runs = 1
     oneToOne_bool = True
+    kw_filter_bool = False  # keyword filter of the matched pairs (see run_expm); on changes the scores
     compare_SAEs_bool = True
     compare_MLPs_bool = True
+    num_workers = 1  # processes scoring layer pairs (0: all in this process)
+    work_dir = '.'
+    results_db = 'results.sqlite'  # SQLite results store (see results_fns)
 
     ### Load base language models and tokenizers
     model_A = AutoModelForCausalLM.from_pretrained(model_name_A)
@@ -151,7 +158,7 @@ def main():
 
     ### Load data using a streaming dataset.
     from datasets import load_dataset
-    dataset = load_dataset(dataset, split="train", streaming=True, trust_remote_code=True)
+    dataset = load_dataset(dataset_name, split="train", streaming=True, trust_remote_code=True)
 
     def get_next_batch(dataset, batch_size=100, max_length=100):
         batch = []
@@ -167,102 +174,45 @@ def main():
 
     _, inputs = get_next_batch(dataset, batch_size=batch_size, max_length=max_length)
 
-    ### Process SAE activations for each model.
+    ### Activations of each layer, extracted by the grid tasks (in this process, as they need the models)
     if compare_SAEs_bool:
-        print("Storing SAE activations for Model A")
-        actvs_by_layer_A = {}
-        for layer_id in model_A_layers:
-            print("Model A Layer: " + str(layer_id))
-            with torch.inference_mode():
-                weight_matrix, reshaped_activations, feature_acts_model = get_sae_actvs(
-                    model_A, 
-                    model_name_A,
-                    sae_name_A, 
-                    inputs, 
-                    layer_id, 
-                    batch_size=32,
-                    sae_lib=sae_lib_A,
-                    compare_MLPs_bool=compare_MLPs_bool
-                )
-                actvs_by_layer_A[layer_id] = (weight_matrix, reshaped_activations, feature_acts_model)
-
-        # with open('actvs_by_layer_A.pkl', 'wb') as f:
-        #     pickle.dump(actvs_by_layer_A, f)
-
-        print("Storing SAE activations for Model B")
-        actvs_by_layer_B = {}
-        for layer_id in model_B_layers:
-            print("Model B Layer: " + str(layer_id))
-            with torch.inference_mode():
-                weight_matrix, reshaped_activations, feature_acts_model = get_sae_actvs(
-                    model_B, 
-                    model_name_B,
-                    sae_name_B, 
-                    inputs, 
-                    layer_id, 
-                    batch_size=32,
-                    sae_lib=sae_lib_B,
-                    compare_MLPs_bool=compare_MLPs_bool
-                )
-                actvs_by_layer_B[layer_id] = (weight_matrix, reshaped_activations, feature_acts_model)
-
-        # with open('actvs_by_layer_B.pkl', 'wb') as f:
-        #     pickle.dump(actvs_by_layer_B, f)
-        
-        sae_name_A = sae_name_A.replace('/', '_')
-        sae_name_B = sae_name_B.replace('/', '_')
+        name_A, name_B = sae_name_A, sae_name_B
+        extract_fns_A = {layer_id: partial(get_sae_actvs, model_A, model_name_A, sae_name_A, inputs, layer_id,
+                                           batch_size=32, sae_lib=sae_lib_A, compare_MLPs_bool=compare_MLPs_bool)
+                         for layer_id in model_A_layers}
+        extract_fns_B = {layer_id: partial(get_sae_actvs, model_B, model_name_B, sae_name_B, inputs, layer_id,
+                                           batch_size=32, sae_lib=sae_lib_B, compare_MLPs_bool=compare_MLPs_bool)
+                         for layer_id in model_B_layers}
     else:
-        actvs_by_layer_A = {}
-        for layer_id in model_A_layers:
-            print("Model A Layer: " + str(layer_id))
-            with torch.inference_mode():
-                weight_matrix, reshaped_activations, feature_acts_model = get_LLM_MLP_actvs(model_A, model_name_A, 
-                                                                                            layer_id, inputs)
-                actvs_by_layer_A[layer_id] = (weight_matrix, reshaped_activations, feature_acts_model)
+        name_A, name_B = model_name_A, model_name_B
+        extract_fns_A = {layer_id: partial(get_LLM_MLP_actvs, model_A, model_name_A, layer_id, inputs)
+                         for layer_id in model_A_layers}
+        extract_fns_B = {layer_id: partial(get_LLM_MLP_actvs, model_B, model_name_B, layer_id, inputs)
+                         for layer_id in model_B_layers}
 
-        actvs_by_layer_B = {}
-        for layer_id in model_B_layers:
-            print("Model B Layer: " + str(layer_id))
-            with torch.inference_mode():
-                weight_matrix, reshaped_activations, feature_acts_model = get_LLM_MLP_actvs(model_B, model_name_B,
-                                                                                            layer_id, inputs)
-                actvs_by_layer_B[layer_id] = (weight_matrix, reshaped_activations, feature_acts_model)
-
-        model_name_A = model_name_A.replace('/', '_')
-        model_name_B = model_name_B.replace('/', '_')
+    vocab = get_vocab_table(tokenizer, cache_dir=work_dir)
 
     ### Run experiment comparing the two models’ SAE activations.
     print("Running experiment")
 
-    model_layer_to_dictscores = {}
+    # each finished task is appended to a task log in work_dir; a killed run started again resumes from it
+    model_layer_to_dictscores = run_layer_grid(
+        name_A, extract_fns_A, name_B, extract_fns_B, inputs, tokenizer, work_dir=work_dir,
+        config={'dataset': dataset_name, 'batch_size': batch_size, 'max_length': max_length,
+                'compare_MLPs_bool': compare_MLPs_bool},
+        num_workers=num_workers, vocab=vocab, num_rand_runs=num_rand_runs, oneToOne_bool=oneToOne_bool,
+        kw_filter_bool=kw_filter_bool, store=ResultsStore(results_db),
+        store_key={'model_A': model_name_A, 'model_B': model_name_B,
+                   'sae_A': sae_name_A if compare_SAEs_bool else None,
+                   'sae_B': sae_name_B if compare_SAEs_bool else None})
 
     for layer_id in model_A_layers:
-        print("Model A Layer: " + str(layer_id))
-        model_layer_to_dictscores[layer_id] = {}
         for layer_id_2 in model_B_layers:
-            print("Model B Layer: " + str(layer_id_2))
-            model_layer_to_dictscores[layer_id][layer_id_2] = run_expm(
-                inputs, tokenizer, 
-                actvs_by_layer_A[layer_id],
-                actvs_by_layer_B[layer_id_2], 
-                num_rand_runs=num_rand_runs, 
-                oneToOne_bool=oneToOne_bool
-            )
+            print("Model A Layer: " + str(layer_id) + ", Model B Layer: " + str(layer_id_2))
             for key, value in model_layer_to_dictscores[layer_id][layer_id_2].items():
                 print(key + ": " + str(value))
             print("\n")
-            if compare_SAEs_bool:
-                with open(f'{sae_name_A}_{sae_name_B}_multL_scores.pkl', 'wb') as f:
-                    pickle.dump(model_layer_to_dictscores, f)
-            else:
-                with open(f'{model_name_A}_{model_name_B}_multL_scores.pkl', 'wb') as f:
-                    pickle.dump(model_layer_to_dictscores, f)
-    if compare_SAEs_bool:
-        with open(f'{sae_name_A}_{sae_name_B}_multL_scores.pkl', 'wb') as f:
-            pickle.dump(model_layer_to_dictscores, f)
-    else:
-        with open(f'{model_name_A}_{model_name_B}_multL_scores.pkl', 'wb') as f:
-            pickle.dump(model_layer_to_dictscores, f)
+    print(f"scores stored in {results_db}")
 
 if __name__ == "__main__":
     main()
@@ -6,9 +6,63 @@ from get_rand_fns import *
 from interpret_fns import *
 from get_actv_fns import *
 from plot_fns import *
+from vocab_fns import *
+from pairing_fns import *
+from topk_index_fns import *
+
+# rsa_method of run_expm: 'full' builds both N x N RSMs; 'sampled' / 'exact' are for large N (e.g. Gemma Scope SAEs)
+rsa_fns = {
+    'full': representational_similarity_analysis,
+    'sampled': rsa_sampled_score,
+    'exact': rsa_exact_blocked,
+}
+
+def threshold_sweep(weight_matrix_1, weight_matrix_2, pair_ind_A, pair_ind_B, pair_vals, corr_thresholds,
+                    metrics=('svcca',)):
+    """
+    Low correlation filtering (keep pairs with corr > thresh) for a grid of thresholds in one pass. The pairs are
+    sorted by corr once, so the pairs kept at each threshold are a prefix of that order:
+        num_feats_curve / mean_corr_curve: kept-feature count and mean filtered corr when keeping the top n pairs,
+            for every n (i.e. every possible threshold), from cumulative sums
+        per threshold in corr_thresholds: num_feats, mean_actv_corr_filt and the paired score of each metric
+            ('svcca', 'rsa'), computed over the nested prefixes with svcca_nested_prefixes / rsa_nested_prefixes
+    """
+    pair_ind_A, pair_ind_B, pair_vals = np.asarray(pair_ind_A), np.asarray(pair_ind_B), np.asarray(pair_vals)
+    order = np.argsort(-pair_vals, kind='stable')
+    sorted_A, sorted_B, sorted_vals = pair_ind_A[order], pair_ind_B[order], pair_vals[order]
+
+    num_feats_curve = np.arange(1, len(sorted_vals) + 1)
+    mean_corr_curve = np.cumsum(sorted_vals) / num_feats_curve
+
+    thresholds = np.sort(np.asarray(corr_thresholds, dtype=np.float64))
+    num_kept = np.searchsorted(-sorted_vals, -thresholds, side='left')  # number of pairs with corr > thresh
+    sweep = {
+        "corr_thresholds": thresholds.tolist(),
+        "num_feats": num_kept.tolist(),
+        "mean_actv_corr_filt": [mean_corr_curve[n - 1] if n > 0 else np.nan for n in num_kept],
+        "num_feats_curve": num_feats_curve,
+        "corr_curve": sorted_vals,
+        "mean_corr_curve": mean_corr_curve,
+    }
+
+    R, Rp = weight_matrix_1[sorted_A[:num_kept.max(initial=0)]], weight_matrix_2[sorted_B[:num_kept.max(initial=0)]]
+    for metric in metrics:
+        if metric == 'svcca':
+            sweep["svcca_paired"] = svcca_nested_prefixes(R, Rp, num_kept)
+        elif metric == 'rsa':
+            sweep["rsa_paired"] = rsa_nested_prefixes(R, Rp, num_kept)
+        else:
+            raise ValueError(f"Unknown sweep metric: {metric}")
+    return sweep
 
-def run_expm(inputs, tokenizer, saeActvs_1, saeActvs_2, num_rand_runs=100, 
-             oneToOne_bool=False, manyA_1B_bool=True, nonconc_words=[], rand_baselines_bool=True):
+def correlate_pairs(inputs, tokenizer, saeActvs_1, saeActvs_2, oneToOne_bool=False, manyA_1B_bool=True, vocab=None,
+                    oneToOne_method='first', assign_topk=10, corr_threshold=0.1, corr_thresholds=None,
+                    sweep_metrics=('svcca',), top_acts_indexes=None, kw_filter_bool=False):
+    """
+    Correlation and filtering stage of run_expm (args as there).
+    Returns (dictscores with the pair counts and mean corrs, feats of A, feats of B), the last two being the
+    parallel lists of the pairs kept by every filter.
+    """
     nonconc_words = ['.', '\\n', '\n', '', ' ', '-', ',', '!', '?', '<|endoftext|>' , '<bos>', '|bos|', '<pad>']
     # nonconc_words = ['.', '\\n', '\n', '<|endoftext|>' , '<bos>', '|bos|', '<pad>']
     dictscores = {}
@@ -23,9 +77,16 @@ def run_expm(inputs, tokenizer, saeActvs_1, saeActvs_2, num_rand_runs=100,
     Use the list with smaller number of features (decoder mat cols) as the second arg
     """
     if manyA_1B_bool:
-        max_corr_inds, max_corr_vals = batched_correlation(reshaped_activations_A, reshaped_activations_B)
+        corr_actvs = (reshaped_activations_A, reshaped_activations_B)
+    else:
+        corr_actvs = (reshaped_activations_B, reshaped_activations_A)
+
+    assign_bool = oneToOne_bool and oneToOne_method in ('hungarian', 'greedy')
+    if assign_bool:
+        topk_corr_inds, topk_corr_vals = batched_correlation_topk(*corr_actvs, k=assign_topk)
+        max_corr_inds, max_corr_vals = topk_corr_inds[:, 0], topk_corr_vals[:, 0]
     else:
-        max_corr_inds, max_corr_vals = batched_correlation(reshaped_activations_B, reshaped_activations_A)
+        max_corr_inds, max_corr_vals = batched_correlation(*corr_actvs)
 
     dictscores["mean_actv_corr"] = sum(max_corr_vals) / len(max_corr_vals)
 
@@ -34,94 +95,64 @@ def run_expm(inputs, tokenizer, saeActvs_1, saeActvs_2, num_rand_runs=100,
     dictscores["num_feat_unique_beforeFilt"] = num_unq_pairs
     dictscores["total_feats_beforeFilt"] = len(max_corr_inds)
 
+    # pairs are kept as parallel arrays (A feat, B feat, corr); every filter below is a mask over them
+    if assign_bool:
+        one_inds, many_inds, pair_vals = assign_feats(topk_corr_inds, topk_corr_vals, method=oneToOne_method)
+        pair_ind_A, pair_ind_B = (many_inds, one_inds) if manyA_1B_bool else (one_inds, many_inds)
+    else:
+        pair_ind_A, pair_ind_B = many_to_one_pairs(max_corr_inds, manyA_1B_bool)
+        pair_vals = np.asarray(max_corr_vals)
+
     ########### filter ###########
     ### keyword filtering ###
     samp_m = 5
 
-    if nonconc_words:
-        filt_corr_ind_A = []
-        filt_corr_ind_B = []
-        for corr_ind_feat, corr_val_feat in enumerate(max_corr_inds):
-            if manyA_1B_bool:
-                feat_B, feat_A = corr_ind_feat, corr_val_feat
-            else:
-                feat_A, feat_B = corr_ind_feat, corr_val_feat
-            ds_top_acts_indices = highest_activating_tokens(feature_acts_model_A, feat_A, samp_m, batch_tokens= inputs['input_ids'])
-            top_A_labels = store_top_toks(ds_top_acts_indices, inputs['input_ids'], tokenizer)
-
-            ds_top_acts_indices = highest_activating_tokens(feature_acts_model_B, feat_B, samp_m, batch_tokens= inputs['input_ids'])
-            top_B_labels = store_top_toks(ds_top_acts_indices, inputs['input_ids'], tokenizer)
-
-            flag = True
-            for filt_word in nonconc_words:
-                if filt_word in top_A_labels or filt_word in top_B_labels:
-                    flag = False
-                    break
-            if flag and len(set(top_A_labels).intersection(set(top_B_labels))) > 0:
-                filt_corr_ind_A.append(feat_A)
-                filt_corr_ind_B.append(feat_B)
+    if kw_filter_bool and nonconc_words:
+        if vocab is None:
+            vocab = get_vocab_table(tokenizer)
+        # one topk over all features per model (or an index lookup), then index the matched pairs' rows
+        if top_acts_indexes is not None:
+            top_A_tok_ids = top_acts_indexes[0].top_token_ids(inputs['input_ids'], samp_m)
+            top_B_tok_ids = top_acts_indexes[1].top_token_ids(inputs['input_ids'], samp_m)
         else:
-            filt_corr_ind_A = max_corr_inds
-            filt_corr_ind_B = list(range(len(max_corr_inds)))
+            top_A_tok_ids = highest_activating_tokens_allFeats(feature_acts_model_A, samp_m, batch_tokens=inputs['input_ids'])
+            top_B_tok_ids = highest_activating_tokens_allFeats(feature_acts_model_B, samp_m, batch_tokens=inputs['input_ids'])
+        keep_mask = keyword_filter_mask(top_A_tok_ids[pair_ind_A], top_B_tok_ids[pair_ind_B],
+                                        inputs['input_ids'], tokenizer, nonconc_words, vocab=vocab)
+        # drops pairs with a nonconc word among either side's top tokens, or with no top token in common
+        pair_ind_A, pair_ind_B, pair_vals = pair_ind_A[keep_mask], pair_ind_B[keep_mask], pair_vals[keep_mask]
 
     if manyA_1B_bool:
-        num_unq_pairs = len(list(set(filt_corr_ind_B)))
+        num_unq_pairs = len(list(set(pair_ind_B)))
         print("% unique after rmv kw: ", num_unq_pairs / len(max_corr_inds))
-        print("num feats after rmv kw: ", len(filt_corr_ind_B))
-        dictscores["num_feat_after_rmv_kw"] = len(filt_corr_ind_B) 
+        print("num feats after rmv kw: ", len(pair_ind_B))
+        dictscores["num_feat_after_rmv_kw"] = len(pair_ind_B) 
     else:
-        num_unq_pairs = len(list(set(filt_corr_ind_A)))
+        num_unq_pairs = len(list(set(pair_ind_A)))
         print("% unique after rmv kw: ", num_unq_pairs / len(max_corr_inds))
-        print("num feats after rmv kw: ", len(filt_corr_ind_A))
-        dictscores["num_feat_after_rmv_kw"] = len(filt_corr_ind_A)
+        print("num feats after rmv kw: ", len(pair_ind_A))
+        dictscores["num_feat_after_rmv_kw"] = len(pair_ind_A)
 
     ### 1-1 filtering ###
     if oneToOne_bool:
-        sorted_feat_counts = Counter(max_corr_inds).most_common()
-        kept_modA_feats = [feat_ID for feat_ID, count in sorted_feat_counts if count == 1]
-
-        oneToOne_A = []
-        oneToOne_B = []
-        seen = set()
-        for ind_A, ind_B in zip(filt_corr_ind_A, filt_corr_ind_B):
-            if manyA_1B_bool:
-                if ind_A in kept_modA_feats:
-                    oneToOne_A.append(ind_A)
-                    oneToOne_B.append(ind_B)
-                elif ind_A not in seen:  # only keep one if it's over count X
-                    seen.add(ind_A)
-                    oneToOne_A.append(ind_A)
-                    oneToOne_B.append(ind_B)
-            else:
-                if ind_B in kept_modA_feats:
-                    oneToOne_A.append(ind_A)
-                    oneToOne_B.append(ind_B)
-                elif ind_B not in seen:
-                    seen.add(ind_B) # only keep one if it's over count X
-                    oneToOne_A.append(ind_A)
-                    oneToOne_B.append(ind_B)
-
-        num_unq_pairs = len(list(set(oneToOne_A)))
-        print("num feats after 1-1: ", len(oneToOne_A))
-        dictscores["num_feat_1_to_1"] = len(oneToOne_A)
-
-        filt_corr_ind_A = oneToOne_A
-        filt_corr_ind_B = oneToOne_B
+        if not assign_bool:  # assigned pairs are already 1-1
+            # keep a "many" feat in all its pairs only if it was matched once before filtering, else only its first pair
+            keep_mask = one_to_X_mask(pair_ind_A if manyA_1B_bool else pair_ind_B, 1, count_inds=max_corr_inds)
+            pair_ind_A, pair_ind_B, pair_vals = pair_ind_A[keep_mask], pair_ind_B[keep_mask], pair_vals[keep_mask]
+
+        print("num feats after 1-1: ", len(pair_ind_A))
+        dictscores["num_feat_1_to_1"] = len(pair_ind_A)
 
     ### low correlation filtering ###
-    new_max_corr_inds_A = []
-    new_max_corr_inds_B = []
-    new_max_corr_vals = []
+    if corr_thresholds is not None:
+        dictscores["threshold_sweep"] = threshold_sweep(weight_matrix_1, weight_matrix_2, pair_ind_A, pair_ind_B,
+                                                        pair_vals, corr_thresholds, metrics=sweep_metrics)
+        print('threshold sweep done')
 
-    for ind_A, ind_B in zip(filt_corr_ind_A, filt_corr_ind_B):
-        if manyA_1B_bool:
-            val = max_corr_vals[ind_B]
-        else:
-            val = max_corr_vals[ind_A]
-        if val > 0.1:
-            new_max_corr_inds_A.append(ind_A)
-            new_max_corr_inds_B.append(ind_B)
-            new_max_corr_vals.append(val)
+    keep_mask = pair_vals > corr_threshold
+    new_max_corr_inds_A = pair_ind_A[keep_mask].tolist()
+    new_max_corr_inds_B = pair_ind_B[keep_mask].tolist()
+    new_max_corr_vals = pair_vals[keep_mask]
 
     # num_unq_pairs = len(list(set(new_max_corr_inds_A)))
     # print("% unique after rmv 0s: ", num_unq_pairs / new_max_corr_inds_A)
@@ -130,31 +161,82 @@ def run_expm(inputs, tokenizer, saeActvs_1, saeActvs_2, num_rand_runs=100,
 
     dictscores["mean_actv_corr_filt"] = sum(new_max_corr_vals) / len(new_max_corr_vals)
 
-    ########### repr similarity scores ###########
-
-    num_feats = len(new_max_corr_inds_A)
+    return dictscores, new_max_corr_inds_A, new_max_corr_inds_B
 
-    dictscores["svcca_paired"] = svcca(weight_matrix_1[new_max_corr_inds_A], weight_matrix_2[new_max_corr_inds_B], "nd")
+def paired_scores(weight_matrix_1, weight_matrix_2, inds_A, inds_B, rsa_method=None):
+    # repr similarity scores of the matched pairs (rows inds_A of weight_matrix_1 vs rows inds_B of weight_matrix_2)
+    dictscores = {}
+    dictscores["svcca_paired"] = svcca(weight_matrix_1[inds_A], weight_matrix_2[inds_B], "nd")
     print('svcca paired done')
-    if rand_baselines_bool:
-        rand_scores = shuffle_rand(num_rand_runs, weight_matrix_1[new_max_corr_inds_A],
-                                    weight_matrix_2[new_max_corr_inds_B], num_feats,
-                                    svcca, shapereq_bool=True)
-        dictscores["svcca_rand_mean"] = sum(rand_scores) / len(rand_scores)
-        dictscores["svcca_rand_pval"] =  np.mean(np.array(rand_scores) >= dictscores["svcca_paired"])
+
+    if rsa_method is not None:
+        if rsa_method == 'sampled':
+            dictscores["rsa_paired"], dictscores["rsa_paired_ci"] = rsa_sampled(
+                weight_matrix_1[inds_A], weight_matrix_2[inds_B], "nd")
+        else:
+            dictscores["rsa_paired"] = rsa_fns[rsa_method](weight_matrix_1[inds_A], weight_matrix_2[inds_B], "nd")
+        print('rsa paired done')
+    return dictscores
+
+def rand_baseline_scores(weight_matrix_1, weight_matrix_2, inds_A, inds_B, paired, num_rand_runs=100,
+                         rsa_method=None, sequential_pval_bool=False, rand_num_workers=None):
+    """
+    Random baselines of the paired scores: mean and p-value of each metric over row shuffles of the matched pairs.
+    paired: the paired_scores output
+    rand_num_workers: score the shuffles on a pool of this many processes (see get_rand_fns.shuffle_rand); not used
+        with sequential_pval_bool, which scores a few runs at a time
+    """
+    dictscores = {}
+    num_feats = len(inds_A)
+    metrics = [("svcca", svcca)] + ([("rsa", rsa_fns[rsa_method])] if rsa_method is not None else [])
+    for metric, sim_fn in metrics:
+        if sequential_pval_bool:
+            null = sequential_shuffle_rand(num_rand_runs, weight_matrix_1[inds_A], weight_matrix_2[inds_B], num_feats,
+                                           sim_fn, True, paired[f"{metric}_paired"])
+            dictscores[f"{metric}_rand_mean"] = null.mean
+            dictscores[f"{metric}_rand_pval"] = null.seq_pval
+            dictscores[f"{metric}_rand_num_runs"] = null.num_done
+            dictscores[f"{metric}_rand_num_failed"] = len(null.failures)
+        else:
+            rand_scores = shuffle_rand(num_rand_runs, weight_matrix_1[inds_A], weight_matrix_2[inds_B], num_feats,
+                                       sim_fn, shapereq_bool=True, num_workers=rand_num_workers)
+            dictscores[f"{metric}_rand_mean"] = sum(rand_scores) / len(rand_scores)
+            dictscores[f"{metric}_rand_pval"] = np.mean(np.array(rand_scores) >= paired[f"{metric}_paired"])
 
     # sel_rand_scores = score_rand(num_rand_runs, weight_matrix_1, weight_matrix_2,
     #                                             num_feats, svcca, shapereq_bool=True)
     # dictscores["svcca_sel_rand_mean"] = sum(sel_rand_scores) / len(sel_rand_scores)
     # dictscores["svcca_sel_rand_pval"] =  np.mean(np.array(sel_rand_scores) >= dictscores["svcca_paired"])
+    return dictscores
 
-    # dictscores["rsa_paired"] = representational_similarity_analysis(weight_matrix_1[new_max_corr_inds_A], weight_matrix_2[new_max_corr_inds_B], "nd")
-    # print('rsa paired done')
-    # if rand_baselines_bool:
-    #     rand_scores = shuffle_rand(num_rand_runs, weight_matrix_1[new_max_corr_inds_A],
-    #                                                 weight_matrix_2[new_max_corr_inds_B], num_feats,
-    #                                                 representational_similarity_analysis, shapereq_bool=True)
-    #     dictscores["rsa_rand_mean"] = sum(rand_scores) / len(rand_scores)
-    #     dictscores["rsa_rand_pval"] =  np.mean(np.array(rand_scores) >= dictscores["rsa_paired"])
-
-    return dictscores
\ No newline at end of file
+def run_expm(inputs, tokenizer, saeActvs_1, saeActvs_2, num_rand_runs=100, 
+             oneToOne_bool=False, manyA_1B_bool=True, nonconc_words=[], rand_baselines_bool=True, vocab=None,
+             oneToOne_method='first', assign_topk=10, corr_threshold=0.1, corr_thresholds=None,
+             sweep_metrics=('svcca',), rsa_method=None, sequential_pval_bool=False, top_acts_indexes=None,
+             kw_filter_bool=False, rand_num_workers=None):
+    """
+    kw_filter_bool: drop the pairs whose A or B feature has a nonconc word among its top tokens, or whose features
+        share no top token. Off by default: the original filter loop's for/else always put the unfiltered pairs back,
+        so the published scores are unfiltered. Turning it on changes num_feat_after_rmv_kw and every later score.
+    corr_threshold: pairs with corr <= corr_threshold are filtered out before the similarity scores
+    corr_thresholds: if given, dictscores["threshold_sweep"] also has the scores for each of these thresholds,
+        see threshold_sweep
+    rsa_method: None (no RSA), or a key of rsa_fns. 'sampled' also stores a confidence interval in "rsa_paired_ci"
+    top_acts_indexes: (TopActivationsIndex of A, of B) built by get_sae_actvs over the same inputs; the keyword
+        filter then reads the top tokens from them instead of running a topk over the feature_acts
+    sequential_pval_bool: stop the random baseline runs early once the p-value is settled (see
+        get_rand_fns.sequential_pval); the number of runs used is stored in "*_rand_num_runs"
+    rand_num_workers: processes scoring the random baseline runs, see rand_baseline_scores
+    oneToOne_method (only used if oneToOne_bool):
+        'first': keep the first pair of each "many" feat (order-dependent)
+        'hungarian' / 'greedy': max-corr 1-1 assignment on the top `assign_topk` correlated candidates of each feat,
+            see pairing_fns.assign_feats
+    """
+    dictscores, inds_A, inds_B = correlate_pairs(
+        inputs, tokenizer, saeActvs_1, saeActvs_2, oneToOne_bool, manyA_1B_bool, vocab, oneToOne_method, assign_topk,
+        corr_threshold, corr_thresholds, sweep_metrics, top_acts_indexes, kw_filter_bool)
+    dictscores.update(paired_scores(saeActvs_1[0], saeActvs_2[0], inds_A, inds_B, rsa_method))
+    if rand_baselines_bool:
+        dictscores.update(rand_baseline_scores(saeActvs_1[0], saeActvs_2[0], inds_A, inds_B, dictscores,
+                                               num_rand_runs, rsa_method, sequential_pval_bool, rand_num_workers))
+    return dictscores
@@ -40,6 +40,7 @@ from experiment_config import config
 
 def main():
     # --- Set model and experiment parameters --- 
+    # To run several of the pairs below in one run, list them in a spec instead (see run_spec.py, specs/)
     # For this experiment we compare the SAE used for pythia-70m at layer 3.
     # model_name_A = "EleutherAI/pythia-160m"
     model_name_A = "EleutherAI/pythia-70m"
@@ -188,6 +189,8 @@ def main():
     sae_name_B = sae_name_B.replace('/', '_')
 
     model_layer_to_dictscores = {}
+    # in memory only: this script keeps the activations in memory too, so there is no cache dir to persist it in
+    vocab = get_vocab_table(tokenizer)
 
     for layer_id in model_A_layers:
         print("Model A Layer: " + str(layer_id))
@@ -205,7 +208,8 @@ def main():
                 saeActvs_by_layer_A[layer_id],
                 saeActvs_by_layer_B[layer_id_2], 
                 num_rand_runs=num_rand_runs, 
-                oneToOne_bool=oneToOne_bool
+                oneToOne_bool=oneToOne_bool,
+                vocab=vocab
             )
             for key, value in model_layer_to_dictscores[layer_id][layer_id_2].items():
                 print(key + ": " + str(value))
@@ -0,0 +1,30 @@
+### run every model / SAE pair of an experiment spec (see spec_fns), extracting each (model, layer) once
+
+import argparse
+
+from spec_fns import run_spec
+
+"""
+example run:
+python run_spec.py --spec specs/example_pythia.toml --dry_run
+python run_spec.py --spec specs/example_pythia.toml --num_workers 2 --work_dir spec_runs
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the model / SAE pairs of an experiment spec")
+    parser.add_argument("--spec", type=str, required=True, help="Spec file (.toml, or .yaml / .yml with pyyaml)")
+    parser.add_argument("--work_dir", type=str, default=".",
+                        help="Extracted activations and the task log; a killed run started again resumes from it")
+    parser.add_argument("--results_db", type=str, default="results.sqlite",
+                        help="SQLite results store the scores are appended to (see results_fns)")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Processes scoring layer pairs while the next layers are extracted (0: all in this process)")
+    parser.add_argument("--dry_run", action="store_true", help="Only print the execution plan")
+    args = parser.parse_args()
+
+    run_spec(args.spec, work_dir=args.work_dir, results_db=args.results_db, num_workers=args.num_workers,
+             dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
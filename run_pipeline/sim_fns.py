@@ -100,13 +100,16 @@ class Pipeline:
             + ")"
         )
 
-from typing import List, Set, Union
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import numpy as np
 import numpy.typing as npt
 import sklearn.neighbors
 import torch
 
+from ann_fns import get_ann_index, report_recall
+
 # from llmcomp.measures.utils import to_numpy_if_needed
 
 
@@ -120,9 +123,16 @@ def jaccard_similarity(
     k: int = 10,
     inner: str = "cosine",
     n_jobs: int = 8,
+    index_kind: str = "exact",
 ) -> float:
+    # index_kind (for inner="cosine"): "exact" blocked k-NN, or "ivf" for the approximate ann_fns.IVFIndex
     R, Rp = to_numpy_if_needed(R, Rp)
 
+    if inner == "cosine" and index_kind == "ivf":
+        return jaccard_from_neighbors(ann_self_neighbors(R, k), ann_self_neighbors(Rp, k))
+    if inner == "cosine":
+        return jaccard_from_neighbors(cached_cosine_neighbors(R, k), cached_cosine_neighbors(Rp, k))
+
     indices_R = nn_array_to_setlist(top_k_neighbors(R, k, inner, n_jobs))
     indices_Rp = nn_array_to_setlist(top_k_neighbors(Rp, k, inner, n_jobs))
 
@@ -153,6 +163,91 @@ def top_k_neighbors(
 def nn_array_to_setlist(nn: npt.NDArray) -> List[Set[int]]:
     return [set(idx) for idx in nn]
 
+
+def cosine_topk_neighbors(
+    R: Union[torch.Tensor, npt.NDArray],
+    k: int,
+    block_size: int = 4096,
+    device: Optional[str] = None,
+) -> npt.NDArray:
+    """Exact k nearest neighbors by cosine similarity, excluding the point itself (as top_k_neighbors).
+
+    Blocked: each tile of rows is one normalized matmul against all rows plus torch.topk, so memory is
+    block_size x N. Zero rows have similarity 0 to everything, as with sklearn's cosine distance.
+    """
+    R = (R if isinstance(R, torch.Tensor) else torch.from_numpy(np.asarray(R))).to(device=device, dtype=torch.float32)
+    R = R / R.norm(dim=1, keepdim=True).clamp_min(torch.finfo(R.dtype).tiny)
+    N = R.shape[0]
+
+    nns = torch.empty((N, k), dtype=torch.int64)
+    for b0 in range(0, N, block_size):
+        b1 = min(b0 + block_size, N)
+        sims = R[b0:b1] @ R.T
+        sims[torch.arange(b1 - b0), torch.arange(b0, b1)] = -torch.inf
+        nns[b0:b1] = torch.topk(sims, k, dim=1).indices.cpu()
+    return nns.numpy()
+
+
+# neighbor lists per (matrix contents, k), so e.g. permutation baselines reuse them
+_cosine_neighbors_cache: Dict[Tuple[str, int], npt.NDArray] = {}
+
+
+def cached_cosine_neighbors(R: npt.NDArray, k: int) -> npt.NDArray:
+    R = np.ascontiguousarray(R)
+    key = (hashlib.sha1(R.view(np.uint8)).hexdigest() + str(R.shape) + str(R.dtype), k)
+    if key not in _cosine_neighbors_cache:
+        _cosine_neighbors_cache[key] = cosine_topk_neighbors(R, k)
+    return _cosine_neighbors_cache[key]
+
+
+def ann_self_neighbors(
+    R: npt.NDArray, k: int, metric: str = "cosine", cache_dir: Optional[str] = None
+) -> npt.NDArray:
+    """Approximate k-NN of every row of R among the other rows, from the IVF index of R (persisted in cache_dir if
+    given). Rows with fewer than k candidates in their probed lists are padded with -1. The index's recall@k against
+    exact search is printed once per index and k (ann_fns.report_recall)."""
+    index = get_ann_index(R, "ivf", metric=metric, cache_dir=cache_dir)
+    report_recall(index, R, k)
+    return index.query(R, k, query_ids=np.arange(R.shape[0]))[0]
+
+
+def jaccard_from_neighbors(nn: npt.NDArray, nn_p: npt.NDArray) -> float:
+    """Mean over rows of |nn[i] & nn_p[i]| / |nn[i] | nn_p[i]| (i.e. _jac_sim_i over the rows), vectorized.
+
+    Each neighbor index is offset by row * N so that one np.intersect1d over the sorted flattened arrays finds the
+    shared neighbors of every row at once. -1 entries (padding of IVFIndex.query) are not neighbors and are left out.
+    """
+    valid, valid_p = nn >= 0, nn_p >= 0
+    N = max(nn.max(initial=0), nn_p.max(initial=0)) + 1
+    row_offsets = np.arange(nn.shape[0])[:, None] * N
+    shared = np.intersect1d((nn + row_offsets)[valid], (nn_p + row_offsets)[valid_p], assume_unique=True)
+    num_shared = np.bincount(shared // N, minlength=nn.shape[0])
+    # the neighbors of a point are distinct, so |union| = |nn[i]| + |nn_p[i]| - |shared| (0 only if both are empty)
+    num_union = valid.sum(axis=1) + valid_p.sum(axis=1) - num_shared
+    return float(np.mean(num_shared / np.maximum(num_union, 1)))
+
+
+def jaccard_permutation_scores(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    perms,
+    k: int = 10,
+) -> list:
+    """jaccard_similarity(R, Rp[perm], k) (cosine) for every row permutation perm in perms.
+
+    Row i of Rp[perm] is row perm[i] of Rp, and Rp's row j is row inv_perm[j] of Rp[perm], so the neighbors of
+    Rp[perm] are inv_perm[nn_p[perm]]: the cached neighbor lists are only relabeled, never recomputed.
+    """
+    R, Rp = to_numpy_if_needed(R, Rp)
+    nn, nn_p = cached_cosine_neighbors(R, k), cached_cosine_neighbors(Rp, k)
+    scores = []
+    for perm in perms:
+        perm = np.asarray(perm)
+        inv_perm = np.empty_like(perm)
+        inv_perm[perm] = np.arange(len(perm))
+        scores.append(jaccard_from_neighbors(nn, inv_perm[nn_p[perm]]))
+    return scores
+
 import functools
 import logging
 from abc import ABC
@@ -547,6 +642,264 @@ def representational_similarity_analysis(
         raise ValueError(f"Unknown outer similarity function: {outer}")
 
 
+def rsa_nested_prefixes(R, Rp, prefix_sizes, n_jobs=None):
+    """representational_similarity_analysis(R[:n], Rp[:n], "nd") for every n in prefix_sizes.
+
+    With inner="correlation" each row is centered on its own, so the RSM of a prefix is the leading block of the
+    RSM of the largest prefix: the RSMs are computed once and only the spearman correlation is redone per prefix.
+    """
+    R, Rp = to_numpy_if_needed(R, Rp)
+    n_max = max(int(n) for n in prefix_sizes) if len(prefix_sizes) else 0
+    R, Rp = R[:n_max], Rp[:n_max]
+    R = R - R.mean(axis=1, keepdims=True)
+    Rp = Rp - Rp.mean(axis=1, keepdims=True)
+    S = 1 - sklearn.metrics.pairwise_distances(R, metric="cosine", n_jobs=n_jobs)  # type:ignore
+    Sp = 1 - sklearn.metrics.pairwise_distances(Rp, metric="cosine", n_jobs=n_jobs)  # type:ignore
+
+    scores = []
+    for n in prefix_sizes:
+        n = int(n)
+        if n < 3:  # need at least 2 RSM entries
+            scores.append(np.nan)
+            continue
+        scores.append(scipy.stats.spearmanr(scipy.spatial.distance.squareform(S[:n, :n], checks=False),
+                                            scipy.spatial.distance.squareform(Sp[:n, :n], checks=False)).statistic)
+    return scores
+
+
+def _correlation_rsm_condensed(R, n_jobs=None):
+    # condensed (upper triangle) RSM as in representational_similarity_analysis with inner="correlation"
+    R = R - R.mean(axis=1, keepdims=True)
+    return scipy.spatial.distance.squareform(
+        1 - sklearn.metrics.pairwise_distances(R, metric="cosine", n_jobs=n_jobs),  # type:ignore
+        checks=False,
+    )
+
+
+def rsa_permutation_scores(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    perms,
+    max_chunk_elems: int = 2**24,
+    n_jobs: Optional[int] = None,
+) -> list:
+    """representational_similarity_analysis(R, Rp[perm], "nd") for every row permutation perm in perms.
+
+    Permuting the rows of Rp permutes its RSM rows and columns, so its condensed RSM (and the ranks of it) is only
+    reordered: entry (i, j) becomes entry (perm[i], perm[j]). Both RSMs are computed and ranked once; each score is
+    then the Pearson correlation of the ranks, where only the dot product depends on the permutation. The dot
+    products are computed for all permutations at once over blocks of RSM rows, gathering the permuted condensed
+    indices, so at most about max_chunk_elems indices are held in memory.
+    """
+    R, Rp = flatten(R, Rp, shape="nd")
+    R, Rp = to_numpy_if_needed(R, Rp)
+    perms = np.asarray(perms, dtype=np.int64).reshape(-1, R.shape[0])
+    N = R.shape[0]
+
+    # standardized ranks: spearman = mean of the products
+    rank_x = scipy.stats.rankdata(_correlation_rsm_condensed(R, n_jobs))
+    rank_y = scipy.stats.rankdata(_correlation_rsm_condensed(Rp, n_jobs))
+    rank_x = (rank_x - rank_x.mean()) / rank_x.std()
+    rank_y = (rank_y - rank_y.mean()) / rank_y.std()
+
+    dots = np.zeros(len(perms))
+    rows_per_block = max(1, max_chunk_elems // max(1, N * len(perms)))
+    start = 0  # condensed index of the first pair in the block
+    for i0 in range(0, N - 1, rows_per_block):
+        i1 = min(i0 + rows_per_block, N - 1)
+        ii, jj = np.nonzero(np.arange(N)[None, :] > np.arange(i0, i1)[:, None])
+        ii += i0
+        lo = np.minimum(perms[:, ii], perms[:, jj])
+        hi = np.maximum(perms[:, ii], perms[:, jj])
+        cond_inds = lo * N - lo * (lo + 1) // 2 + hi - lo - 1
+        dots += rank_y[cond_inds] @ rank_x[start:start + len(ii)]
+        start += len(ii)
+    return (dots / len(rank_x)).tolist()
+
+
+##################################################################################
+# RSA for large N: the N x N RSMs are never built, only blocks of rows of them.
+
+import tempfile  # noqa:e402
+
+
+def _centered_unit_rows(R):
+    # correlation RSM entry (i, j) = dot of row-centered, unit-norm rows (zero rows give 0, as in sklearn's cosine)
+    R = R - R.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(R, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return R / norms
+
+
+def _sample_rsm_pairs(N, num_pairs, num_strata, rng):
+    """
+    Stratified sample of upper-triangle pairs (i < j): the RSM rows are split into num_strata blocks with about the
+    same number of pairs, and each block gets its share of num_pairs (proportional allocation).
+    Returns (i, j, stratum) arrays.
+    """
+    pairs_per_row = np.arange(N - 1, 0, -1)  # row i has N - 1 - i pairs
+    total_pairs = pairs_per_row.sum()
+    bounds = np.searchsorted(np.cumsum(pairs_per_row), np.linspace(0, total_pairs, num_strata + 1)[1:-1])
+    bounds = np.unique(np.concatenate([[0], bounds, [N - 1]]))
+
+    ii, jj, strata = [], [], []
+    for s, (r0, r1) in enumerate(zip(bounds[:-1], bounds[1:])):
+        weights = pairs_per_row[r0:r1]
+        num_s = max(2, int(round(num_pairs * weights.sum() / total_pairs)))
+        i = r0 + rng.choice(r1 - r0, size=num_s, p=weights / weights.sum())
+        j = i + 1 + (rng.random(num_s) * (N - 1 - i)).astype(np.int64)
+        ii.append(i)
+        jj.append(j)
+        strata.append(np.full(num_s, s))
+    return np.concatenate(ii), np.concatenate(jj), np.concatenate(strata)
+
+
+def rsa_sampled(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    shape: SHAPE_TYPE,
+    num_pairs: int = 1_000_000,
+    num_strata: int = 20,
+    confidence: Optional[float] = 0.95,
+    seed: int = 0,
+    chunk_size: int = 2**16,
+):
+    """Estimate of representational_similarity_analysis (inner="correlation", outer="spearman") for large N.
+
+    Spearman correlation over a stratified random sample of RSM entries (see _sample_rsm_pairs). Only the sampled
+    entries are computed, as dot products of the normalized rows, so memory is O(num_pairs + N * D).
+    The confidence interval is a normal interval with a delete-one-stratum jackknife standard error; since the strata
+    are blocks of RSM rows, it accounts for sampled pairs sharing rows. confidence=None skips the interval.
+
+    Returns:
+        (estimate, (ci_low, ci_high))
+    """
+    R, Rp = flatten(R, Rp, shape=shape)
+    R, Rp = to_numpy_if_needed(R, Rp)
+    R, Rp = _centered_unit_rows(R), _centered_unit_rows(Rp)
+    rng = np.random.default_rng(seed)
+    ii, jj, strata = _sample_rsm_pairs(R.shape[0], num_pairs, num_strata, rng)
+
+    s_x, s_y = np.empty(len(ii)), np.empty(len(ii))
+    for c0 in range(0, len(ii), chunk_size):
+        i, j = ii[c0:c0 + chunk_size], jj[c0:c0 + chunk_size]
+        s_x[c0:c0 + chunk_size] = np.einsum("nd,nd->n", R[i], R[j])
+        s_y[c0:c0 + chunk_size] = np.einsum("nd,nd->n", Rp[i], Rp[j])
+
+    estimate = scipy.stats.spearmanr(s_x, s_y).statistic
+    num_groups = strata.max() + 1
+    if confidence is None or num_groups < 2:
+        return estimate, (np.nan, np.nan)
+    jack = np.array([scipy.stats.spearmanr(s_x[strata != s], s_y[strata != s]).statistic for s in range(num_groups)])
+    se = np.sqrt((num_groups - 1) / num_groups * np.sum((jack - jack.mean()) ** 2))
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2)
+    return estimate, (estimate - z * se, estimate + z * se)
+
+
+def rsa_sampled_score(R, Rp, shape: SHAPE_TYPE, **kwargs) -> float:
+    # rsa_sampled without the interval, with the same signature as the other similarity functions
+    return rsa_sampled(R, Rp, shape, confidence=None, **kwargs)[0]
+
+
+def _write_condensed_rsm(R, out, block_rows):
+    # condensed correlation RSM of R, written to out block by block of RSM rows
+    N = R.shape[0]
+    start = 0
+    for i0 in range(0, N - 1, block_rows):
+        i1 = min(i0 + block_rows, N - 1)
+        upper = np.arange(N)[None, :] > np.arange(i0, i1)[:, None]
+        vals = (R[i0:i1] @ R.T)[upper]  # row-major, i.e. condensed order
+        out[start:start + len(vals)] = vals
+        start += len(vals)
+
+
+def _external_rank(vals, out, max_mem_elems, num_bins=2**16):
+    """
+    scipy.stats.rankdata(vals) (average ranks for ties) for an on-disk vals, writing the ranks to out while holding
+    at most about max_mem_elems values in memory. Values are bucketed by a fixed-width histogram; consecutive
+    buckets are grouped so each group fits in memory, and each group is gathered, ranked in memory and offset by the
+    number of smaller values. Ties always fall in the same bucket.
+    """
+    M = len(vals)
+    chunks = [(c0, min(c0 + max_mem_elems, M)) for c0 in range(0, M, max_mem_elems)]
+    lo = min(np.min(vals[c0:c1]) for c0, c1 in chunks)
+    hi = max(np.max(vals[c0:c1]) for c0, c1 in chunks)
+    scale = num_bins / (float(hi) - float(lo)) if hi > lo else 0.0
+
+    def bin_of(v):
+        return np.minimum(((v.astype(np.float64) - lo) * scale).astype(np.int64), num_bins - 1)
+
+    counts = np.zeros(num_bins, dtype=np.int64)
+    for c0, c1 in chunks:
+        counts += np.bincount(bin_of(vals[c0:c1]), minlength=num_bins)
+
+    # group consecutive bins so each group has <= max_mem_elems values (or is a single bin)
+    groups = []
+    b0 = 0
+    while b0 < num_bins:
+        b1 = b0 + 1
+        total = counts[b0]
+        while b1 < num_bins and total + counts[b1] <= max_mem_elems:
+            total += counts[b1]
+            b1 += 1
+        groups.append((b0, b1))
+        b0 = b1
+
+    num_smaller = np.concatenate([[0], np.cumsum(counts)])
+    for b0, b1 in groups:
+        if num_smaller[b1] == num_smaller[b0]:
+            continue
+        group_vals, group_inds = [], []
+        for c0, c1 in chunks:
+            chunk_bins = bin_of(vals[c0:c1])
+            sel = np.nonzero((chunk_bins >= b0) & (chunk_bins < b1))[0]
+            group_vals.append(vals[c0:c1][sel])
+            group_inds.append(c0 + sel)
+        group_inds = np.concatenate(group_inds)
+        out[group_inds] = scipy.stats.rankdata(np.concatenate(group_vals)) + num_smaller[b0]
+
+
+def rsa_exact_blocked(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    shape: SHAPE_TYPE,
+    block_rows: int = 1024,
+    max_mem_elems: int = 2**25,
+    tmp_dir: Optional[str] = None,
+) -> float:
+    """representational_similarity_analysis (inner="correlation", outer="spearman") without in-memory N x N matrices.
+
+    Mantel-style: both condensed RSMs are written block by block of rows to memory-mapped files in tmp_dir, ranked
+    with an external-memory rank step (_external_rank), and the Pearson correlation of the ranks is accumulated over
+    chunks. Needs about 12 bytes per RSM entry per side on disk (float32 RSM + float64 ranks) for float32 inputs.
+    """
+    R, Rp = flatten(R, Rp, shape=shape)
+    R, Rp = to_numpy_if_needed(R, Rp)
+    N = R.shape[0]
+    M = N * (N - 1) // 2
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        ranks = []
+        for name, X in (("x", R), ("y", Rp)):
+            X = _centered_unit_rows(X)
+            rsm = np.memmap(f"{tmp}/rsm_{name}.dat", dtype=X.dtype, mode="w+", shape=(M,))
+            _write_condensed_rsm(X, rsm, block_rows)
+            rank = np.memmap(f"{tmp}/rank_{name}.dat", dtype=np.float64, mode="w+", shape=(M,))
+            _external_rank(rsm, rank, max_mem_elems)
+            del rsm
+            ranks.append(rank)
+
+        # average ranks always have mean (M + 1) / 2
+        sums = np.zeros(3)  # x^2, y^2, xy of the centered ranks
+        for c0 in range(0, M, max_mem_elems):
+            x = ranks[0][c0:c0 + max_mem_elems] - (M + 1) / 2
+            y = ranks[1][c0:c0 + max_mem_elems] - (M + 1) / 2
+            sums += [x @ x, y @ y, x @ y]
+        del ranks
+
+    return float(sums[2] / np.sqrt(sums[0] * sums[1]))
+
+
 class RSA(RSMSimilarityMeasure):
     def __init__(self):
         # choice of inner/outer in __call__ if fixed to default values, so these values are always the same
@@ -1012,6 +1365,76 @@ def _svcca_original(acts1, acts2):
     return np.mean(svcca_results["cca_coef1"])
 
 
+def cca_mean_from_covariances(sigmaxx, sigmaxy, sigmayy, epsilon=1e-10):
+    # Same steps as get_cca_similarity (rescaling, compute_ccas) but starting from given (cross-)covariances
+    # instead of np.cov over the datapoints. Any common scale factor (e.g. 1 / (N-1)) cancels in the rescaling.
+    xmax = np.max(np.abs(sigmaxx))
+    ymax = np.max(np.abs(sigmayy))
+    sigmaxx = sigmaxx / xmax
+    sigmayy = sigmayy / ymax
+    sigmaxy = sigmaxy / np.sqrt(xmax * ymax)
+
+    # compute_ccas returns zeros if every direction is removed by remove_small
+    if not np.any(np.abs(np.diagonal(sigmaxx)) >= epsilon) or not np.any(np.abs(np.diagonal(sigmayy)) >= epsilon):
+        return 0.0
+    ([u, s, v], _, _, _, _) = compute_ccas(sigmaxx, sigmaxy, sigmaxy.T.copy(), sigmayy, epsilon=epsilon, verbose=False)
+    return np.mean(s)
+
+
+def svcca_from_scatter(sxx, sxy, syy, num_datapoints=None):
+    """SVCCA from centered scatter matrices instead of the activations.
+
+    With cacts1 (D1, N) and cacts2 (D2, N) the mean-subtracted activations of _svcca_original, sxx = cacts1 @ cacts1.T,
+    sxy = cacts1 @ cacts2.T and syy = cacts2 @ cacts2.T. The eigendecomposition of sxx gives the singular values and
+    left singular vectors of cacts1, so the top-k PCA projection and the CCA on it only need D x D matrices. This
+    gives the same score as _svcca_original, but the scatter matrices can be built incrementally over nested feature
+    subsets or reused across permutations.
+    """
+    w1, U1 = np.linalg.eigh(sxx)
+    w2, U2 = np.linalg.eigh(syy)
+    w1, U1 = np.clip(w1[::-1], 0, None), U1[:, ::-1]
+    w2, U2 = np.clip(w2[::-1], 0, None), U2[:, ::-1]
+
+    # top-k PCA components only
+    k1 = top_k_pca_comps(np.sqrt(w1))
+    k2 = top_k_pca_comps(np.sqrt(w2))
+    if num_datapoints is not None:
+        assert k1 < num_datapoints and k2 < num_datapoints, "input must be number of neurons" "by datapoints"
+
+    # covariances of svacts1 = U1[:, :k1].T @ cacts1 and svacts2
+    return cca_mean_from_covariances(np.diag(w1[:k1]), U1[:, :k1].T @ sxy @ U2[:, :k2], np.diag(w2[:k2]))
+
+
+def svcca_nested_prefixes(R, Rp, prefix_sizes):
+    """svcca(R[:n], Rp[:n], "nd") for every n in prefix_sizes (rows are datapoints).
+
+    The raw moments are accumulated once over increasing prefixes, so each row is only touched once; only the
+    D x D eigendecompositions and the small CCA are redone per prefix. Prefixes with fewer than 2 rows give nan.
+    """
+    R, Rp = to_numpy_if_needed(R, Rp)
+    R, Rp = R.astype(np.float64), Rp.astype(np.float64)
+    sum_x, sum_y = np.zeros(R.shape[1]), np.zeros(Rp.shape[1])
+    xtx, yty, xty = np.zeros((R.shape[1],) * 2), np.zeros((Rp.shape[1],) * 2), np.zeros((R.shape[1], Rp.shape[1]))
+
+    scores = {}
+    n_done = 0
+    for n in sorted(set(int(n) for n in prefix_sizes)):
+        X, Y = R[n_done:n], Rp[n_done:n]
+        sum_x += X.sum(axis=0)
+        sum_y += Y.sum(axis=0)
+        xtx += X.T @ X
+        yty += Y.T @ Y
+        xty += X.T @ Y
+        n_done = n
+        if n < 2:
+            scores[n] = np.nan
+            continue
+        # centered scatter = raw moment - n * mean mean^T
+        scores[n] = svcca_from_scatter(xtx - np.outer(sum_x, sum_x) / n, xty - np.outer(sum_x, sum_y) / n,
+                                       yty - np.outer(sum_y, sum_y) / n, num_datapoints=n)
+    return [scores[int(n)] for n in prefix_sizes]
+
+
 # Copied from https://github.com/google/svcca/blob/1f3fbf19bd31bd9b76e728ef75842aa1d9a4cd2b/pwcca.py
 # Modification: get_cca_similarity is in the same file.
 def compute_pwcca(acts1, acts2, epsilon=0.0):
@@ -1089,6 +1512,39 @@ def svcca(
     return _svcca_original(R.T, Rp.T)
 
 
+def svcca_top_k_svd(R):
+    # (s[:k], V[:k]) of the mean-subtracted acts R.T, as computed in _svcca_original
+    acts = R.T
+    cacts = acts - np.mean(acts, axis=1, keepdims=True)
+    _, s, V = np.linalg.svd(cacts, full_matrices=False)
+    k = top_k_pca_comps(s)
+    return s[:k], V[:k]
+
+
+def svcca_permutation_scores(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    perms,
+) -> list:
+    """svcca(R, Rp[perm], "nd") for every row permutation perm in perms.
+
+    Permuting the rows of Rp (the datapoints) leaves its centering and singular values unchanged and only permutes
+    the columns of V, so both truncated SVDs are computed once. Per permutation only the k1 x k2 cross-covariance
+    of the permuted V blocks and the small CCA on it are computed.
+    """
+    R, Rp = flatten(R, Rp, shape="nd")
+    R, Rp = to_numpy_if_needed(R, Rp)
+    s1, V1 = svcca_top_k_svd(R)
+    s2, V2 = svcca_top_k_svd(Rp)
+    assert len(s1) < R.shape[0] and len(s2) < Rp.shape[0], "input must be number of neurons" "by datapoints"
+
+    # covariances of svacts = diag(s[:k]) @ V[:k]; rows of V are zero-mean since the acts are centered
+    s1, s2 = s1.astype(np.float64), s2.astype(np.float64)
+    sigmaxx, sigmayy = np.diag(s1**2), np.diag(s2**2)
+    sV1, sV2 = s1[:, None] * V1, s2[:, None] * V2
+    return [cca_mean_from_covariances(sigmaxx, sV1 @ sV2[:, perm].T, sigmayy) for perm in perms]
+
+
 def pwcca(
     R: Union[torch.Tensor, npt.NDArray],
     Rp: Union[torch.Tensor, npt.NDArray],
@@ -1146,4 +1602,536 @@ class PWCCA(RepresentationalSimilarityMeasure):
             R, Rp = align_spatial_dimensions(R, Rp)
             shape = "nd"
 
-        return self.sim_func(R, Rp, shape)
\ No newline at end of file
+        return self.sim_func(R, Rp, shape)
+
+##################################################################################
+# Linear CKA without N x N Gram matrices (cf. centered_kernel_alignment / hsic in repsim, Kornblith et al. 2019).
+# With centered R (N x D) and Rp (N x D'), <R R^T, Rp Rp^T>_F = ||R^T Rp||_F^2, so linear CKA only needs the
+# D x D', D x D and D' x D' (cross-)covariances.
+
+
+def _cka_from_covariances(cov_xy, cov_xx, cov_yy):
+    return float(np.sum(cov_xy**2) / (np.linalg.norm(cov_xx, ord="fro") * np.linalg.norm(cov_yy, ord="fro")))
+
+
+def centered_kernel_alignment(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    shape: SHAPE_TYPE,
+) -> float:
+    """Linear CKA (Kornblith et al., 2019) from the feature-space (cross-)covariances."""
+    R, Rp = flatten(R, Rp, shape=shape)
+    R, Rp = to_numpy_if_needed(R, Rp)
+    R = center_columns(R.astype(np.float64))
+    Rp = center_columns(Rp.astype(np.float64))
+    return _cka_from_covariances(R.T @ Rp, R.T @ R, Rp.T @ Rp)
+
+
+def cka_permutation_scores(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    perms,
+    max_chunk_elems: int = 2**26,
+) -> list:
+    """centered_kernel_alignment(R, Rp[perm], "nd") for every row permutation perm in perms.
+
+    The centering and the denominator ||R^T R|| ||Rp^T Rp|| do not change under a row permutation, so they are
+    computed once. Each side is also reduced to at most min(N, D) columns (R = U S V^T -> U S, which keeps
+    ||R^T P Rp||_F), so per permutation only an N x r x r' product is left; these are batched over permutations.
+    """
+    R, Rp = flatten(R, Rp, shape="nd")
+    R, Rp = to_numpy_if_needed(R, Rp)
+    R = center_columns(R.astype(np.float64))
+    Rp = center_columns(Rp.astype(np.float64))
+    denom = np.linalg.norm(R.T @ R, ord="fro") * np.linalg.norm(Rp.T @ Rp, ord="fro")
+
+    def reduce_cols(X):
+        if X.shape[0] >= X.shape[1]:
+            return X
+        U, s, _ = np.linalg.svd(X, full_matrices=False)
+        return U * s
+
+    R, Rp = reduce_cols(R), reduce_cols(Rp)
+    perms = np.asarray(perms, dtype=np.int64).reshape(-1, R.shape[0])
+    perms_per_chunk = max(1, max_chunk_elems // Rp.size)
+
+    scores = []
+    for p0 in range(0, len(perms), perms_per_chunk):
+        chunk = perms[p0:p0 + perms_per_chunk]
+        # R^T [Rp[perm_1] | Rp[perm_2] | ...] as one product, then ||.||_F^2 per perm
+        cross = R.T @ Rp[chunk.T].reshape(R.shape[0], -1)
+        cross = cross.reshape(R.shape[1], len(chunk), Rp.shape[1])
+        scores.extend((np.sum(cross**2, axis=(0, 2)) / denom).tolist())
+    return scores
+
+
+class MinibatchCKA:
+    """Linear CKA from the unbiased HSIC estimator averaged over minibatches (Nguyen et al., 2021).
+
+    For streaming over activation chunks: call update(X, Y) with the rows of each chunk (same datapoints in X and Y),
+    then score(). Every term of the unbiased HSIC_1 (Song et al., 2012) is computed from X^T Y, the row norms and the
+    column sums, so the n x n minibatch Gram matrices are never built either. Batches need at least 4 rows.
+    """
+
+    def __init__(self):
+        self.hsic_xy = 0.0
+        self.hsic_xx = 0.0
+        self.hsic_yy = 0.0
+        self.num_batches = 0
+
+    @staticmethod
+    def _unbiased_hsic_terms(X, Y):
+        n = X.shape[0]
+        # K~ = X X^T with zeroed diagonal: K~ 1 = X (X^T 1) - diag(K), 1^T K~ 1 = ||X^T 1||^2 - tr(K)
+        diag_k, diag_l = np.sum(X**2, axis=1), np.sum(Y**2, axis=1)
+        k_1 = X @ X.sum(axis=0) - diag_k
+        l_1 = Y @ Y.sum(axis=0) - diag_l
+        trace_kl = np.sum((X.T @ Y) ** 2) - diag_k @ diag_l
+        return (trace_kl + k_1.sum() * l_1.sum() / ((n - 1) * (n - 2)) - 2 / (n - 2) * (k_1 @ l_1)) / (n * (n - 3))
+
+    def update(self, X: Union[torch.Tensor, npt.NDArray], Y: Union[torch.Tensor, npt.NDArray]):
+        X, Y = (x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else np.asarray(x) for x in (X, Y))
+        X, Y = X.reshape(X.shape[0], -1).astype(np.float64), Y.reshape(Y.shape[0], -1).astype(np.float64)
+        assert X.shape[0] == Y.shape[0] and X.shape[0] > 3, "need the same (> 3) number of rows in X and Y"
+        self.hsic_xy += self._unbiased_hsic_terms(X, Y)
+        self.hsic_xx += self._unbiased_hsic_terms(X, X)
+        self.hsic_yy += self._unbiased_hsic_terms(Y, Y)
+        self.num_batches += 1
+        return self
+
+    def score(self) -> float:
+        return float(self.hsic_xy / np.sqrt(self.hsic_xx * self.hsic_yy))
+
+
+class CKA(RepresentationalSimilarityMeasure):
+    def __init__(self):
+        super().__init__(
+            sim_func=centered_kernel_alignment,
+            larger_is_more_similar=True,
+            is_metric=False,
+            is_symmetric=True,
+            invariant_to_affine=False,
+            invariant_to_invertible_linear=False,
+            invariant_to_ortho=True,
+            invariant_to_permutation=True,
+            invariant_to_isotropic_scaling=True,
+            invariant_to_translation=True,
+        )
+
+
+##################################################################################
+# Torch CCA core: get_cca_similarity / compute_ccas / _svcca_original / compute_pwcca on torch.linalg, so they run on
+# CPU threads or a GPU, in float32, and over a leading batch dimension. Directions that remove_small would crop are
+# masked instead (zero rows / cols, unit diagonal), so every batch element keeps the same shape; the canonical
+# correlations are padded with zeros and num_coefs gives how many are real. Instead of the retry-with-noise loop of
+# robust_cca_similarity, `reg` adds Tikhonov regularization (in the rescaled units, where max |sigma_xx| = 1).
+
+
+def _as_torch(*args, dtype=torch.float32, device=None):
+    return [(x if isinstance(x, torch.Tensor) else torch.from_numpy(np.asarray(x))).to(device=device, dtype=dtype)
+            for x in args]
+
+
+def _inv_sqrt_psd(sigma):
+    # sigma^(-1/2) for (batched) symmetric positive definite sigma, via eigh (cf. pinv + positivedef_matrix_sqrt)
+    w, v = torch.linalg.eigh(sigma)
+    w = w.clamp_min(torch.finfo(w.dtype).tiny)
+    return (v * w.rsqrt().unsqueeze(-2)) @ v.transpose(-1, -2)
+
+
+def compute_ccas_torch(sigma_xx, sigma_xy, sigma_yy, epsilon, reg=0.0):
+    """Batched compute_ccas: (..., Dx, Dx), (..., Dx, Dy), (..., Dy, Dy) -> same outputs, with masked small directions.
+
+    Returns:
+        [u, s, v], invsqrt_xx, invsqrt_yy, x_idxs, y_idxs, num_coefs
+    """
+    x_idxs = torch.diagonal(sigma_xx, dim1=-2, dim2=-1).abs() >= epsilon
+    y_idxs = torch.diagonal(sigma_yy, dim1=-2, dim2=-1).abs() >= epsilon
+
+    def mask_cov(sigma, idxs):
+        keep = idxs.unsqueeze(-1) & idxs.unsqueeze(-2)
+        eye = torch.eye(sigma.shape[-1], dtype=sigma.dtype, device=sigma.device)
+        return torch.where(keep, sigma, 0) + eye * (~idxs).unsqueeze(-1) + (epsilon + reg) * eye
+
+    sigma_xy = torch.where(x_idxs.unsqueeze(-1) & y_idxs.unsqueeze(-2), sigma_xy, 0)
+    invsqrt_xx = _inv_sqrt_psd(mask_cov(sigma_xx, x_idxs)) * (x_idxs.unsqueeze(-1) & x_idxs.unsqueeze(-2))
+    invsqrt_yy = _inv_sqrt_psd(mask_cov(sigma_yy, y_idxs)) * (y_idxs.unsqueeze(-1) & y_idxs.unsqueeze(-2))
+
+    u, s, v = torch.linalg.svd(invsqrt_xx @ sigma_xy @ invsqrt_yy)
+    num_coefs = torch.minimum(x_idxs.sum(-1), y_idxs.sum(-1))
+    return [u, s.abs(), v], invsqrt_xx, invsqrt_yy, x_idxs, y_idxs, num_coefs
+
+
+def get_cca_similarity_torch(acts1, acts2, epsilon=0.0, reg=1e-6, dtype=torch.float32, device=None):
+    """Batched get_cca_similarity on acts1 (..., num_neurons1, N) and acts2 (..., num_neurons2, N).
+
+    Returns the dict entries of get_cca_similarity that do not need cropping: "cca_coef1" (zero-padded), "num_coefs",
+    "mean_coef" (mean of the real coefficients, i.e. np.mean(cca_coef1) of the original), "coef_x", "coef_y",
+    "full_invsqrt_xx", "full_invsqrt_yy", "x_idxs", "y_idxs", "neuron_means1", "neuron_means2".
+    """
+    acts1, acts2 = _as_torch(acts1, acts2, dtype=dtype, device=device)
+    assert acts1.shape[-1] == acts2.shape[-1], "dimensions don't match"
+    assert acts1.shape[-2] < acts1.shape[-1], "input must be number of neurons" "by datapoints"
+    N = acts1.shape[-1]
+
+    # np.cov(acts1, acts2)
+    neuron_means1 = acts1.mean(dim=-1, keepdim=True)
+    neuron_means2 = acts2.mean(dim=-1, keepdim=True)
+    cacts1, cacts2 = acts1 - neuron_means1, acts2 - neuron_means2
+    sigmaxx = cacts1 @ cacts1.transpose(-1, -2) / (N - 1)
+    sigmaxy = cacts1 @ cacts2.transpose(-1, -2) / (N - 1)
+    sigmayy = cacts2 @ cacts2.transpose(-1, -2) / (N - 1)
+
+    # rescale covariance to make cca computation more stable
+    xmax = sigmaxx.abs().amax(dim=(-2, -1), keepdim=True)
+    ymax = sigmayy.abs().amax(dim=(-2, -1), keepdim=True)
+    sigmaxx, sigmayy, sigmaxy = sigmaxx / xmax, sigmayy / ymax, sigmaxy / torch.sqrt(xmax * ymax)
+
+    ([u, s, v], invsqrt_xx, invsqrt_yy, x_idxs, y_idxs, num_coefs) = compute_ccas_torch(
+        sigmaxx, sigmaxy, sigmayy, epsilon=epsilon, reg=reg
+    )
+    return {
+        "cca_coef1": s,
+        "num_coefs": num_coefs,
+        "mean_coef": s.sum(dim=-1) / num_coefs.clamp_min(1),  # 0 if every direction was removed
+        "coef_x": u.transpose(-1, -2),
+        "coef_y": v,
+        "full_invsqrt_xx": invsqrt_xx,
+        "full_invsqrt_yy": invsqrt_yy,
+        "x_idxs": x_idxs,
+        "y_idxs": y_idxs,
+        "neuron_means1": neuron_means1,
+        "neuron_means2": neuron_means2,
+    }
+
+
+def svcca_torch(R, Rp, epsilon=1e-10, reg=1e-6, dtype=torch.float32, device=None) -> torch.Tensor:
+    """svcca(R, Rp, "nd") for R (..., N, D), Rp (..., N, D'), batched over the leading dimensions.
+
+    As in svcca_from_scatter, the top-k PCA projection is taken from the eigendecomposition of the D x D scatter
+    matrix, so no N-sized SVD is needed. Components beyond top_k_pca_comps are masked.
+    """
+    R, Rp = _as_torch(R, Rp, dtype=dtype, device=device)
+    N = R.shape[-2]
+    R = R - R.mean(dim=-2, keepdim=True)
+    Rp = Rp - Rp.mean(dim=-2, keepdim=True)
+
+    def top_k_pca(X):
+        w, U = torch.linalg.eigh(X.transpose(-1, -2) @ X)
+        w, U = w.flip(-1).clamp_min(0), U.flip(-1)
+        # top_k_pca_comps, incl. its comparison of normalized cumulative variance with threshold * total variance
+        total_variance = w.sum(dim=-1, keepdim=True)
+        reached = torch.cumsum(w / total_variance, dim=-1) >= 0.99 * total_variance
+        k = torch.where(reached.any(dim=-1), reached.int().argmax(dim=-1) + 1, 1)
+        mask = torch.arange(w.shape[-1], device=w.device) < k.unsqueeze(-1)
+        return w * mask, U * mask.unsqueeze(-2)
+
+    w1, U1 = top_k_pca(R)
+    w2, U2 = top_k_pca(Rp)
+    # covariances of svacts1 = U1[:, :k1]^T R^T (zero rows beyond k1), up to the common 1 / (N - 1)
+    sigmaxx, sigmayy = torch.diag_embed(w1), torch.diag_embed(w2)
+    sigmaxy = U1.transpose(-1, -2) @ R.transpose(-1, -2) @ Rp @ U2
+
+    xmax = sigmaxx.abs().amax(dim=(-2, -1), keepdim=True)
+    ymax = sigmayy.abs().amax(dim=(-2, -1), keepdim=True)
+    sigmaxx, sigmayy, sigmaxy = sigmaxx / xmax, sigmayy / ymax, sigmaxy / torch.sqrt(xmax * ymax)
+    ([_, s, _], _, _, _, _, num_coefs) = compute_ccas_torch(sigmaxx, sigmaxy, sigmayy, epsilon=epsilon, reg=reg)
+    assert bool((num_coefs < N).all()), "input must be number of neurons" "by datapoints"
+    return s.sum(dim=-1) / num_coefs.clamp_min(1)
+
+
+def pwcca_torch(R, Rp, reg=1e-6, dtype=torch.float32, device=None) -> torch.Tensor:
+    """pwcca(R, Rp, "nd") for R (..., N, D), Rp (..., N, D'), batched over the leading dimensions.
+
+    compute_pwcca uses epsilon=0, so no direction is removed and its projection weighting is on the side with fewer
+    neurons. (For D > D' the original indexes acts1 with the y indices and fails; here the y side is used.) As in
+    compute_pwcca, the means are added back to the CCA directions, so for uncentered inputs the result depends on the
+    (arbitrary) signs of the singular vectors and float32 may differ from float64 beyond rounding.
+    """
+    R, Rp = _as_torch(R, Rp, dtype=dtype, device=device)
+    if R.shape[-1] > Rp.shape[-1]:
+        R, Rp = Rp, R
+    acts1, acts2 = R.transpose(-1, -2), Rp.transpose(-1, -2)
+    sresults = get_cca_similarity_torch(acts1, acts2, epsilon=0.0, reg=reg, dtype=dtype, device=device)
+
+    means = sresults["neuron_means1"]
+    dirns = sresults["coef_x"] @ (acts1 - means) + means
+    P, _ = torch.linalg.qr(dirns.transpose(-1, -2))
+    weights = torch.abs(P.transpose(-1, -2) @ R).sum(dim=-1)
+    weights = weights / weights.sum(dim=-1, keepdim=True)
+    return (weights * sresults["cca_coef1"][..., :weights.shape[-1]]).sum(dim=-1)
+
+
+def cka_torch(R, Rp, dtype=torch.float32, device=None) -> torch.Tensor:
+    """centered_kernel_alignment(R, Rp, "nd") for R (..., N, D), Rp (..., N, D'), batched over the leading dims."""
+    R, Rp = _as_torch(R, Rp, dtype=dtype, device=device)
+    R = R - R.mean(dim=-2, keepdim=True)
+    Rp = Rp - Rp.mean(dim=-2, keepdim=True)
+    cross = torch.linalg.matrix_norm(R.transpose(-1, -2) @ Rp) ** 2
+    return cross / (torch.linalg.matrix_norm(R.transpose(-1, -2) @ R) * torch.linalg.matrix_norm(Rp.transpose(-1, -2) @ Rp))
+
+
+def orthogonal_procrustes_torch(R, Rp, dtype=torch.float32, device=None) -> torch.Tensor:
+    """Orthogonal Procrustes distance min_Q ||R Q - Rp||_F (repsim's orthogonal_procrustes, zero padding the smaller
+    dimension) for R (..., N, D), Rp (..., N, D'), batched over the leading dims."""
+    R, Rp = _as_torch(R, Rp, dtype=dtype, device=device)
+    nucnorm = torch.linalg.svdvals(R.transpose(-1, -2) @ Rp).sum(dim=-1)
+    sq_dist = torch.linalg.matrix_norm(R) ** 2 + torch.linalg.matrix_norm(Rp) ** 2 - 2 * nucnorm
+    return torch.sqrt(sq_dist.clamp_min(0))
+
+
+##################################################################################
+# Multi-metric evaluation on shared preprocessing: Pipeline applies its preprocessing and one similarity function per
+# call, so scoring SVCCA, PWCCA, RSA and CKA on the same pair redoes the flattening, centering, SVDs and RSMs each
+# time. RepresentationContext computes each of these lazily, at most once per representation.
+
+import time  # noqa:e402
+
+
+class RepresentationContext:
+    """Lazily computed, memoized preprocessing of one N x D representation."""
+
+    def __init__(self, R: Union[torch.Tensor, npt.NDArray], shape: SHAPE_TYPE = "nd"):
+        (R,) = flatten(R, shape=shape)
+        (self.R,) = to_numpy_if_needed(R)
+
+    @functools.cached_property
+    def centered(self) -> npt.NDArray:
+        # column-centered (each dim over the N datapoints), as in _svcca_original and CKA
+        return center_columns(self.R.astype(np.float64))
+
+    @functools.cached_property
+    def svd(self) -> Tuple[npt.NDArray, npt.NDArray]:
+        # (U, s) of the centered R = U diag(s) V^T; U^T are the V rows of the SVD in _svcca_original
+        U, s, _ = np.linalg.svd(self.centered, full_matrices=False)
+        return U, s
+
+    @functools.cached_property
+    def cov_fro_norm(self) -> float:
+        return float(np.linalg.norm(self.centered.T @ self.centered, ord="fro"))
+
+    @functools.cached_property
+    def rsm_condensed(self) -> npt.NDArray:
+        # condensed correlation RSM, as in representational_similarity_analysis
+        return _correlation_rsm_condensed(self.R)
+
+
+def svcca_from_contexts(ctx: RepresentationContext, ctx_p: RepresentationContext) -> float:
+    (U1, s1), (U2, s2) = ctx.svd, ctx_p.svd
+    k1, k2 = top_k_pca_comps(s1), top_k_pca_comps(s2)
+    assert k1 < ctx.R.shape[0] and k2 < ctx_p.R.shape[0], "input must be number of neurons" "by datapoints"
+    sV1, sV2 = s1[:k1, None] * U1[:, :k1].T, s2[:k2, None] * U2[:, :k2].T
+    return cca_mean_from_covariances(np.diag(s1[:k1] ** 2), sV1 @ sV2.T, np.diag(s2[:k2] ** 2))
+
+
+def cka_from_contexts(ctx: RepresentationContext, ctx_p: RepresentationContext) -> float:
+    return float(np.sum((ctx.centered.T @ ctx_p.centered) ** 2) / (ctx.cov_fro_norm * ctx_p.cov_fro_norm))
+
+
+def rsa_from_contexts(ctx: RepresentationContext, ctx_p: RepresentationContext) -> float:
+    return scipy.stats.spearmanr(ctx.rsm_condensed, ctx_p.rsm_condensed).statistic  # type:ignore
+
+
+def pwcca_from_contexts(ctx: RepresentationContext, ctx_p: RepresentationContext) -> float:
+    return compute_pwcca(ctx.R.T, ctx_p.R.T)[0]
+
+
+class MultiMetricEvaluator:
+    """Scores one pair with several RepresentationalSimilarityMeasures, sharing their preprocessing.
+
+    Measures with an entry in context_sim_funcs are computed from the two RepresentationContexts; any other measure
+    is called on the flattened numpy arrays. Pass RepresentationContexts instead of arrays to also share the work
+    across pairs (e.g. one model A layer against every model B layer). Returns (scores, seconds) dicts keyed by
+    measure name; a measure's time includes the context entries it was the first to need.
+    """
+
+    context_sim_funcs: Dict[type, Callable[[RepresentationContext, RepresentationContext], float]] = {}
+
+    def __init__(self, measures: List[RepresentationalSimilarityMeasure]):
+        self.measures = measures
+
+    def __call__(
+        self,
+        R: Union[torch.Tensor, npt.NDArray, RepresentationContext],
+        Rp: Union[torch.Tensor, npt.NDArray, RepresentationContext],
+        shape: SHAPE_TYPE = "nd",
+    ) -> Tuple[Dict[str, float], Dict[str, float]]:
+        ctx = R if isinstance(R, RepresentationContext) else RepresentationContext(R, shape)
+        ctx_p = Rp if isinstance(Rp, RepresentationContext) else RepresentationContext(Rp, shape)
+
+        scores, seconds = {}, {}
+        for measure in self.measures:
+            start = time.perf_counter()
+            try:
+                context_func = self.context_sim_funcs.get(type(measure))
+                if context_func is not None:
+                    scores[measure.name] = context_func(ctx, ctx_p)
+                else:
+                    scores[measure.name] = measure(ctx.R, ctx_p.R, "nd")
+            except ValueError as e:
+                log.info(f"{measure.name} failed: {e}")
+                scores[measure.name] = np.nan
+            seconds[measure.name] = time.perf_counter() - start
+        return scores, seconds
+
+
+MultiMetricEvaluator.context_sim_funcs.update(
+    {SVCCA: svcca_from_contexts, PWCCA: pwcca_from_contexts, RSA: rsa_from_contexts, CKA: cka_from_contexts}
+)
+
+
+##################################################################################
+# Procrustes distances (cf. repsim's orthogonal_procrustes / permutation_procrustes, which zero pad the smaller dim)
+
+from scipy.optimize import linear_sum_assignment  # noqa:e402
+
+from pairing_fns import hungarian_assignment  # noqa:e402
+
+
+def orthogonal_procrustes(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    shape: SHAPE_TYPE,
+) -> float:
+    """min over orthogonal Q of ||R Q - Rp||_F, from the singular values of the D x D cross-covariance R^T Rp."""
+    R, Rp = flatten(R, Rp, shape=shape)
+    R, Rp = to_numpy_if_needed(R, Rp)
+    R, Rp = adjust_dimensionality(R.astype(np.float64), Rp.astype(np.float64))
+    nucnorm = np.linalg.svd(R.T @ Rp, compute_uv=False).sum()
+    return float(np.sqrt(max(np.linalg.norm(R, ord="fro") ** 2 + np.linalg.norm(Rp, ord="fro") ** 2 - 2 * nucnorm, 0)))
+
+
+def max_trace_column_assignment(
+    cross: npt.NDArray, topk: Optional[int] = 32, max_dense_size: int = 4_000_000
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """Column assignment (PR, PRp) maximizing the sum of cross[PR, PRp], like linear_sum_assignment(maximize=True).
+
+    cross with at most max_dense_size entries is solved densely (exact). Above that, with topk, only the topk largest entries of each row are candidates: pairing_fns.hungarian_assignment solves the
+    sparse graph (per connected component), and the rows / cols it leaves unmatched are assigned by a dense
+    linear_sum_assignment on their (small) sub-block. This is the exact optimum whenever the optimal assignment only
+    uses top-k entries, which is the usual case for matched decoder dims.
+    """
+    D = cross.shape[0]
+    if topk is None or topk >= cross.shape[1] or cross.size <= max_dense_size:
+        return linear_sum_assignment(cross, maximize=True)
+
+    # shift to positive values so hungarian_assignment keeps every candidate edge
+    shift = 1 - cross.min()
+    topk_inds = np.argpartition(-cross, topk - 1, axis=1)[:, :topk]
+    topk_vals = np.take_along_axis(cross, topk_inds, axis=1) + shift
+    PR, PRp, _ = hungarian_assignment(topk_inds, topk_vals)
+
+    rest_R = np.setdiff1d(np.arange(D), PR)
+    rest_Rp = np.setdiff1d(np.arange(cross.shape[1]), PRp)
+    if len(rest_R):
+        rows, cols = linear_sum_assignment(cross[np.ix_(rest_R, rest_Rp)], maximize=True)
+        PR, PRp = np.concatenate([PR, rest_R[rows]]), np.concatenate([PRp, rest_Rp[cols]])
+    order = np.argsort(PR)
+    return PR[order], PRp[order]
+
+
+def permutation_procrustes(
+    R: Union[torch.Tensor, npt.NDArray],
+    Rp: Union[torch.Tensor, npt.NDArray],
+    shape: SHAPE_TYPE,
+    optimal_permutation_alignment: Optional[Tuple[npt.NDArray, npt.NDArray]] = None,
+    topk: Optional[int] = 32,
+) -> float:
+    """min over column permutations P of ||R P - Rp||_F. topk: see max_trace_column_assignment (None = dense)."""
+    R, Rp = flatten(R, Rp, shape=shape)
+    R, Rp = to_numpy_if_needed(R, Rp)
+    R, Rp = adjust_dimensionality(R, Rp)
+
+    if not optimal_permutation_alignment:
+        optimal_permutation_alignment = max_trace_column_assignment(R.T @ Rp, topk)
+    PR, PRp = optimal_permutation_alignment
+    return float(np.linalg.norm(R[:, PR] - Rp[:, PRp], ord="fro"))
+
+
+def _procrustes_permutation_setup(R, Rp):
+    R, Rp = flatten(R, Rp, shape="nd")
+    R, Rp = to_numpy_if_needed(R, Rp)
+    R, Rp = adjust_dimensionality(R.astype(np.float64), Rp.astype(np.float64))
+    sq_norms = np.linalg.norm(R, ord="fro") ** 2 + np.linalg.norm(Rp, ord="fro") ** 2
+    return R, Rp, sq_norms
+
+
+def _permuted_cross_covs(R, Rp, perms, max_chunk_elems):
+    # R^T Rp[perm] for chunks of perms, as one product per chunk
+    perms = np.asarray(perms, dtype=np.int64).reshape(-1, R.shape[0])
+    perms_per_chunk = max(1, max_chunk_elems // Rp.size)
+    for p0 in range(0, len(perms), perms_per_chunk):
+        chunk = perms[p0:p0 + perms_per_chunk]
+        cross = R.T @ Rp[chunk.T].reshape(R.shape[0], -1)
+        yield cross.reshape(R.shape[1], len(chunk), Rp.shape[1]).transpose(1, 0, 2)
+
+
+def orthogonal_procrustes_permutation_scores(R, Rp, perms, max_chunk_elems: int = 2**26) -> list:
+    """orthogonal_procrustes(R, Rp[perm], "nd") for every row permutation perm in perms.
+
+    The Frobenius norms do not change under a row permutation, and the nuclear norm of R^T P Rp is unchanged when each
+    side is replaced by its U S factor (R = U S V^T), so for N < D each side is reduced to N columns once. The
+    cross-covariances are batched over permutations and their singular values taken in one batched SVD.
+    """
+    R, Rp, sq_norms = _procrustes_permutation_setup(R, Rp)
+
+    def reduce_cols(X):
+        if X.shape[0] >= X.shape[1]:
+            return X
+        U, s, _ = np.linalg.svd(X, full_matrices=False)
+        return U * s
+
+    scores = []
+    for cross in _permuted_cross_covs(reduce_cols(R), reduce_cols(Rp), perms, max_chunk_elems):
+        nucnorms = np.linalg.svd(cross, compute_uv=False).sum(axis=-1)
+        scores.extend(np.sqrt(np.maximum(sq_norms - 2 * nucnorms, 0)).tolist())
+    return scores
+
+
+def permutation_procrustes_permutation_scores(
+    R, Rp, perms, topk: Optional[int] = 32, max_chunk_elems: int = 2**26
+) -> list:
+    """permutation_procrustes(R, Rp[perm], "nd") for every row permutation perm in perms.
+
+    ||R P - Rp[perm]||^2 = ||R||^2 + ||Rp||^2 - 2 trace, so only the assignment on the (batched) cross-covariance
+    is redone per permutation.
+    """
+    R, Rp, sq_norms = _procrustes_permutation_setup(R, Rp)
+    scores = []
+    for cross in _permuted_cross_covs(R, Rp, perms, max_chunk_elems):
+        for cross_perm in cross:
+            PR, PRp = max_trace_column_assignment(cross_perm, topk)
+            scores.append(float(np.sqrt(max(sq_norms - 2 * cross_perm[PR, PRp].sum(), 0))))
+    return scores
+
+
+class OrthogonalProcrustes(RepresentationalSimilarityMeasure):
+    def __init__(self):
+        super().__init__(
+            sim_func=orthogonal_procrustes,
+            larger_is_more_similar=False,
+            is_metric=True,
+            is_symmetric=True,
+            invariant_to_affine=False,
+            invariant_to_invertible_linear=False,
+            invariant_to_ortho=True,
+            invariant_to_permutation=True,
+            invariant_to_isotropic_scaling=False,
+            invariant_to_translation=False,
+        )
+
+
+class PermutationProcrustes(RepresentationalSimilarityMeasure):
+    def __init__(self):
+        super().__init__(
+            sim_func=permutation_procrustes,
+            larger_is_more_similar=False,
+            is_metric=True,
+            is_symmetric=True,
+            invariant_to_affine=False,
+            invariant_to_invertible_linear=False,
+            invariant_to_ortho=False,
+            invariant_to_permutation=True,
+            invariant_to_isotropic_scaling=False,
+            invariant_to_translation=False,
+        )
@@ -0,0 +1,239 @@
+"""
+Experiment specs: many (model, SAE, layers) entries and the pairs of entries to compare, in one TOML (or, with pyyaml
+installed, YAML) file, run as one task grid (see grid_fns). The plan has one extract task per (entry, layer) needed by
+any pair, so a layer shared by several pairs (e.g. pythia-70m L3 against every partner model) is extracted once, and
+one correlate / score / baselines chain per layer pair of every pair. The extractions run grouped by model (and
+rerandomize_seed), then by layer, so only one model is loaded at once and each of its layers is run through it once:
+every SAE entry of that model layer only encodes the shared LLM activations. Meanwhile the pool already scores the
+pairs whose layers are ready.
+
+Spec layout (TOML; specs/example_pythia.toml is a full example):
+
+    [data]                  dataset, batch_size, max_length, tokenizer (default: the first entry's model),
+                            shuffle_seed (optional, shuffles the streamed dataset)
+    [settings]              pair_tasks / correlate_pairs args shared by all pairs (num_rand_runs, oneToOne_bool, ...)
+                            and extraction args: extract_batch_size, compare_MLPs_bool, top_index_k
+    [[entries]]             name, model, layers, and optionally sae + sae_lib (without an sae: the LLM MLP
+                            neurons, get_LLM_MLP_actvs) and rerandomize_seed (compare against the model re-randomized
+                            with rerandomized_model.RerandomizedModel)
+    [[pairs]]               A, B (entry names), and optionally layers_A / layers_B (subsets of the entries' layers)
+
+All entries are fed the same inputs, tokenized once with data.tokenizer, so the models of a spec must share a
+tokenizer (as the pairs of run.py / run_LLMs.py do).
+"""
+import os
+from functools import partial
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # python < 3.11
+    import tomli as tomllib
+
+from get_actv_fns import get_LLM_MLP_actvs, get_LLM_res_stream_actvs, get_sae_actvs
+from grid_fns import extract_tasks, pair_tasks, run_tasks, store_task_scores
+from results_fns import ResultsStore, config_hash
+from topk_index_fns import top_acts_index_path
+
+EXTRACT_SETTINGS = {'extract_batch_size': 32, 'compare_MLPs_bool': False, 'top_index_k': 10}
+PAIR_SETTINGS = ('num_rand_runs', 'rand_baselines_bool', 'rsa_method', 'sequential_pval_bool', 'oneToOne_bool',
+                 'manyA_1B_bool', 'oneToOne_method', 'assign_topk', 'corr_threshold', 'corr_thresholds', 'sweep_metrics',
+                 'kw_filter_bool', 'rand_num_workers')
+
+# {model_key: model} of the entries being extracted; loading another model frees it
+_loaded_model = {}
+# {(model_key, layer_id, compare_MLPs_bool): LLM activations} of the layer being extracted, shared by its SAE entries
+_llm_actvs = {}
+
+def load_spec(path):
+    """
+    The spec at path (.toml, or .yaml / .yml with pyyaml), checked: entry names unique, pairs refer to entries and
+    their layers, settings known.
+    """
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError as e:
+            raise ImportError("YAML specs need pyyaml (pip install pyyaml); TOML specs work without it") from e
+        with open(path) as f:
+            spec = yaml.safe_load(f)
+    else:
+        with open(path, 'rb') as f:
+            spec = tomllib.load(f)
+
+    spec.setdefault('data', {})
+    spec.setdefault('settings', {})
+    spec.setdefault('pairs', [])
+    entries = {}
+    for entry in spec.get('entries', []):
+        if entry['name'] in entries:
+            raise ValueError(f"Duplicate entry name: {entry['name']}")
+        entries[entry['name']] = entry
+    pairs = set()
+    for pair in spec['pairs']:
+        for side in ('A', 'B'):
+            if pair[side] not in entries:
+                raise ValueError(f"Pair {pair['A']} vs {pair['B']}: unknown entry {pair[side]}")
+            unknown_layers = set(pair.get(f'layers_{side}', [])) - set(entries[pair[side]]['layers'])
+            if unknown_layers:
+                raise ValueError(f"Pair {pair['A']} vs {pair['B']}: layers {sorted(unknown_layers)} not in entry "
+                                 f"{pair[side]}")
+        if (pair['A'], pair['B']) in pairs:
+            raise ValueError(f"Duplicate pair: {pair['A']} vs {pair['B']}")
+        pairs.add((pair['A'], pair['B']))
+    unknown_settings = set(spec['settings']) - set(PAIR_SETTINGS) - set(EXTRACT_SETTINGS)
+    if unknown_settings:
+        raise ValueError(f"Unknown settings: {sorted(unknown_settings)}")
+    spec['entries'] = entries
+    return spec
+
+def pair_layers(spec, pair):
+    return (pair.get('layers_A', spec['entries'][pair['A']]['layers']),
+            pair.get('layers_B', spec['entries'][pair['B']]['layers']))
+
+def model_key(entry):
+    # entries with the same key run the same model, so they share it and its LLM activations
+    return (entry['model'], entry.get('rerandomize_seed'))
+
+def load_model(model_name, rerandomize_seed=None):
+    from transformers import AutoModelForCausalLM
+    model = AutoModelForCausalLM.from_pretrained(model_name)
+    if rerandomize_seed is not None:
+        from experiment_config import config
+        from rerandomized_model import RerandomizedModel
+        model = RerandomizedModel(model, rerandomize_embeddings=config.rerandomize_embeddings,
+                                  rerandomize_layer_norm=config.rerandomize_layer_norm, seed=rerandomize_seed).model
+    return model
+
+def entry_model(entry):
+    # the entry's model, loaded on first use; the previously loaded model (and its activations) are freed first
+    key = model_key(entry)
+    if key not in _loaded_model:
+        _loaded_model.clear()
+        _llm_actvs.clear()
+        _loaded_model[key] = load_model(*key)
+    return _loaded_model[key]
+
+def entry_llm_actvs(entry, layer_id, inputs, extract_settings):
+    # the model's layer_id activations that the entry's SAE encodes, computed once per model layer
+    key = (model_key(entry), layer_id, extract_settings['compare_MLPs_bool'])
+    if key not in _llm_actvs:
+        model = entry_model(entry)
+        _llm_actvs.clear()
+        if extract_settings['compare_MLPs_bool']:
+            _, _, _llm_actvs[key] = get_LLM_MLP_actvs(model, entry['model'], layer_id, inputs,
+                                                      extract_settings['extract_batch_size'])
+        else:
+            _llm_actvs[key] = get_LLM_res_stream_actvs(model, layer_id, inputs, extract_settings['extract_batch_size'])
+    return _llm_actvs[key]
+
+def extract_entry_layer(entry, layer_id, inputs, extract_settings, work_dir):
+    if entry.get('sae') is None:
+        return get_LLM_MLP_actvs(entry_model(entry), entry['model'], layer_id, inputs,
+                                 extract_settings['extract_batch_size'])
+    return get_sae_actvs(None, entry['model'], entry['sae'], inputs, layer_id,
+                         batch_size=extract_settings['extract_batch_size'], sae_lib=entry.get('sae_lib', 'eleuther'),
+                         compare_MLPs_bool=extract_settings['compare_MLPs_bool'],
+                         top_index_k=extract_settings['top_index_k'],
+                         top_index_path=top_acts_index_path(entry['name'], layer_id, work_dir),
+                         LLM_actvs=entry_llm_actvs(entry, layer_id, inputs, extract_settings))
+
+def plan_tasks(spec, inputs, tokenizer, vocab=None, work_dir='.'):
+    """
+    The tasks of every pair of spec: the extract tasks of each (entry, layer) used by any pair, grouped by model_key
+    (in spec order, so each model is loaded once), then by layer (so the entries of a model layer share its LLM
+    activations), then the pair tasks. Entries and layers no pair uses are skipped.
+    """
+    extract_settings = {**EXTRACT_SETTINGS, **{key: val for key, val in spec['settings'].items()
+                                              if key in EXTRACT_SETTINGS}}
+    pair_settings = {key: val for key, val in spec['settings'].items() if key not in EXTRACT_SETTINGS}
+    has_top_index = extract_settings['top_index_k'] is not None
+
+    needed = {name: set() for name in spec['entries']}
+    for pair in spec['pairs']:
+        layers_A, layers_B = pair_layers(spec, pair)
+        needed[pair['A']].update(layers_A)
+        needed[pair['B']].update(layers_B)
+
+    model_order = {}
+    for entry in spec['entries'].values():
+        model_order.setdefault(model_key(entry), len(model_order))
+    extract_order = sorted(((model_order[model_key(entry)], layer_id, entry_ind, name)
+                            for entry_ind, (name, entry) in enumerate(spec['entries'].items())
+                            for layer_id in needed[name]))
+    tasks = []
+    for _, layer_id, _, name in extract_order:
+        tasks += extract_tasks(name, {layer_id: partial(extract_entry_layer, spec['entries'][name], layer_id, inputs,
+                                                        extract_settings, work_dir)}, work_dir)
+
+    for pair in spec['pairs']:
+        # without an sae there is no top_acts index; the keyword filter then runs a topk over the activations
+        use_top_index = has_top_index and all(spec['entries'][pair[side]].get('sae') for side in ('A', 'B'))
+        layers_A, layers_B = pair_layers(spec, pair)
+        tasks += pair_tasks(pair['A'], layers_A, pair['B'], layers_B, inputs, tokenizer, vocab=vocab,
+                            top_index_path_fn=partial(top_acts_index_path, cache_dir=work_dir) if use_top_index else None,
+                            **pair_settings)
+    return tasks
+
+def print_plan(spec, tasks):
+    num_extract = sum(task.task_id[0] == 'extract' for task in tasks)
+    num_naive = sum(len(layers_A) + len(layers_B) for layers_A, layers_B in
+                    (pair_layers(spec, pair) for pair in spec['pairs']))
+    print(f"{len(spec['pairs'])} pairs, {num_extract} layer extractions ({num_naive} if each pair extracted its own), "
+          f"{len(tasks) - num_extract} pair tasks")
+    for pair in spec['pairs']:
+        layers_A, layers_B = pair_layers(spec, pair)
+        print(f"  {pair['A']} {list(layers_A)} vs {pair['B']} {list(layers_B)}")
+
+def load_inputs(data, tokenizer):
+    from datasets import load_dataset
+    dataset = load_dataset(data.get('dataset', "Skylion007/openwebtext"), split="train", streaming=True,
+                           trust_remote_code=True)
+    if data.get('shuffle_seed') is not None:
+        dataset = dataset.shuffle(seed=data['shuffle_seed'])
+    batch = []
+    dataset_iter = iter(dataset)
+    for _ in range(data.get('batch_size', 100)):
+        try:
+            batch.append(next(dataset_iter)['text'])
+        except StopIteration:
+            break
+    return tokenizer(batch, return_tensors="pt", padding=True, truncation=True, max_length=data.get('max_length', 100))
+
+def run_spec(spec_path, work_dir='.', results_db='results.sqlite', num_workers=1, dry_run=False):
+    """
+    Runs (or resumes, from the task log in work_dir) every pair of the spec at spec_path, adding the scores to the
+    ResultsStore at results_db, with each entry's model and sae as the row key and data + settings as the config.
+    Returns the {task_id: result} of all tasks.
+    dry_run: only print the plan (nothing is loaded)
+    """
+    spec = load_spec(spec_path)
+    if dry_run:
+        print_plan(spec, plan_tasks(spec, None, None, work_dir=work_dir))
+        return {}
+
+    from transformers import AutoTokenizer
+    from vocab_fns import get_vocab_table
+
+    first_model = next(iter(spec['entries'].values()))['model']
+    tokenizer = AutoTokenizer.from_pretrained(spec['data'].get('tokenizer', first_model))
+    tokenizer.pad_token = tokenizer.eos_token
+    inputs = load_inputs(spec['data'], tokenizer)
+    tasks = plan_tasks(spec, inputs, tokenizer, get_vocab_table(tokenizer, cache_dir=work_dir), work_dir)
+    print_plan(spec, tasks)
+
+    # kw_filter_bool is always part of the config, so filtered and unfiltered scores never share rows
+    config = {**spec['data'], 'kw_filter_bool': False, **spec['settings']}
+    store = ResultsStore(results_db)
+    store_keys = {(pair['A'], pair['B']): {'model_A': spec['entries'][pair['A']]['model'],
+                                           'model_B': spec['entries'][pair['B']]['model'],
+                                           'sae_A': spec['entries'][pair['A']].get('sae'),
+                                           'sae_B': spec['entries'][pair['B']].get('sae')}
+                  for pair in spec['pairs']}
+
+    def on_done(task_id, result):
+        if task_id[0] != 'extract':
+            store_task_scores(store, store_keys[task_id[1], task_id[3]], config, task_id, result)
+
+    spec_name = os.path.splitext(os.path.basename(spec_path))[0]
+    log_path = os.path.join(work_dir, f'grid_spec_{spec_name}_{config_hash(config)}.pkl')
+    return run_tasks(tasks, log_path, num_workers, on_done=on_done)
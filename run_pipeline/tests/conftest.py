@@ -0,0 +1,5 @@
+# the run_pipeline modules import each other by their flat names, as when running from run_pipeline
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import torch
+
+import get_rand_fns
+from get_rand_fns import iter_null_scores, null_distribution, sequential_pval, sequential_score_rand
+
+
+def failing_sim(R, Rp):
+    raise ValueError("degenerate subset")
+
+
+def test_sequential_pval_no_runs():
+    rng = np.random.default_rng(0)
+    W1, W2 = rng.standard_normal((50, 8)), rng.standard_normal((60, 8))
+    null = sequential_score_rand(0, W1, W2, 10, failing_sim, False, observed=0.5)
+    assert np.isnan(null.seq_pval)
+    assert null.stop_reason == 'no_scores'
+    assert null.num_done == 0
+
+
+def test_sequential_pval_all_failed():
+    rng = np.random.default_rng(0)
+    W1, W2 = rng.standard_normal((50, 8)), rng.standard_normal((60, 8))
+    null = sequential_pval(iter_null_scores(20, W1, W2, 10, failing_sim, False, observed=0.5))
+    assert np.isnan(null.seq_pval)
+    assert null.stop_reason == 'no_scores'
+    assert len(null.failures) == 20 and not null.scores
+
+
+def first_entry_sim(R, Rp, shape):
+    return float(R[0, 0])
+
+
+def first_entry_batch(R, Rp, dtype=torch.float64, device=None):
+    return torch.as_tensor(R[:, 0, 0], dtype=dtype, device=device)
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_null_distribution_nonfinite_scores_are_failures(batched, monkeypatch):
+    if batched:
+        monkeypatch.setitem(get_rand_fns.subset_batch_fns, first_entry_sim, first_entry_batch)
+    rng = np.random.default_rng(0)
+    W1, W2 = rng.standard_normal((40, 4)), rng.standard_normal((40, 4))
+    W1[::2, 0] = np.nan  # half the rows score nan when drawn first
+    null = null_distribution(30, W1, W2, 5, first_entry_sim, True, observed=0.0, max_batch_runs=8)
+
+    assert null.num_done == 30
+    assert null.failures and len(null.scores) + len(null.failures) == 30
+    assert np.isfinite(null.scores).all() and np.isfinite(null.mean) and np.isfinite(null.pval)
+    assert all('non-finite' in msg for _, msg in null.failures)
+
+
+def test_batched_svcca_null_matches_paired_estimator():
+    # float64 batches use reg=0, i.e. the same CCA as svcca on each subset
+    rng = np.random.default_rng(0)
+    W1, W2 = rng.standard_normal((60, 12)), rng.standard_normal((70, 12))
+    batched = null_distribution(6, W1, W2, 30, get_rand_fns.svcca, True, max_batch_runs=3)
+    inds_1, inds_2 = get_rand_fns.draw_rand_subsets(6, 60, 70, 30)
+    single = [get_rand_fns.svcca(W1[i1], W2[i2], "nd") for i1, i2 in zip(inds_1, inds_2)]
+    assert not batched.failures
+    np.testing.assert_allclose(batched.scores, single, rtol=1e-9, atol=1e-12)
+
+
+def test_shuffle_rand_num_workers(tmp_path):
+    # seeded like the cache_dir path, and the same scores for any num_workers
+    rng = np.random.default_rng(0)
+    W1, W2 = rng.standard_normal((40, 6)), rng.standard_normal((40, 5))
+    cached = get_rand_fns.shuffle_rand(8, W1, W2, 40, get_rand_fns.svcca, True, cache_dir=str(tmp_path), seed=3)
+    in_process = get_rand_fns.shuffle_rand(8, W1, W2, 40, get_rand_fns.svcca, True, seed=3, num_workers=1)
+    pooled = get_rand_fns.shuffle_rand(8, W1, W2, 40, get_rand_fns.svcca, True, seed=3, num_workers=2)
+    np.testing.assert_allclose(in_process, cached)
+    np.testing.assert_allclose(pooled, cached)
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from results_fns import config_hash
+
+
+def test_config_hash_canonical_values():
+    base = {'batch_size': 200, 'corr_threshold': 0.1}
+    # plain configs keep their hash
+    assert config_hash(base) == config_hash({'corr_threshold': 0.1, 'batch_size': np.int64(200)})
+    # arrays and dicts are hashed by value instead of dropped
+    assert config_hash({**base, 'corr_thresholds': np.array([0.1, 0.2])}) == \
+        config_hash({**base, 'corr_thresholds': [0.1, 0.2]})
+    assert config_hash({**base, 'corr_thresholds': np.array([0.1, 0.3])}) != \
+        config_hash({**base, 'corr_thresholds': np.array([0.1, 0.2])})
+    assert config_hash({**base, 'data': {'a': 1, 'b': 2}}) == config_hash({**base, 'data': {'b': 2, 'a': 1}})
+    assert config_hash({**base, 'data': {'a': 1}}) != config_hash(base)
+
+
+def test_config_hash_rejects_unhashable_values():
+    with pytest.raises(TypeError):
+        config_hash({'vocab': object()})
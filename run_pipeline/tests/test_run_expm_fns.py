@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("sparsify")
+pytest.importorskip("sae_lens")
+
+from run_expm_fns import correlate_pairs  # noqa: E402
+from vocab_fns import VocabTable  # noqa: E402
+
+NUM_TOKS = 12
+
+
+def peak_acts(peaks):
+    # (1, NUM_TOKS, num_feats) activations, feature f active (1.0) at positions peaks[f]
+    acts = torch.zeros(1, NUM_TOKS, len(peaks))
+    for feat, positions in enumerate(peaks):
+        acts[0, positions, feat] = 1.0
+    return acts
+
+
+def keyword_case():
+    vocab = VocabTable(['.', 'cat', 'dog'])
+    inputs = {'input_ids': torch.tensor([[1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 0, 0]])}
+    # A0 / B0 peak on the 5 'cat' tokens; A1 on the 5 'dog' tokens, and its best match B1 on 4 'dog' tokens and a '.'
+    acts_A = peak_acts([[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]])
+    acts_B = peak_acts([[0, 1, 2, 3, 4], [6, 7, 8, 9, 10]])
+    W_A, W_B = np.eye(2, 4), np.eye(2, 4)
+    return inputs, (W_A, acts_A.reshape(-1, 2), acts_A), (W_B, acts_B.reshape(-1, 2), acts_B), vocab
+
+
+def test_keyword_filter_drops_nonconcept_pairs():
+    inputs, saeActvs_A, saeActvs_B, vocab = keyword_case()
+    dictscores, inds_A, inds_B = correlate_pairs(inputs, None, saeActvs_A, saeActvs_B, vocab=vocab,
+                                                 kw_filter_bool=True)
+    assert dictscores["total_feats_beforeFilt"] == 2
+    assert dictscores["num_feat_after_rmv_kw"] == 1
+    assert (inds_A, inds_B) == ([0], [0])
+
+
+def test_keyword_filter_off_by_default():
+    # as the original loop, whose for/else put the unfiltered pairs back
+    inputs, saeActvs_A, saeActvs_B, vocab = keyword_case()
+    dictscores, inds_A, inds_B = correlate_pairs(inputs, None, saeActvs_A, saeActvs_B, vocab=vocab)
+    assert dictscores["num_feat_after_rmv_kw"] == 2
+    assert (inds_A, inds_B) == ([0, 1], [0, 1])
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+import torch
+
+from sim_fns import (ann_self_neighbors, centered_kernel_alignment, cka_torch, compute_ccas, compute_ccas_torch,
+                     get_cca_similarity, get_cca_similarity_torch, jaccard_from_neighbors, pwcca, pwcca_torch, svcca,
+                     svcca_torch)
+
+# tolerances of the torch CCA core against the numpy float64 cca_core functions; reg=0 for float64 (no
+# regularization, so it must match to rounding), the default reg=1e-6 for float32
+TOLS = {torch.float64: dict(reg=0.0, atol=1e-8), torch.float32: dict(reg=1e-6, atol=1e-4)}
+N, D, Dp = 400, 12, 9
+
+
+def rand_reps(seed, batch=None, centered=False):
+    # correlated R (N x D), Rp (N x D') with a shared latent, so the CCA coefficients are spread out
+    rng = np.random.default_rng(seed)
+    shape = (batch,) if batch else ()
+    latent = rng.standard_normal((*shape, N, 6))
+    R = latent @ rng.standard_normal((6, D)) + 0.5 * rng.standard_normal((*shape, N, D))
+    Rp = latent @ rng.standard_normal((6, Dp)) + 0.5 * rng.standard_normal((*shape, N, Dp))
+    if centered:
+        R, Rp = R - R.mean(axis=-2, keepdims=True), Rp - Rp.mean(axis=-2, keepdims=True)
+    return R, Rp
+
+
+@pytest.mark.parametrize("dtype", TOLS)
+def test_compute_ccas_torch(dtype):
+    R, Rp = rand_reps(0)
+    sigma = np.cov(R.T, Rp.T)
+    sigma_xx, sigma_xy, sigma_yx, sigma_yy = sigma[:D, :D], sigma[:D, D:], sigma[D:, :D], sigma[D:, D:]
+    [_, s, _], *_ = compute_ccas(sigma_xx, sigma_xy, sigma_yx, sigma_yy, epsilon=0.0, verbose=False)
+    [_, s_torch, _], *_, num_coefs = compute_ccas_torch(*(torch.tensor(x, dtype=dtype) for x in
+                                                          (sigma_xx, sigma_xy, sigma_yy)),
+                                                        epsilon=0.0, reg=TOLS[dtype]["reg"] / 10)
+    assert int(num_coefs) == Dp
+    np.testing.assert_allclose(s_torch[:Dp].double().numpy(), s[:Dp], atol=TOLS[dtype]["atol"])
+
+
+@pytest.mark.parametrize("dtype", TOLS)
+def test_get_cca_similarity_torch(dtype):
+    R, Rp = rand_reps(1)
+    expected = get_cca_similarity(R.T, Rp.T, epsilon=0.0, compute_dirns=False, verbose=False)
+    result = get_cca_similarity_torch(R.T, Rp.T, epsilon=0.0, reg=TOLS[dtype]["reg"], dtype=dtype)
+    np.testing.assert_allclose(result["cca_coef1"][:Dp].double().numpy(), expected["cca_coef1"][:Dp],
+                               atol=TOLS[dtype]["atol"])
+    np.testing.assert_allclose(float(result["mean_coef"]), np.mean(expected["cca_coef1"]), atol=TOLS[dtype]["atol"])
+    np.testing.assert_allclose(result["neuron_means1"].double().numpy(), expected["neuron_means1"], rtol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", TOLS)
+def test_svcca_torch(dtype):
+    R, Rp = rand_reps(2)
+    result = svcca_torch(R, Rp, reg=TOLS[dtype]["reg"], dtype=dtype)
+    np.testing.assert_allclose(float(result), svcca(R, Rp, "nd"), atol=TOLS[dtype]["atol"])
+
+
+# compute_pwcca adds the neuron means back to the CCA directions, so with uncentered inputs its result depends on the
+# sign of each singular vector, which float32 and float64 (LAPACK) SVDs need not agree on. Centered inputs pin the
+# numerics in both dtypes; uncentered ones are compared in float64, where torch and numpy share the sign convention.
+@pytest.mark.parametrize("dtype", TOLS)
+def test_pwcca_torch(dtype):
+    R, Rp = rand_reps(3, centered=True)
+    # pwcca needs D <= D' (see pwcca_torch)
+    result = pwcca_torch(Rp, R, reg=TOLS[dtype]["reg"], dtype=dtype)
+    np.testing.assert_allclose(float(result), pwcca(Rp, R, "nd"), atol=TOLS[dtype]["atol"])
+
+
+def test_pwcca_torch_uncentered_float64():
+    R, Rp = rand_reps(3)
+    result = pwcca_torch(Rp, R, reg=0.0, dtype=torch.float64)
+    np.testing.assert_allclose(float(result), pwcca(Rp, R, "nd"), atol=TOLS[torch.float64]["atol"])
+
+
+@pytest.mark.parametrize("dtype", TOLS)
+def test_cka_torch(dtype):
+    R, Rp = rand_reps(4)
+    result = cka_torch(R, Rp, dtype=dtype)
+    np.testing.assert_allclose(float(result), centered_kernel_alignment(R, Rp, "nd"), atol=TOLS[dtype]["atol"])
+
+
+@pytest.mark.parametrize("dtype", TOLS)
+def test_batched_matches_numpy(dtype):
+    # a batch of pairs gives the numpy result of each pair
+    R, Rp = rand_reps(5, batch=3, centered=True)
+    for torch_fn, np_fn in ((svcca_torch, svcca), (pwcca_torch, pwcca), (cka_torch, centered_kernel_alignment)):
+        kwargs = {} if torch_fn is cka_torch else {"reg": TOLS[dtype]["reg"]}
+        result = torch_fn(Rp, R, dtype=dtype, **kwargs).double().numpy()
+        expected = [np_fn(Rp[b], R[b], "nd") for b in range(3)]
+        np.testing.assert_allclose(result, expected, atol=TOLS[dtype]["atol"])
+
+
+def test_jaccard_from_neighbors_ignores_padding():
+    # row 1 has only 2 of k=3 neighbors, padded with -1 as IVFIndex.query does; with the row * N offset, a -1 would
+    # otherwise become row 0's id N - 1
+    nn = np.array([[4, 1, 2], [3, 0, -1], [0, 1, 3]])
+    nn_p = np.array([[4, 2, 3], [4, 1, 0], [1, 0, -1]])
+    expected = np.mean([len(set(a) & set(b) - {-1}) / len((set(a) | set(b)) - {-1}) for a, b in zip(nn, nn_p)])
+    assert jaccard_from_neighbors(nn, nn_p) == pytest.approx(expected)
+
+
+def test_ann_self_neighbors_not_persisted_by_default(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    R = np.random.default_rng(0).standard_normal((300, 16)).astype(np.float32)
+    nn = ann_self_neighbors(R, 5)
+    assert nn.shape == (300, 5)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("sparsify")
+pytest.importorskip("sae_lens")
+
+import spec_fns
+from grid_fns import run_tasks
+from spec_fns import plan_tasks
+
+
+def test_entries_share_model_and_llm_actvs(tmp_path, monkeypatch):
+    loads, forwards, encodes = [], [], []
+
+    def fake_load_model(model_name, rerandomize_seed=None):
+        loads.append((model_name, rerandomize_seed))
+        return model_name
+
+    def fake_res_stream_actvs(model, layer_id, inputs, batch_size):
+        forwards.append((model, layer_id))
+        return torch.full((2, 3, 4), float(layer_id))
+
+    def fake_sae_actvs(model, model_name, sae_name, inputs, layer_id, LLM_actvs=None, **kwargs):
+        encodes.append((sae_name, layer_id, LLM_actvs))
+        return np.zeros((5, 4)), torch.zeros(6, 5), torch.zeros(2, 3, 5)
+
+    monkeypatch.setattr(spec_fns, 'load_model', fake_load_model)
+    monkeypatch.setattr(spec_fns, 'get_LLM_res_stream_actvs', fake_res_stream_actvs)
+    monkeypatch.setattr(spec_fns, 'get_sae_actvs', fake_sae_actvs)
+    monkeypatch.setattr(spec_fns, '_loaded_model', {})
+    monkeypatch.setattr(spec_fns, '_llm_actvs', {})
+
+    entries = {
+        '70m_32k': {'name': '70m_32k', 'model': 'pythia-70m', 'sae': 'sae-70m-32k', 'layers': [1, 2]},
+        '160m': {'name': '160m', 'model': 'pythia-160m', 'sae': 'sae-160m', 'layers': [1]},
+        '70m_16k': {'name': '70m_16k', 'model': 'pythia-70m', 'sae': 'sae-70m-16k', 'layers': [1, 2]},
+    }
+    spec = {'entries': entries, 'settings': {'top_index_k': None},
+            'pairs': [{'A': '70m_32k', 'B': '160m'}, {'A': '70m_16k', 'B': '160m'}]}
+    tasks = plan_tasks(spec, {'input_ids': torch.zeros(2, 3, dtype=torch.long)}, None, work_dir=str(tmp_path))
+    extract = [task for task in tasks if task.task_id[0] == 'extract']
+    run_tasks(extract, str(tmp_path / 'log.pkl'), num_workers=0)
+
+    assert loads == [('pythia-70m', None), ('pythia-160m', None)]
+    assert forwards == [('pythia-70m', 1), ('pythia-70m', 2), ('pythia-160m', 1)]
+    assert [(sae, layer) for sae, layer, _ in encodes] == [
+        ('sae-70m-32k', 1), ('sae-70m-16k', 1), ('sae-70m-32k', 2), ('sae-70m-16k', 2), ('sae-160m', 1)]
+    # both SAEs of a pythia-70m layer encode the same LLM activations
+    assert encodes[0][2] is encodes[1][2] and encodes[2][2] is encodes[3][2]
+    assert (encodes[2][2] == 2).all()
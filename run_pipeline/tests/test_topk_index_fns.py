@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from interpret_fns import keyword_filter_mask
+from keyword_index_fns import KeywordIndex, concept_feats
+from topk_index_fns import TopActivationsIndex, get_top_acts_index, tokens_hash
+from vocab_fns import VocabTable
+
+
+def short_index():
+    # 3 tokens seen in total, k=5: every feature has 2 empty slots
+    index = TopActivationsIndex(num_feats=2, k=5)
+    index.update(torch.tensor([[[0.0, 3.0], [2.0, 1.0], [1.0, 2.0]]]))
+    return index
+
+
+def test_top_token_ids_empty_slots():
+    batch_tokens = torch.tensor([[7, 8, 9]])
+    tok_ids = short_index().top_token_ids(batch_tokens)
+    assert tok_ids.tolist() == [[8, 9, 7, -1, -1], [7, 9, 8, -1, -1]]
+
+
+def test_empty_slots_are_not_tokens():
+    vocab = VocabTable(['.', 'a', 'b', 'c', 'd'])
+    batch_tokens = torch.tensor([[0, 1, 2, 3, 4]])
+    top_A = torch.tensor([[1, 2, -1], [1, -1, -1]])
+    top_B = torch.tensor([[3, 4, -1], [1, -1, -1]])
+    # pair 0 shares only empty slots, pair 1 shares 'a'
+    assert keyword_filter_mask(top_A, top_B, batch_tokens, None, ['.'], vocab=vocab).tolist() == [False, True]
+
+    # -1 would decode to the last vocab entry, 'd'
+    keyword_index = KeywordIndex.from_top_token_ids(top_A, vocab)
+    assert sorted(keyword_index.keys.tolist()) == ['a', 'b']
+    assert keyword_index.lookup('a').tolist() == [0, 1]
+    assert {concept: feats.tolist() for concept, feats in
+            concept_feats(keyword_index, {'ab': ['A', 'b'], 'none': ['d']}).items()} == {'ab': [0, 1], 'none': []}
+
+
+def test_stale_index_is_not_loaded(tmp_path):
+    batch_tokens = torch.tensor([[7, 8, 9]])
+    index = short_index()
+    index.inputs_hash = tokens_hash(batch_tokens)
+    path = str(tmp_path / 'top_acts.npz')
+    index.save(path)
+    assert get_top_acts_index(path, batch_tokens).top_token_ids(batch_tokens).tolist() == \
+        index.top_token_ids(batch_tokens).tolist()
+
+    with pytest.raises(ValueError, match='other inputs'):
+        get_top_acts_index(path, torch.tensor([[7, 8, 10]]))
+
+    # saved without an inputs hash, e.g. by an older run
+    TopActivationsIndex(2, 5).save(path)
+    with pytest.raises(ValueError, match='other inputs'):
+        get_top_acts_index(path, batch_tokens)
@@ -0,0 +1,103 @@
+"""
+Per-feature top-k activations over a whole dataset, built while the SAE activations are extracted (get_sae_actvs) and
+persisted next to them, so the keyword filter and the interpret / semantic-subspace code look a feature's top
+examples up instead of running a topk over the in-memory feature_acts.
+
+TopActivationsIndex keeps, for every feature, its k largest activations seen so far with their (doc, pos). Each
+extraction batch is reduced to its own top-k per feature with one topk over all features, and merged into the running
+top-k with a second topk over the 2k candidates, i.e. a bounded top-k heap per feature, updated for all features at
+once. Saved as (num_feats, k) arrays: values float16, docs / pos int32, with the tokens_hash of the inputs it was
+built over; get_top_acts_index checks it, so an index left over from other inputs is not read as this run's.
+"""
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+# in-process cache of loaded indexes
+_top_acts_indexes = {}
+
+def tokens_hash(batch_tokens):
+    # fingerprint of the (num_docs, seq_len) token IDs the (doc, pos) entries index into
+    tokens = np.ascontiguousarray(torch.as_tensor(batch_tokens).cpu().numpy().astype(np.int64))
+    return hashlib.sha1(tokens.view(np.uint8)).hexdigest()[:16] + f'_{tokens.shape[0]}x{tokens.shape[1]}'
+
+class TopActivationsIndex:
+    def __init__(self, num_feats, k=10, values=None, docs=None, pos=None, inputs_hash=None):
+        self.k = k
+        self.inputs_hash = inputs_hash
+        self.values = torch.full((num_feats, k), -torch.inf) if values is None else torch.as_tensor(values).float()
+        self.docs = torch.full((num_feats, k), -1, dtype=torch.int32) if docs is None else torch.as_tensor(docs)
+        self.pos = torch.full((num_feats, k), -1, dtype=torch.int32) if pos is None else torch.as_tensor(pos)
+
+    @property
+    def num_feats(self):
+        return self.values.shape[0]
+
+    def update(self, batch_acts, doc_offset=0, feat_chunk_size=4096):
+        """
+        batch_acts: (batch, seq, num_feats) activations of docs doc_offset, ..., doc_offset + batch - 1
+        """
+        batch_size, seq_len, num_feats = batch_acts.shape
+        flat_acts = batch_acts.reshape(-1, num_feats).float()
+        k = min(self.k, flat_acts.shape[0])
+        for start in range(0, num_feats, feat_chunk_size):
+            end = min(start + feat_chunk_size, num_feats)
+            batch_vals, batch_inds = flat_acts[:, start:end].topk(k, dim=0)  # (k, chunk)
+            batch_vals, batch_inds = batch_vals.t().cpu(), batch_inds.t().cpu()
+
+            values = torch.cat([self.values[start:end], batch_vals], dim=1)
+            docs = torch.cat([self.docs[start:end], (doc_offset + batch_inds // seq_len).int()], dim=1)
+            pos = torch.cat([self.pos[start:end], (batch_inds % seq_len).int()], dim=1)
+            top_vals, top = values.topk(self.k, dim=1)
+            self.values[start:end] = top_vals
+            self.docs[start:end] = torch.gather(docs, 1, top)
+            self.pos[start:end] = torch.gather(pos, 1, top)
+
+    def top(self, feature_idx, k=None):
+        # ((k, 2) [doc, pos] indices, (k,) values) of one feature, as highest_activating_tokens returns them
+        k = k or self.k
+        return torch.stack([self.docs[feature_idx, :k], self.pos[feature_idx, :k]], dim=-1).long(), \
+            self.values[feature_idx, :k]
+
+    def top_token_ids(self, batch_tokens, k=None, feats=None):
+        """
+        Token IDs at the top k positions of every feature (or of feats), as highest_activating_tokens_allFeats.
+        Slots not filled (fewer than k positions seen) are -1; keyword_filter_mask and KeywordIndex skip them.
+        """
+        k = k or self.k
+        feats = slice(None) if feats is None else torch.as_tensor(feats)
+        docs, pos = self.docs[feats, :k].long(), self.pos[feats, :k].long()
+        tok_ids = batch_tokens.cpu()[docs.clamp_min(0), pos.clamp_min(0)]
+        return torch.where(docs >= 0, tok_ids, -1)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(path, values=self.values.numpy().astype(np.float16), docs=self.docs.numpy(), pos=self.pos.numpy(),
+                 inputs_hash=np.array(self.inputs_hash or ''))
+
+    @classmethod
+    def load(cls, path):
+        saved = np.load(path)
+        inputs_hash = str(saved['inputs_hash']) if 'inputs_hash' in saved.files else ''
+        return cls(saved['values'].shape[0], saved['values'].shape[1], values=saved['values'], docs=saved['docs'],
+                   pos=saved['pos'], inputs_hash=inputs_hash or None)
+
+def top_acts_index_path(sae_name, layer_id, cache_dir='.'):
+    return os.path.join(cache_dir, f'top_acts_{sae_name.replace("/", "_")}_L{layer_id}.npz')
+
+def get_top_acts_index(path, batch_tokens=None):
+    """
+    The index saved at path (cached in-process until the file is rewritten).
+    batch_tokens: the inputs' token IDs; raises ValueError if the index was built over other inputs (or saved without
+        its tokens_hash), e.g. left in the work dir by a run with other data
+    """
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _top_acts_indexes:
+        _top_acts_indexes[key] = TopActivationsIndex.load(path)
+    index = _top_acts_indexes[key]
+    if batch_tokens is not None and index.inputs_hash != tokens_hash(batch_tokens):
+        raise ValueError(f"{path} was built over other inputs ({index.inputs_hash}, expected "
+                         f"{tokens_hash(batch_tokens)}); extract the layer again to rebuild it")
+    return index
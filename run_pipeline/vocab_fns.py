@@ -0,0 +1,73 @@
+import json
+import os
+
+import numpy as np
+
+# in-process cache so each tokenizer is only decoded / loaded once per run
+_vocab_tables = {}
+
+def normalize_tok_str(tok_str):
+    # same normalization the keyword searches use: drop spaces and lowercase
+    return tok_str.replace(' ', '').lower()
+
+class VocabTable:
+    '''
+    Decoded vocabulary of a tokenizer: id_to_str[tok_id] is tokenizer.decode(tok_id), so decoding becomes an
+    array index. str_to_ids maps a normalized string to the sorted array of IDs that decode to it.
+    '''
+    def __init__(self, id_to_str):
+        self.id_to_str = np.asarray(id_to_str, dtype=object)
+        self._str_to_ids = None
+
+    def __len__(self):
+        return len(self.id_to_str)
+
+    def decode(self, tok_ids):
+        # works on a single ID, a list, or any numpy / torch integer array
+        if hasattr(tok_ids, 'cpu'):
+            tok_ids = tok_ids.cpu().numpy()
+        return self.id_to_str[tok_ids]
+
+    @property
+    def str_to_ids(self):
+        if self._str_to_ids is None:
+            norm_strs = np.array([normalize_tok_str(tok_str) for tok_str in self.id_to_str], dtype=object)
+            order = np.argsort(norm_strs, kind='stable')
+            unq_strs, starts = np.unique(norm_strs[order], return_index=True)
+            self._str_to_ids = dict(zip(unq_strs.tolist(), np.split(order, starts[1:])))
+        return self._str_to_ids
+
+    def ids_for(self, word):
+        return self.str_to_ids.get(normalize_tok_str(word), np.array([], dtype=np.int64))
+
+def vocab_table_path(tokenizer, cache_dir='.'):
+    tok_name = str(getattr(tokenizer, 'name_or_path', '') or 'tokenizer').replace('/', '_')
+    return os.path.join(cache_dir, f'vocab_{tok_name}_{len(tokenizer)}.json')
+
+def build_vocab_table(tokenizer):
+    # one batched decode over the whole vocab instead of a decode call per token in the hot loops
+    id_to_str = tokenizer.batch_decode([[tok_id] for tok_id in range(len(tokenizer))])
+    return VocabTable(id_to_str)
+
+def get_vocab_table(tokenizer, cache_dir=None):
+    '''
+    Returns the VocabTable for tokenizer, building it once per process.
+    cache_dir: if given (the directory the SAE activations are saved in, e.g. work_dir), the table is persisted there
+        so later runs only load it
+    '''
+    path = vocab_table_path(tokenizer, cache_dir if cache_dir is not None else '')
+    if path in _vocab_tables:
+        return _vocab_tables[path]
+
+    if cache_dir is not None and os.path.exists(path):
+        with open(path, 'r') as f:
+            vocab = VocabTable(json.load(f))
+    else:
+        vocab = build_vocab_table(tokenizer)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(vocab.id_to_str.tolist(), f)
+
+    _vocab_tables[path] = vocab
+    return vocab